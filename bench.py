@@ -0,0 +1,387 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import random
+import tempfile
+import threading
+import time
+from storage import Storage, VectorClock, VersionedValue, RecordCodec, TreeRecords
+from wal import WriteAheadLog
+from engine import ENGINES
+from ring import Ring, VirtualNode, HASHES
+from config import config
+
+def put_latency(history_sizes: list[int], samples: int = 200) -> None:
+    """
+    Mean add_version latency on a single key after it has accumulated `history` versions.
+    Every put supersedes the current leaf, like a cart that keeps getting updated.
+    """
+    print(f"{'history':>10} | {'put latency (us)':>16}")
+    for history in history_sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Storage(os.path.join(tmp, "bench_storage.db"))
+            for version in range(1, history + 1):
+                db.add_version("cart", f"value{version}", VectorClock({"A": version}))
+
+            start = time.perf_counter()
+            for version in range(history + 1, history + samples + 1):
+                db.add_version("cart", f"value{version}", VectorClock({"A": version}))
+            elapsed = time.perf_counter() - start
+            db.close()
+
+        print(f"{history:>10} | {elapsed / samples * 1e6:>16.1f}")
+
+def get_latency(history_sizes: list[int], samples: int = 1000) -> None:
+    """
+    Mean get_leaf_nodes latency on a key with `history` versions and two concurrent leaves,
+    next to the cost of assembling the whole version tree.
+    """
+    print(f"{'history':>10} | {'get_leaf_nodes (us)':>19} | {'get_version_tree (us)':>21}")
+    for history in history_sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Storage(os.path.join(tmp, "bench_storage.db"))
+            for version in range(1, history - 1):
+                db.add_version("cart", f"value{version}", VectorClock({"A": version}))
+            db.add_version("cart", "sibling1", VectorClock({"A": history, "B": 1}))
+            db.add_version("cart", "sibling2", VectorClock({"A": history, "C": 1}))
+
+            start = time.perf_counter()
+            for _ in range(samples):
+                db.get_leaf_nodes("cart")
+            leaves_elapsed = time.perf_counter() - start
+
+            tree_samples = max(1, samples // history)
+            start = time.perf_counter()
+            for _ in range(tree_samples):
+                db.get_version_tree("cart")
+            tree_elapsed = time.perf_counter() - start
+            db.close()
+
+        print(f"{history:>10} | {leaves_elapsed / samples * 1e6:>19.1f} | {tree_elapsed / tree_samples * 1e6:>21.1f}")
+
+def wal_throughput(thread_counts: list[int], puts: int = 200, windows: tuple = (0, 0.001, 0.002, 0.005)) -> None:
+    """
+    Durable puts per second through the write-ahead log with `threads` concurrent writers
+    on distinct keys, for several group commit windows.
+    """
+    print(f"{'threads':>10} | " + " | ".join(f"{f'{window * 1000:g} ms window':>15}" for window in windows) + " | fsyncs/commit")
+    for threads in thread_counts:
+        row = []
+        for window in windows:
+            with tempfile.TemporaryDirectory() as tmp:
+                wal = WriteAheadLog(os.path.join(tmp, "bench_wal.log"), window)
+                db = Storage(os.path.join(tmp, "bench_storage.db"), wal)
+
+                def writer(thread: int):
+                    for version in range(1, puts + 1):
+                        db.add_version(f"cart{thread}", f"value{version}", VectorClock({"A": version}))
+
+                workers = [threading.Thread(target=writer, args=(thread,)) for thread in range(threads)]
+                start = time.perf_counter()
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                elapsed = time.perf_counter() - start
+                row.append(threads * puts / elapsed)
+                ratio = wal.fsyncs / wal.commits
+                wal.close()
+                db.close()
+
+        print(f"{threads:>10} | " + " | ".join(f"{rate:>15.0f}" for rate in row) + f" | {ratio:.3f}")
+
+def engine_throughput(key_counts: list[int], engines: tuple = tuple(ENGINES)) -> None:
+    """
+    Operations per second of every storage engine for the basic workloads:
+    inserting new keys, updating existing keys and reading their leaves.
+    """
+    print(f"{'engine':>8} | {'keys':>8} | {'insert/s':>10} | {'update/s':>10} | {'get/s':>10}")
+    for engine in engines:
+        for keys in key_counts:
+            with tempfile.TemporaryDirectory() as tmp:
+                try:
+                    db = Storage(os.path.join(tmp, "bench_storage.db"), engine=engine)
+                except ImportError as e:
+                    print(f"{engine:>8} | skipped: {e}")
+                    break
+
+                rates = []
+                for version in (1, 2):
+                    start = time.perf_counter()
+                    for key in range(keys):
+                        db.add_version(f"cart{key}", f"value{version}", VectorClock({"A": version}))
+                    rates.append(keys / (time.perf_counter() - start))
+
+                start = time.perf_counter()
+                for key in range(keys):
+                    db.get_leaf_nodes(f"cart{key}")
+                rates.append(keys / (time.perf_counter() - start))
+                db.close()
+
+            print(f"{engine:>8} | {keys:>8} | " + " | ".join(f"{rate:>10.0f}" for rate in rates))
+
+class SlowReads:
+    """Engine wrapper adding a fixed latency to every read, like a disk seek on a cold key."""
+    def __init__(self, db, latency: float):
+        self.db = db
+        self.latency: float = latency
+
+    def get(self, key: bytes, default=None):
+        time.sleep(self.latency)
+        return self.db.get(key, default)
+
+    def __getattr__(self, name: str):
+        return getattr(self.db, name)
+
+def lock_striping(thread_counts: list[int], puts: int = 300, stripes: tuple = (1, 64), latency: float = 0.0001) -> None:
+    """
+    Puts per second with `threads` concurrent writers on distinct keys, with a single lock
+    for the whole storage against a pool of striped locks. The cache is off and every read
+    waits `latency` seconds, so writers spend their time in the engine like on cold keys.
+    """
+    print(f"{'threads':>10} | " + " | ".join(f"{f'{count} stripes':>12}" for count in stripes))
+    defaults = config.LOCK_STRIPES, config.CACHE_ENTRIES
+    config.CACHE_ENTRIES = 0
+    for threads in thread_counts:
+        row = []
+        for count in stripes:
+            config.LOCK_STRIPES = count
+            with tempfile.TemporaryDirectory() as tmp:
+                db = Storage(os.path.join(tmp, "bench_storage.db"))
+                db.db = SlowReads(db.db, latency)
+
+                def writer(thread: int):
+                    for version in range(1, puts + 1):
+                        db.add_version(f"cart{thread}", f"value{version}", VectorClock({"A": version}))
+
+                workers = [threading.Thread(target=writer, args=(thread,)) for thread in range(threads)]
+                start = time.perf_counter()
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                row.append(threads * puts / (time.perf_counter() - start))
+                db.close()
+        print(f"{threads:>10} | " + " | ".join(f"{rate:>12.0f}" for rate in row))
+    config.LOCK_STRIPES, config.CACHE_ENTRIES = defaults
+
+def cart_records(history: int) -> list:
+    """
+    Records of a cart updated `history` times by coordinators spread over three servers,
+    with the occasional concurrent update leaving siblings behind.
+    """
+    rng = random.Random(history)
+    servers = ["localhost:2000", "localhost:2001", "localhost:2002"]
+    clock: dict[str, int] = {}
+    records = []
+    previous = None
+    for version in range(1, history + 1):
+        server = rng.choice(servers)
+        clock[server] = clock.get(server, 0) + 1
+        items = [f"item{rng.randrange(100)}" for _ in range(rng.randrange(1, 6))]
+        versioned_value = VersionedValue(",".join(items), VectorClock(dict(clock)))
+        node_id = TreeRecords.node_id(versioned_value)
+        records.append((versioned_value, time.time()))
+        records.append({previous} if previous else {b"root"})
+        records.append({node_id: versioned_value} if rng.random() > 0.1 else {node_id: versioned_value, previous or b"root": "root"})
+        previous = node_id
+    return records
+
+def codec_comparison(history_sizes: list[int]) -> None:
+    """Encode and decode time and total encoded size of cart histories, pickle against RecordCodec."""
+    print(f"{'history':>10} | {'codec':>6} | {'encode (us/rec)':>15} | {'decode (us/rec)':>15} | {'bytes':>10}")
+    codecs = {"pickle": (pickle.dumps, pickle.loads), "binary": (RecordCodec.encode, RecordCodec.decode)}
+    for history in history_sizes:
+        records = cart_records(history)
+        for name, (encode, decode) in codecs.items():
+            start = time.perf_counter()
+            encoded = [encode(record) for record in records]
+            encode_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for raw in encoded:
+                decode(raw)
+            decode_elapsed = time.perf_counter() - start
+
+            size = sum(len(raw) for raw in encoded)
+            print(f"{history:>10} | {name:>6} | {encode_elapsed / len(records) * 1e6:>15.2f} | {decode_elapsed / len(records) * 1e6:>15.2f} | {size:>10}")
+
+def compression_ratio(key_counts: list[int], threshold: int = 128) -> None:
+    """
+    Stored size and put latency of cart JSON values without compression, with zlib alone and
+    with zlib and a dictionary trained on the first carts.
+    """
+    print(f"{'keys':>8} | {'mode':>10} | {'ratio':>6} | {'stored bytes':>12} | {'put (us)':>8}")
+    default = config.COMPRESSION_THRESHOLD
+    rng = random.Random(0)
+    for keys in key_counts:
+        carts = [json.dumps({"cart": [{"item": f"product-{rng.randrange(200)}", "quantity": rng.randrange(1, 4)}
+                                      for _ in range(rng.randrange(1, 8))]}) for _ in range(keys)]
+        for mode in ("off", "zlib", "dictionary"):
+            config.COMPRESSION_THRESHOLD = None if mode == "off" else threshold
+            with tempfile.TemporaryDirectory() as tmp:
+                db = Storage(os.path.join(tmp, "bench_storage.db"))
+                if mode == "dictionary":
+                    db.train_compression([cart.encode() for cart in carts[:200]])
+                start = time.perf_counter()
+                for key, cart in enumerate(carts):
+                    db.add_version(f"cart{key}", cart, VectorClock({"A": 1}))
+                elapsed = time.perf_counter() - start
+                stats = db.compression.stats()
+                db.close()
+            print(f"{keys:>8} | {mode:>10} | {stats['ratio']:>6.2f} | {stats['stored_bytes']:>12} | {elapsed / keys * 1e6:>8.1f}")
+    config.COMPRESSION_THRESHOLD = default
+
+def cold_reads(key_counts: list[int], reads: int = 2000) -> None:
+    """
+    Size of the hot engine and mean get_leaf_nodes latency with the cache off, with every key in the
+    hot engine and once all keys moved to cold segments.
+    """
+    print(f"{'keys':>8} | {'tier':>5} | {'hot records':>11} | {'get (us)':>8}")
+    defaults = config.CACHE_ENTRIES, config.COLD_AFTER
+    config.CACHE_ENTRIES, config.COLD_AFTER = 0, 3600
+    for keys in key_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Storage(os.path.join(tmp, "bench_storage.db"))
+            for version in (1, 2):
+                db.multi_put([(f"cart{key}", f"value{version}", VectorClock({"A": version})) for key in range(keys)])
+            rng = random.Random(keys)
+            for tier in ("hot", "cold"):
+                if tier == "cold":
+                    db.demote_cold(idle=0)
+                sample = [f"cart{rng.randrange(keys)}" for _ in range(reads)]
+                start = time.perf_counter()
+                for key in sample:
+                    db.get_leaf_nodes(key)
+                elapsed = time.perf_counter() - start
+                print(f"{keys:>8} | {tier:>5} | {len(db.db.hot.keys()):>11} | {elapsed / reads * 1e6:>8.1f}")
+            db.close()
+    config.CACHE_ENTRIES, config.COLD_AFTER = defaults
+
+def dag_walk(sibling_counts: list[int], samples: int = 2000) -> None:
+    """
+    Mean time to link a new version into a version tree whose leaves are `siblings` concurrent
+    versions written through as many servers, the new version superseding them all. Records are
+    decoded beforehand, so this is the cost of the walk and its clock comparisons alone.
+    """
+    print(f"{'siblings':>10} | {'insert walk (us)':>16}")
+    for siblings in sibling_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Storage(os.path.join(tmp, "bench_storage.db"), engine="memory")
+            db.add_version("cart", "base", VectorClock({"A": 1}))
+            merged = {"A": 2}
+            for sibling in range(siblings):
+                for version in (1, 2):
+                    db.add_version("cart", f"value{sibling}.{version}", VectorClock({"A": 1, f"S{sibling}": version}))
+                merged[f"S{sibling}"] = 2
+
+            records = db._records(db.encode("cart"))
+            new_version = VersionedValue("merged", VectorClock(merged))
+            db._insert(records, new_version)    # Load every record the walk reads
+            start = time.perf_counter()
+            for _ in range(samples):
+                records.dirty.clear()
+                db._insert(records, new_version)
+            elapsed = time.perf_counter() - start
+            db.close()
+        print(f"{siblings:>10} | {elapsed / samples * 1e6:>16.1f}")
+
+def ring_lookup(token_counts: list[int], lookups: int = 20000) -> None:
+    """
+    Mean preference list lookup time for a key on a ring of `tokens` virtual nodes spread over
+    servers of config.T tokens each, and the time to rebuild the ring after a server adds a token.
+    """
+    print(f"{'tokens':>10} | {'lookup (us)':>12} | {'rebuild (ms)':>12}")
+    for tokens in token_counts:
+        rng = random.Random(tokens)
+        nodes = [VirtualNode(f"server{i % max(1, tokens // config.T)}", pos)
+                 for i, pos in enumerate(rng.sample(range(config.Q), tokens))]
+        ring = Ring(nodes, {})
+        ring.serverName = nodes[0].server
+        ring.versions = {nodes[0].server: 1}
+        keys = [str(rng.random()) for _ in range(1000)]
+
+        start = time.perf_counter()
+        for i in range(lookups):
+            ring.getPrefList(keys[i % len(keys)])
+        lookup = (time.perf_counter() - start) / lookups
+
+        start = time.perf_counter()
+        ring.add(rng.randrange(config.Q))
+        rebuild = time.perf_counter() - start
+        print(f"{tokens:>10} | {lookup * 1e6:>12.2f} | {rebuild * 1e3:>12.2f}")
+
+def key_hashes(key_counts: list[int], ranges: int = 256) -> None:
+    """
+    Throughput of the key hash functions of the ring, against the md5 hex digest parsing used before,
+    and how evenly they spread `keys` sequential cart keys over `ranges` equal token ranges of Q:
+    chi-squared per degree of freedom, about 1 for a uniform hash, and the fullest range over the mean.
+    """
+    hashes = {"md5 (hex)": lambda data: int(hashlib.md5(data).hexdigest(), 16), **HASHES}
+    print(f"{'keys':>10} | {'hash':>10} | {'Mkeys/s':>8} | {'chi2/dof':>8} | {'max/mean':>8}")
+    for keys in key_counts:
+        data = [f"cart{key}".encode() for key in range(keys)]
+        for name, hash in hashes.items():
+            start = time.perf_counter()
+            tokens = [hash(key) % config.Q for key in data]
+            elapsed = time.perf_counter() - start
+
+            counts = [0] * ranges
+            for token in tokens:
+                counts[token * ranges // config.Q] += 1
+            mean = keys / ranges
+            chi2 = sum((count - mean) ** 2 / mean for count in counts) / (ranges - 1)
+            print(f"{keys:>10} | {name:>10} | {keys / elapsed / 1e6:>8.2f} | {chi2:>8.2f} | {max(counts) / mean:>8.2f}")
+
+def gossip_bytes(server_counts: list[int], changed: int = 1) -> None:
+    """
+    JSON bytes of one gossip round between two servers of a ring of `servers` servers of config.T
+    tokens each, when `changed` servers added a token: whole rings both ways against deltas.
+    """
+    print(f"{'servers':>10} | {'whole rings':>11} | {'deltas':>8} | {'saved':>6}")
+    for servers in server_counts:
+        rng = random.Random(servers)
+        nodes = [VirtualNode(f"server{i}", rng.randrange(config.Q)) for i in range(servers) for _ in range(config.T)]
+        versions = {f"server{i}": 1 for i in range(servers)}
+        behind, ahead = Ring(nodes, dict(versions)), Ring(nodes, dict(versions))
+        for i in range(changed):
+            ahead.serverName = f"server{i}"
+            ahead.add(rng.randrange(config.Q))
+
+        whole = len(json.dumps({'ring': behind.serialize()})) + len(json.dumps({'ring': ahead.serialize()}))
+        request = {'versions': behind.versions, 'keyHash': behind.keyHash}
+        response = {'delta': ahead.delta(ahead.newerThan(behind.versions)), 'request': ahead.olderThan(behind.versions),
+                    'keyHash': ahead.keyHash}
+        deltas = len(json.dumps(request)) + len(json.dumps(response))
+        behind.mergeDelta(response['delta'], response['keyHash'])
+        assert behind.snapshot.prefLists == ahead.snapshot.prefLists
+        print(f"{servers:>10} | {whole:>11} | {deltas:>8} | {1 - deltas / whole:>6.0%}")
+
+BENCHMARKS = {
+    "put": put_latency,
+    "get": get_latency,
+    "wal": wal_throughput,
+    "engines": engine_throughput,
+    "codec": codec_comparison,
+    "stripes": lock_striping,
+    "compression": compression_ratio,
+    "cold": cold_reads,
+    "dag": dag_walk,
+    "ring": ring_lookup,
+    "hashes": key_hashes,
+    "gossip": gossip_bytes,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=BENCHMARKS.keys(), help="Benchmark to run")
+    parser.add_argument('-sizes', nargs='+', type=int, default=[10, 100, 1000, 10000], help="History sizes, writer threads for wal and stripes, keys for engines and hashes, tokens for ring or servers for gossip")
+    parser.add_argument('-engine', choices=ENGINES.keys(), help="Storage engine, config.ENGINE by default")
+    args = parser.parse_args()
+
+    if args.engine:
+        config.ENGINE = args.engine
+
+    BENCHMARKS[args.benchmark](args.sizes)
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+class LRUCache:
+    """
+    Least recently used cache bounded by both entry count and total size in bytes.
+    Sizes are given by the caller, usually the encoded size of what the entry decodes.
+    """
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries: int = max_entries
+        self.max_bytes: int = max_bytes
+        self.entries: OrderedDict[Any, tuple[Any, int]] = OrderedDict()
+        self.bytes: int = 0
+        self.lock = threading.Lock()
+
+        # Metrics
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key: Any) -> Optional[Any]:
+        """Lookup that does not count as a use, for a second access after get or for writers."""
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def __contains__(self, key: Any) -> bool:
+        """Membership test that does not count as a use."""
+        return key in self.entries
+
+    def put(self, key: Any, value: Any, size: int) -> None:
+        """Insert or refresh an entry, evicting the least recently used ones to make room."""
+        with self.lock:
+            self._remove(key)
+            if size > self.max_bytes or self.max_entries <= 0:
+                return
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def pop(self, key: Any) -> None:
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key: Any) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        """Counters for sizing the cache."""
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -67,6 +67,11 @@ class Client:
                 new_vc = new_vc.merge(vc)
             
             deserialized.add(VersionedValue(serialized[0],new_vc))
+
+        elif len(serialized[1]) == 1:
+            # Siblings sharing the context that covers them all
+            for value in serialized[0]:
+                deserialized.add(VersionedValue(value, VectorClock(serialized[1][0])))
         
         else:
 
@@ -0,0 +1,254 @@
+import mmap
+import os
+import pickle
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+from engine import Engine, Writes
+
+class ColdSegment:
+    """
+    Immutable file of the records of keys moved out of the hot engine, memory-mapped for reads.
+    Layout: the record values back to back, a metadata block mapping every key to the
+    {record key: (offset, length)} of its records, and a footer with the metadata offset.
+    """
+    FOOTER = struct.Struct('!Q8s')
+    MAGIC = b'COLDSEG1'
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self.number: int = int(os.path.basename(path)[:-len('.seg')])
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        meta_offset, magic = self.FOOTER.unpack_from(self.map, len(self.map) - self.FOOTER.size)
+        if magic != self.MAGIC:
+            raise ValueError(f"Not a cold segment file: {path}")
+        self.keys: dict[bytes, dict[bytes, tuple[int, int]]] = pickle.loads(self.view[meta_offset:-self.FOOTER.size])
+        self.readers: int = 0           # Reads in progress, the store unmaps the segment once they are done
+        self.closing: bool = False
+
+    def read(self, offset: int, length: int) -> memoryview:
+        """A record, as a slice of the mapping: served from the page cache, never copied."""
+        return self.view[offset:offset + length]
+
+    def close(self) -> None:
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            pass    # Still exported by a record being read, unmapped once it is released
+
+    @classmethod
+    def write(cls, path: str, keys: dict[bytes, Writes]) -> None:
+        """Write the records of several keys atomically to path."""
+        index: dict[bytes, dict[bytes, tuple[int, int]]] = {}
+        with open(path + '.tmp', 'wb') as file:
+            offset = 0
+            for key_bytes, records in keys.items():
+                index[key_bytes] = {}
+                for record_key, value in records:
+                    file.write(value)
+                    index[key_bytes][record_key] = (offset, len(value))
+                    offset += len(value)
+            file.write(pickle.dumps(index))
+            file.write(cls.FOOTER.pack(offset, cls.MAGIC))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+
+class ColdStore:
+    """
+    Directory of cold segments with an in-memory index of the records of every cold key.
+    A key lives in the newest segment holding it. Segments whose keys have all been moved back
+    to the hot engine are deleted by collect, once the hot engine holds those keys durably.
+    """
+    def __init__(self, path: str):
+        self.path: str = path
+        self.lock = threading.Lock()
+        self.index: dict[bytes, tuple[ColdSegment, dict[bytes, tuple[int, int]]]] = {}
+        self.live: dict[ColdSegment, int] = {}      # Cold keys held by each segment
+        self.dead: list[ColdSegment] = []           # Segments without cold keys, to delete
+        self.next: int = 1
+
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.tmp'):
+                    os.remove(os.path.join(path, name))
+                elif name.endswith('.seg'):
+                    self._add(ColdSegment(os.path.join(path, name)))
+
+    def _add(self, segment: ColdSegment) -> None:
+        """Index the keys of a segment, newer than any indexed so far. Called holding self.lock or on open."""
+        self.live[segment] = 0
+        for key_bytes, records in segment.keys.items():
+            if key_bytes in self.index:
+                self._release(self.index[key_bytes][0])
+            self.index[key_bytes] = (segment, records)
+            self.live[segment] += 1
+        self.next = segment.number + 1
+        if not self.live[segment]:
+            self._release(segment, 0)
+
+    def _release(self, segment: ColdSegment, keys: int = 1) -> None:
+        """Forget keys of a segment, which is dead once it has none left."""
+        self.live[segment] -= keys
+        if self.live[segment] <= 0:
+            del self.live[segment]
+            self.dead.append(segment)
+
+    def __contains__(self, key_bytes: bytes) -> bool:
+        return key_bytes in self.index
+
+    @contextmanager
+    def _pinned(self, key_bytes: bytes) -> Iterator[Optional[tuple[ColdSegment, dict[bytes, tuple[int, int]]]]]:
+        """The segment and record locations of a cold key, its segment kept mapped while in use."""
+        with self.lock:
+            entry = self.index.get(key_bytes)
+            if entry is not None:
+                entry[0].readers += 1
+        try:
+            yield entry
+        finally:
+            if entry is not None:
+                with self.lock:
+                    entry[0].readers -= 1
+                    if entry[0].closing and not entry[0].readers:
+                        entry[0].close()
+
+    def get(self, record_key: bytes) -> Optional[memoryview]:
+        with self._pinned(record_key.split(b"\x00", 1)[0]) as entry:
+            if entry is None:
+                return None
+            segment, records = entry
+            location = records.get(record_key)
+            return segment.read(*location) if location is not None else None
+
+    def record_keys(self) -> Iterator[bytes]:
+        for _, records in list(self.index.values()):
+            yield from records
+
+    def records(self, key_bytes: bytes) -> Writes:
+        """Copies of every record of a cold key, none if it is not cold."""
+        with self._pinned(key_bytes) as entry:
+            if entry is None:
+                return []
+            segment, records = entry
+            return [(record_key, bytes(segment.read(*location))) for record_key, location in records.items()]
+
+    def add(self, keys: dict[bytes, Writes]) -> None:
+        """Write the records of several keys to a new segment and serve them from it."""
+        os.makedirs(self.path, exist_ok=True)
+        with self.lock:
+            path = os.path.join(self.path, f"{self.next:08d}.seg")
+            ColdSegment.write(path, keys)
+            self._add(ColdSegment(path))
+
+    def drop(self, keys_bytes: list[bytes]) -> None:
+        """Stop serving keys, once their records are back in the hot engine."""
+        with self.lock:
+            for key_bytes in keys_bytes:
+                entry = self.index.pop(key_bytes, None)
+                if entry is not None:
+                    self._release(entry[0])
+
+    def dead_segments(self) -> list[ColdSegment]:
+        """The segments without cold keys as of now."""
+        with self.lock:
+            return list(self.dead)
+
+    def collect(self, segments: Optional[list[ColdSegment]] = None) -> None:
+        """Delete the given segments without cold keys, all of them by default, unmapping each once its reads are done."""
+        with self.lock:
+            dead = self.dead if segments is None else [segment for segment in self.dead if segment in segments]
+            self.dead = [segment for segment in self.dead if segment not in dead]
+            for segment in dead:
+                os.remove(segment.path)
+                if segment.readers:
+                    segment.closing = True
+                else:
+                    segment.close()
+
+    def close(self) -> None:
+        for segment in list(self.live) + self.dead:
+            segment.close()
+
+class TieredEngine(Engine):
+    """
+    Hot engine in front of a cold store of keys no one touched for a while.
+    Reads fall through to the cold store, whose records are memoryview slices of its segments.
+    Writes go to the hot engine: the first write to a cold key moves all of its records back first.
+    A key whose marker record is in the hot engine is hot, so a key moved back whose cold copy
+    outlived a crash is read from the hot engine alone. Write-ahead logs replay into the hot engine.
+    """
+    def __init__(self, hot: Engine, cold_path: str):
+        self.hot: Engine = hot
+        self.cold = ColdStore(cold_path)
+        stale = [key_bytes for key_bytes in self.cold.index if self.hot.has_key(key_bytes)]
+        self.cold.drop(stale)
+
+    def __getitem__(self, key: bytes) -> bytes:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: bytes, default: Optional[bytes] = None) -> Optional[bytes]:
+        value = self.hot.get(key)
+        if value is None:
+            value = self.cold.get(key)
+        return value if value is not None else default
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, Optional[bytes]]:
+        values = self.hot.get_many(keys)
+        for key, value in values.items():
+            if value is None:
+                values[key] = self.cold.get(key)
+        return values
+
+    def __contains__(self, key: bytes) -> bool:
+        return self.hot.has_key(key) or self.cold.get(key) is not None
+
+    def keys(self) -> list[bytes]:
+        return list(self.hot.keys()) + list(self.cold.record_keys())
+
+    def __setitem__(self, key: bytes, value: bytes) -> None:
+        self.write_batch([(key, value)])
+
+    def __delitem__(self, key: bytes) -> None:
+        self.write_batch([(key, None)])
+
+    def thaw(self, keys_bytes: list[bytes]) -> Writes:
+        """Move cold keys back to the hot engine, returns the records moved."""
+        cold = [key_bytes for key_bytes in keys_bytes if key_bytes in self.cold]
+        records = [record for key_bytes in cold for record in self.cold.records(key_bytes)]
+        if records:
+            self.hot.write_batch(records)
+            self.cold.drop(cold)
+        return records
+
+    def write_batch(self, writes: Writes) -> None:
+        self.thaw(list({key.split(b"\x00", 1)[0] for key, _ in writes}))
+        self.hot.write_batch(writes)
+
+    def demote(self, keys: dict[bytes, Writes], write: Optional[Callable[[Writes], None]] = None) -> Writes:
+        """
+        Move every record of several keys to a new cold segment, then delete them from the hot engine
+        with `write`, such as a commit through a write-ahead log. Returns the deletions.
+        """
+        self.cold.add(keys)
+        deletions: Writes = [(record_key, None) for records in keys.values() for record_key, _ in records]
+        (write or self.hot.write_batch)(deletions)
+        return deletions
+
+    def sync(self) -> None:
+        # Keys moved back after the hot engine synced are not durable there yet: keep their segments
+        dead = self.cold.dead_segments()
+        self.hot.sync()
+        self.cold.collect(dead)
+
+    def close(self) -> None:
+        self.hot.close()
+        self.cold.collect()
+        self.cold.close()
@@ -0,0 +1,118 @@
+import hashlib
+import re
+import struct
+import threading
+import zlib
+from collections import Counter
+from typing import Callable, Optional
+from engine import Engine, Writes
+
+# A compressed record is a (COMPRESSED, dictionary id) header followed by a raw deflate stream.
+# Dictionary id 0 is no dictionary. Encoded records never start with COMPRESSED.
+COMPRESSED: int = 2
+HEADER = struct.Struct('!BI')
+
+DICTIONARY_PREFIX: bytes = b"\x00zd"     # Preset dictionaries, by id
+ACTIVE_KEY: bytes = b"\x00za"            # Id of the dictionary new records are compressed with
+
+def train_dictionary(samples: list[bytes], size: int = 4096) -> bytes:
+    """
+    Preset dictionary for zlib built from sample values, such as cart JSON: the strings and the
+    punctuation between them that recur across samples, the most useful last since zlib reaches
+    recent bytes with shorter distances.
+    """
+    counts: Counter[bytes] = Counter()
+    for sample in samples:
+        counts.update(set(re.findall(rb'"[^"]*"|[^"]+', sample)))
+
+    picked: list[bytes] = []
+    total = 0
+    for token, count in sorted(counts.items(), key=lambda item: item[1] * len(item[0]), reverse=True):
+        if count > 1 and total + len(token) <= size:
+            picked.append(token)
+            total += len(token)
+    return b"".join(reversed(picked))
+
+class Compression:
+    """
+    zlib compression of encoded records of at least `threshold` bytes, None turns it off.
+    Records are compressed with the active preset dictionary, if any, and kept as they are when
+    compression does not make them smaller. Compressed records are read whatever the threshold.
+    `write` commits records durably, such as through the write-ahead log of the database.
+    """
+    def __init__(self, db: Engine, threshold: Optional[int], level: int = 6,
+                 write: Optional[Callable[[Writes], None]] = None):
+        self.db = db
+        self.write: Optional[Callable[[Writes], None]] = write
+        self.threshold: Optional[int] = threshold
+        self.level: int = level
+        self.dictionaries: dict[int, bytes] = {}
+        self.lock = threading.Lock()
+
+        active = self.db.get(ACTIVE_KEY)
+        self.active: int = struct.unpack('!I', active)[0] if active is not None else 0
+
+        # Metrics
+        self.records: int = 0           # Records encoded
+        self.compressed: int = 0        # Records stored compressed
+        self.raw_bytes: int = 0         # Encoded bytes of all records
+        self.stored_bytes: int = 0      # Bytes of all records as stored
+
+    def _dictionary(self, dictionary_id: int) -> Optional[bytes]:
+        if not dictionary_id:
+            return None
+        if dictionary_id not in self.dictionaries:
+            zdict = self.db.get(DICTIONARY_PREFIX + struct.pack('!I', dictionary_id))
+            if zdict is None:
+                raise ValueError(f"Missing compression dictionary {dictionary_id}")
+            self.dictionaries[dictionary_id] = zdict
+        return self.dictionaries[dictionary_id]
+
+    def add_dictionary(self, zdict: bytes) -> int:
+        """
+        Store a preset dictionary and compress new records with it, returns its id.
+        The dictionary is durable before any record compressed with it is written.
+        """
+        dictionary_id = int.from_bytes(hashlib.blake2b(zdict, digest_size=4).digest(), 'big') or 1
+        writes = [(DICTIONARY_PREFIX + struct.pack('!I', dictionary_id), zdict),
+                  (ACTIVE_KEY, struct.pack('!I', dictionary_id))]
+        (self.write or self.db.write_batch)(writes)
+        self.dictionaries[dictionary_id] = zdict
+        self.active = dictionary_id
+        return dictionary_id
+
+    def compress(self, raw: bytes) -> bytes:
+        stored = raw
+        if self.threshold is not None and len(raw) >= self.threshold:
+            zdict = self._dictionary(self.active)
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=zdict) if zdict \
+                else zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            data = HEADER.pack(COMPRESSED, self.active) + compressor.compress(raw) + compressor.flush()
+            if len(data) < len(raw):
+                stored = data
+
+        with self.lock:
+            self.records += 1
+            self.compressed += stored is not raw
+            self.raw_bytes += len(raw)
+            self.stored_bytes += len(stored)
+        return stored
+
+    def decompress(self, data: bytes) -> bytes:
+        if data[0] != COMPRESSED:
+            return data
+        _, dictionary_id = HEADER.unpack_from(data)
+        zdict = self._dictionary(dictionary_id)
+        decompressor = zlib.decompressobj(-15, zdict=zdict) if zdict else zlib.decompressobj(-15)
+        return decompressor.decompress(data[HEADER.size:]) + decompressor.flush()
+
+    def stats(self) -> dict[str, float]:
+        """Counters of the records encoded so far, ratio is encoded over stored bytes."""
+        with self.lock:
+            return {
+                "records": self.records,
+                "compressed": self.compressed,
+                "raw_bytes": self.raw_bytes,
+                "stored_bytes": self.stored_bytes,
+                "ratio": self.raw_bytes / self.stored_bytes if self.stored_bytes else 1.0,
+            }
@@ -8,7 +8,16 @@ LB_PORT: Final[int] = 4000
 BUFFER_SIZE: Final[int] = 1024
 
 class Config:
-    def __init__(self, N, R, W, Q, T, G, I):
+    def __init__(self, N, R, W, Q, T, G, I, GC_MODE=None, GC_GENERATIONS=None, GC_WINDOW=None, GC_INTERVAL=60,
+                 WAL_WINDOW=None, WAL_CHECKPOINT=1 << 22, ENGINE="bsddb",
+                 LSM_MEMTABLE_SIZE=1 << 22, LSM_COMPACTION_THRESHOLD=4,
+                 CACHE_ENTRIES=10000, CACHE_BYTES=1 << 26, VERSION_BLOCK=1000,
+                 LOCK_STRIPES=64, MERKLE_DEPTH=10, RING_HASH="md5",
+                 COMPRESSION_THRESHOLD=None, COMPRESSION_LEVEL=6, COMPRESSION_DICTIONARY_SIZE=4096,
+                 COLD_AFTER=None, COLD_INTERVAL=300, COLD_SEGMENT_KEYS=1000,
+                 DEFAULT_TTL=None, TTL_SWEEP_INTERVAL=60, TTL_SWEEP_RATE=1000, TOMBSTONE_GRACE=86400,
+                 CLOCK_MAX_ENTRIES=None, DOTTED_VERSION_VECTORS=False,
+                 PHI_THRESHOLD=8.0, PHI_WINDOW=100, PHI_MIN_STD=1.0, SKIP_SUSPECTED=False):
         self.N = N
         self.R = R
         self.W = W
@@ -17,6 +26,47 @@ class Config:
         self.G = G      # Number of servers to gossip with
         self.I = I      # Gossip interval
 
+        self.GC_MODE = GC_MODE                  # Version tree garbage collection: None, "inline" or "background"
+        self.GC_GENERATIONS = GC_GENERATIONS    # Generations of ancestors kept below the leaves
+        self.GC_WINDOW = GC_WINDOW              # Seconds for which ancestors are kept
+        self.GC_INTERVAL = GC_INTERVAL          # Seconds between background garbage collection sweeps
+
+        self.WAL_WINDOW = WAL_WINDOW            # Seconds writes wait to share an fsync, None disables the write-ahead log
+        self.WAL_CHECKPOINT = WAL_CHECKPOINT    # Log size in bytes after which the databases are synced and the log truncated
+
+        self.ENGINE = ENGINE                    # Storage engine: "bsddb", "memory", "sqlite", "log" or "lsm"
+        self.LSM_MEMTABLE_SIZE = LSM_MEMTABLE_SIZE                  # Bytes buffered in memory before writing a segment
+        self.LSM_COMPACTION_THRESHOLD = LSM_COMPACTION_THRESHOLD    # Similar sized segments merged together
+
+        self.CACHE_ENTRIES = CACHE_ENTRIES      # Keys whose decoded version trees are cached
+        self.CACHE_BYTES = CACHE_BYTES          # Encoded bytes of version trees the cache may hold
+
+        self.VERSION_BLOCK = VERSION_BLOCK      # Versions of a key reserved by each durable counter write
+        self.LOCK_STRIPES = LOCK_STRIPES        # Locks shared by the keys of a Storage, picked by key hash
+        self.MERKLE_DEPTH = MERKLE_DEPTH        # Merkle trees of token ranges have 2**MERKLE_DEPTH buckets
+        self.RING_HASH = RING_HASH              # Key hash of a new cluster: "md5", "blake2b" or "crc32", later changes go through Ring.setKeyHash
+
+        self.COMPRESSION_THRESHOLD = COMPRESSION_THRESHOLD              # Encoded records of this many bytes or more are zlib compressed, None disables compression
+        self.COMPRESSION_LEVEL = COMPRESSION_LEVEL                      # zlib level, 1 (fastest) to 9 (smallest)
+        self.COMPRESSION_DICTIONARY_SIZE = COMPRESSION_DICTIONARY_SIZE  # Bytes of trained preset dictionaries
+
+        self.COLD_AFTER = COLD_AFTER                # Seconds without reads or writes after which a key moves to a cold segment, None disables cold segments
+        self.COLD_INTERVAL = COLD_INTERVAL          # Seconds between moves of idle keys to cold segments
+        self.COLD_SEGMENT_KEYS = COLD_SEGMENT_KEYS  # Keys written to each cold segment
+
+        self.DEFAULT_TTL = DEFAULT_TTL                  # Seconds after its last put a key expires when the PUT gives no "ttl", None for never
+        self.TTL_SWEEP_INTERVAL = TTL_SWEEP_INTERVAL    # Seconds between sweeps for expired keys
+        self.TTL_SWEEP_RATE = TTL_SWEEP_RATE            # Keys checked per second by a sweep
+        self.TOMBSTONE_GRACE = TOMBSTONE_GRACE          # Seconds tombstones of expired keys are kept to drop late writes of older versions
+
+        self.CLOCK_MAX_ENTRIES = CLOCK_MAX_ENTRIES              # Entries a vector clock keeps, the least recently updated are dropped past it, None for no limit
+        self.DOTTED_VERSION_VECTORS = DOTTED_VERSION_VECTORS    # Coordinators tag puts with dots, so puts made in the same context become siblings instead of overwriting each other
+
+        self.PHI_THRESHOLD = PHI_THRESHOLD      # Suspicion level above which the failure detector suspects a server
+        self.PHI_WINDOW = PHI_WINDOW            # Heartbeat intervals of each server the failure detector keeps
+        self.PHI_MIN_STD = PHI_MIN_STD          # Floor of the standard deviation of heartbeat intervals, in seconds
+        self.SKIP_SUSPECTED = SKIP_SUSPECTED    # Preference lists pass over suspected servers to the next healthy ones
+
 config = Config(
     N = 3,
     R = 3,
@@ -25,4 +75,35 @@ config = Config(
     T = 5,             
     G = 1,             
     I = 30,             
+    GC_MODE = None,
+    GC_GENERATIONS = 4,
+    GC_WINDOW = None,
+    GC_INTERVAL = 60,
+    WAL_WINDOW = 0.002,
+    WAL_CHECKPOINT = 1 << 22,
+    ENGINE = "bsddb",
+    LSM_MEMTABLE_SIZE = 1 << 22,
+    LSM_COMPACTION_THRESHOLD = 4,
+    CACHE_ENTRIES = 10000,
+    CACHE_BYTES = 1 << 26,
+    VERSION_BLOCK = 1000,
+    LOCK_STRIPES = 64,
+    MERKLE_DEPTH = 10,
+    RING_HASH = "md5",
+    COMPRESSION_THRESHOLD = None,
+    COMPRESSION_LEVEL = 6,
+    COMPRESSION_DICTIONARY_SIZE = 4096,
+    COLD_AFTER = None,
+    COLD_INTERVAL = 300,
+    COLD_SEGMENT_KEYS = 1000,
+    DEFAULT_TTL = None,
+    TTL_SWEEP_INTERVAL = 60,
+    TTL_SWEEP_RATE = 1000,
+    TOMBSTONE_GRACE = 86400,
+    CLOCK_MAX_ENTRIES = None,
+    DOTTED_VERSION_VECTORS = False,
+    PHI_THRESHOLD = 8.0,
+    PHI_WINDOW = 100,
+    PHI_MIN_STD = 1.0,
+    SKIP_SUSPECTED = False,
 )
\ No newline at end of file
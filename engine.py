@@ -0,0 +1,668 @@
+import bisect
+import hashlib
+import heapq
+import os
+import pickle
+import shutil
+import sqlite3
+import struct
+import threading
+import zlib
+from typing import Iterator, Optional
+from config import config
+
+Writes = list[tuple[bytes, Optional[bytes]]]
+
+class Engine:
+    """
+    Byte-string key-value store backing a Storage or KeyVersion database.
+    Engines behave like the mapping returned by bsddb3.hashopen.
+    """
+    def __getitem__(self, key: bytes) -> bytes:
+        raise NotImplementedError
+
+    def __setitem__(self, key: bytes, value: bytes) -> None:
+        raise NotImplementedError
+
+    def __delitem__(self, key: bytes) -> None:
+        raise NotImplementedError
+
+    def __contains__(self, key: bytes) -> bool:
+        raise NotImplementedError
+
+    def keys(self) -> list[bytes]:
+        raise NotImplementedError
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self.keys())
+
+    def has_key(self, key: bytes) -> bool:
+        return key in self
+
+    def get(self, key: bytes, default: Optional[bytes] = None) -> Optional[bytes]:
+        return self[key] if key in self else default
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, Optional[bytes]]:
+        """Read several keys at once, None for the missing ones."""
+        return {key: self.get(key) for key in keys}
+
+    def write_batch(self, writes: Writes) -> None:
+        """Apply several writes, a None value deletes the key."""
+        for key, value in writes:
+            if value is not None:
+                self[key] = value
+            elif key in self:
+                del self[key]
+
+    def sync(self) -> None:
+        """Flush the writes made so far to disk."""
+        pass
+
+    def close(self) -> None:
+        pass
+
+class BsddbEngine(Engine):
+    """Berkeley DB hash file. The legacy bsddb3 wrapper keeps shared cursor state, so calls are serialized."""
+    def __init__(self, db_path: str):
+        import bsddb3
+        self.db = bsddb3.hashopen(db_path, 'w' if os.path.exists(db_path) else 'c')
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key: bytes) -> bytes:
+        with self.lock:
+            return self.db[key]
+
+    def __setitem__(self, key: bytes, value: bytes) -> None:
+        with self.lock:
+            self.db[key] = value
+
+    def __delitem__(self, key: bytes) -> None:
+        with self.lock:
+            del self.db[key]
+
+    def __contains__(self, key: bytes) -> bool:
+        with self.lock:
+            return self.db.has_key(key)
+
+    def keys(self) -> list[bytes]:
+        with self.lock:
+            return self.db.keys()
+
+    def sync(self) -> None:
+        with self.lock:
+            self.db.sync()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+class MemoryEngine(Engine):
+    """Plain dict, nothing survives the process."""
+    def __init__(self, db_path: str = None):
+        self.db: dict[bytes, bytes] = {}
+
+    def __getitem__(self, key: bytes) -> bytes:
+        return self.db[key]
+
+    def __setitem__(self, key: bytes, value: bytes) -> None:
+        self.db[key] = value
+
+    def __delitem__(self, key: bytes) -> None:
+        del self.db[key]
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self.db
+
+    def keys(self) -> list[bytes]:
+        return list(self.db.keys())
+
+class SqliteEngine(Engine):
+    """Single table in an sqlite3 database in WAL journal mode, a write batch is one transaction."""
+    MAX_PARAMS = 500    # Keys per query of get_many, below SQLITE_MAX_VARIABLE_NUMBER
+
+    def __init__(self, db_path: str):
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv (key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID")
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key: bytes) -> bytes:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: bytes, default: Optional[bytes] = None) -> Optional[bytes]:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, Optional[bytes]]:
+        values: dict[bytes, Optional[bytes]] = dict.fromkeys(keys)
+        with self.lock:
+            for i in range(0, len(keys), self.MAX_PARAMS):
+                chunk = keys[i:i + self.MAX_PARAMS]
+                query = f"SELECT key, value FROM kv WHERE key IN ({','.join('?' * len(chunk))})"
+                values.update(self.conn.execute(query, chunk).fetchall())
+        return values
+
+    def __setitem__(self, key: bytes, value: bytes) -> None:
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, value))
+
+    def __delitem__(self, key: bytes) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def __contains__(self, key: bytes) -> bool:
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM kv WHERE key = ?", (key,)).fetchone() is not None
+
+    def keys(self) -> list[bytes]:
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT key FROM kv")]
+
+    def write_batch(self, writes: Writes) -> None:
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                for key, value in writes:
+                    if value is not None:
+                        self.conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, value))
+                    else:
+                        self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                # Any interruption, KeyboardInterrupt included, must not leave the transaction open
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def sync(self) -> None:
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def close(self) -> None:
+        self.conn.close()
+
+class LogEngine(Engine):
+    """
+    Append-only record log with an in-memory index of the latest offset of every key.
+    Each record is a (key length, value length, crc32) header, the key and the value.
+    A value length of -1 is a deletion. The index is rebuilt by scanning the log on open
+    and the log is rewritten with only the live records once most of it is garbage.
+    """
+    HEADER = struct.Struct('!IiI')
+
+    def __init__(self, db_path: str):
+        self.path: str = db_path
+        self.lock = threading.Lock()
+        self.index: dict[bytes, tuple[int, int]] = {}   # key -> (value offset, value length)
+        self.garbage: int = 0                           # Bytes taken by overwritten records
+
+        self.file = open(db_path, 'a+b')
+        self._load()
+
+    def _load(self) -> None:
+        self.file.seek(0)
+        data = self.file.read()
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+            key_len, value_len, crc = self.HEADER.unpack_from(data, offset)
+            start = offset + self.HEADER.size
+            end = start + key_len + max(value_len, 0)
+            if end > len(data) or zlib.crc32(data[start:end]) != crc:
+                break   # Torn tail
+            key = data[start:start + key_len]
+            self._index(key, start + key_len, value_len)
+            offset = end
+        self.file.truncate(offset)
+
+    def _index(self, key: bytes, value_offset: int, value_len: int) -> None:
+        if key in self.index:
+            self.garbage += self.HEADER.size + len(key) + self.index[key][1]
+        if value_len < 0:
+            self.index.pop(key, None)
+            self.garbage += self.HEADER.size + len(key)
+        else:
+            self.index[key] = (value_offset, value_len)
+
+    def _append(self, buffer: bytearray, offset: int, key: bytes, value: Optional[bytes]) -> None:
+        """Add a record to a buffer that will be written at `offset` in the log."""
+        body = key + (value or b'')
+        value_len = -1 if value is None else len(value)
+        self._index(key, offset + len(buffer) + self.HEADER.size + len(key), value_len)
+        buffer += self.HEADER.pack(len(key), value_len, zlib.crc32(body))
+        buffer += body
+
+    def __getitem__(self, key: bytes) -> bytes:
+        with self.lock:
+            value_offset, value_len = self.index[key]
+            self.file.flush()
+            return os.pread(self.file.fileno(), value_len, value_offset)
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, Optional[bytes]]:
+        with self.lock:
+            self.file.flush()
+            fd = self.file.fileno()
+            return {key: os.pread(fd, self.index[key][1], self.index[key][0]) if key in self.index else None
+                    for key in keys}
+
+    def __setitem__(self, key: bytes, value: bytes) -> None:
+        self.write_batch([(key, value)])
+
+    def __delitem__(self, key: bytes) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self.write_batch([(key, None)])
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self.index
+
+    def keys(self) -> list[bytes]:
+        with self.lock:
+            return list(self.index.keys())
+
+    def write_batch(self, writes: Writes) -> None:
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            buffer = bytearray()
+            for key, value in writes:
+                if value is not None or key in self.index:
+                    self._append(buffer, offset, key, value)
+            self.file.write(buffer)
+            if self.garbage > (1 << 20) and self.garbage * 2 > self.file.tell():
+                self._rewrite()
+
+    def _rewrite(self) -> None:
+        """Replace the log with one holding only the live records."""
+        self.file.flush()
+        live = [(key, os.pread(self.file.fileno(), value_len, value_offset))
+                for key, (value_offset, value_len) in self.index.items()]
+        tmp_path = self.path + '.rewrite'
+        with open(tmp_path, 'wb') as tmp:
+            for key, value in live:
+                tmp.write(self.HEADER.pack(len(key), len(value), zlib.crc32(key + value)) + key + value)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        self.file.close()
+        os.replace(tmp_path, self.path)
+
+        self.file = open(self.path, 'a+b')
+        self.index.clear()
+        self.garbage = 0
+        self._load()
+
+    def sync(self) -> None:
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+class BloomFilter:
+    """Bit array answering "maybe present" or "surely absent" for a set of keys."""
+    def __init__(self, nbits: int, k: int, bits: bytes = None):
+        self.nbits: int = max(nbits, 8)
+        self.k: int = k
+        self.bits: bytearray = bytearray(bits) if bits else bytearray((self.nbits + 7) // 8)
+
+    @staticmethod
+    def for_keys(count: int, bits_per_key: int = 10) -> 'BloomFilter':
+        """Filter sized for `count` keys, about 1% false positives with 10 bits per key."""
+        return BloomFilter(count * bits_per_key, max(1, round(bits_per_key * 0.69)))
+
+    def _positions(self, key: bytes) -> Iterator[int]:
+        h1, h2 = struct.unpack('!QQ', hashlib.blake2b(key, digest_size=16).digest())
+        return ((h1 + i * h2) % self.nbits for i in range(self.k))
+
+    def add(self, key: bytes) -> None:
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+class Segment:
+    """
+    Immutable sorted run of records, newest value of a key only.
+    Layout: records, a metadata block (sparse index, bloom filter) and a footer with its offset.
+    A record is a (key length, value length) header with -1 as value length for a deletion.
+    """
+    RECORD = struct.Struct('!Ii')
+    FOOTER = struct.Struct('!Q8s')
+    MAGIC = b'LSMSEG01'
+    INDEX_INTERVAL = 16     # Records between sparse index entries
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self.name: str = os.path.basename(path)
+        first, last = self.name[:-len('.seg')].split('-')
+        self.seqs: tuple[int, int] = (int(first), int(last))   # Flushes merged into this segment
+        self.size: int = os.path.getsize(path)
+
+        self.fd: int = os.open(path, os.O_RDONLY)
+        self.meta_offset, magic = self.FOOTER.unpack(os.pread(self.fd, self.FOOTER.size, self.size - self.FOOTER.size))
+        if magic != self.MAGIC:
+            raise ValueError(f"Not a segment file: {path}")
+        meta = pickle.loads(os.pread(self.fd, self.size - self.FOOTER.size - self.meta_offset, self.meta_offset))
+        self.index: list[tuple[bytes, int]] = meta["index"]
+        self.index_keys: list[bytes] = [key for key, _ in self.index]
+        self.bloom = BloomFilter(*meta["bloom"])
+        self.count: int = meta["count"]
+
+    def __del__(self):
+        os.close(self.fd)
+
+    @classmethod
+    def write(cls, path: str, items: Iterator[tuple[bytes, Optional[bytes]]], count: int) -> None:
+        """Write sorted (key, value) items, a None value being a deletion, atomically to path."""
+        index: list[tuple[bytes, int]] = []
+        bloom = BloomFilter.for_keys(count)
+        written = 0
+        with open(path + '.tmp', 'wb') as file:
+            for key, value in items:
+                if written % cls.INDEX_INTERVAL == 0:
+                    index.append((key, file.tell()))
+                bloom.add(key)
+                file.write(cls.RECORD.pack(len(key), -1 if value is None else len(value)) + key + (value or b''))
+                written += 1
+            meta_offset = file.tell()
+            file.write(pickle.dumps({"index": index, "bloom": (bloom.nbits, bloom.k, bytes(bloom.bits)), "count": written}))
+            file.write(cls.FOOTER.pack(meta_offset, cls.MAGIC))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _block(self, i: int) -> Iterator[tuple[bytes, Optional[bytes]]]:
+        start = self.index[i][1]
+        end = self.index[i + 1][1] if i + 1 < len(self.index) else self.meta_offset
+        data = os.pread(self.fd, end - start, start)
+        offset = 0
+        while offset < len(data):
+            key_len, value_len = self.RECORD.unpack_from(data, offset)
+            offset += self.RECORD.size
+            key = data[offset:offset + key_len]
+            offset += key_len
+            if value_len < 0:
+                yield key, None
+            else:
+                yield key, data[offset:offset + value_len]
+                offset += value_len
+
+    def get(self, key: bytes) -> tuple[bool, Optional[bytes]]:
+        """(found, value), a found None value is a deletion."""
+        i = bisect.bisect_right(self.index_keys, key) - 1
+        if i < 0:
+            return False, None
+        for record_key, value in self._block(i):
+            if record_key == key:
+                return True, value
+            if record_key > key:
+                break
+        return False, None
+
+    def items(self, start: Optional[bytes] = None) -> Iterator[tuple[bytes, Optional[bytes]]]:
+        """Records in key order from `start` on, deletions included."""
+        first = max(bisect.bisect_right(self.index_keys, start) - 1, 0) if start is not None else 0
+        for i in range(first, len(self.index)):
+            for key, value in self._block(i):
+                if start is None or key >= start:
+                    yield key, value
+
+class LsmEngine(Engine):
+    """
+    Log-structured merge tree in a directory.
+    Writes go to a sorted in-memory memtable, journaled to memtable.log, which is written out as
+    an immutable segment file once it holds config.LSM_MEMTABLE_SIZE bytes. Lookups go from the
+    memtable to the newest segment, skipping segments whose bloom filter rules the key out.
+    A background thread merges runs of config.LSM_COMPACTION_THRESHOLD similar sized segments
+    (size-tiered compaction). Segment files are named after the range of flushes they hold.
+    """
+    JOURNAL = struct.Struct('!Ii')
+
+    def __init__(self, db_path: str):
+        self.path: str = db_path
+        os.makedirs(db_path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.cv = threading.Condition(self.lock)
+        self.compacting = threading.Lock()  # One compaction at a time
+        self.closed: bool = False
+
+        self.segments: list[Segment] = self._load_segments()    # Newest first
+        self.seq: int = max((segment.seqs[1] for segment in self.segments), default=0)
+
+        self.memtable: dict[bytes, Optional[bytes]] = {}
+        self.memtable_size: int = 0
+        self._replay_journal()
+
+        # Metrics
+        self.bloom_skips: int = 0
+        self.compactions: int = 0
+
+        self.compactThread = threading.Thread(target=self._compaction_loop, daemon=True)
+        self.compactThread.start()
+
+    def _load_segments(self) -> list[Segment]:
+        segments = []
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(self.path, name))
+            elif name.endswith('.seg'):
+                segments.append(Segment(os.path.join(self.path, name)))
+
+        # Inputs of a compaction that was interrupted before they were deleted
+        covered = [segment for segment in segments if any(
+            other is not segment and other.seqs[0] <= segment.seqs[0] and segment.seqs[1] <= other.seqs[1]
+            and other.seqs != segment.seqs for other in segments)]
+        for segment in covered:
+            os.remove(segment.path)
+        return sorted((segment for segment in segments if segment not in covered),
+                      key=lambda segment: segment.seqs[1], reverse=True)
+
+    def _replay_journal(self) -> None:
+        journal_path = os.path.join(self.path, 'memtable.log')
+        data = open(journal_path, 'rb').read() if os.path.exists(journal_path) else b''
+        offset = 0
+        while offset + self.JOURNAL.size <= len(data):
+            key_len, value_len = self.JOURNAL.unpack_from(data, offset)
+            end = offset + self.JOURNAL.size + key_len + max(value_len, 0)
+            if end > len(data):
+                break   # Torn tail
+            key = data[offset + self.JOURNAL.size: offset + self.JOURNAL.size + key_len]
+            self._put(key, None if value_len < 0 else data[offset + self.JOURNAL.size + key_len: end])
+            offset = end
+        self.journal = open(journal_path, 'ab')
+        self.journal.truncate(offset)
+
+    def _put(self, key: bytes, value: Optional[bytes]) -> None:
+        old = self.memtable.get(key)
+        self.memtable_size += len(value or b'') - len(old or b'') + (0 if key in self.memtable else len(key))
+        self.memtable[key] = value
+
+    def _lookup(self, key: bytes) -> tuple[bool, Optional[bytes]]:
+        with self.lock:
+            if key in self.memtable:
+                return True, self.memtable[key]
+            segments = self.segments
+        for segment in segments:
+            if key not in segment.bloom:
+                self.bloom_skips += 1
+                continue
+            found, value = segment.get(key)
+            if found:
+                return True, value
+        return False, None
+
+    def __getitem__(self, key: bytes) -> bytes:
+        found, value = self._lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: bytes, default: Optional[bytes] = None) -> Optional[bytes]:
+        found, value = self._lookup(key)
+        return value if value is not None else default
+
+    def __contains__(self, key: bytes) -> bool:
+        return self._lookup(key)[1] is not None
+
+    def __setitem__(self, key: bytes, value: bytes) -> None:
+        self.write_batch([(key, value)])
+
+    def __delitem__(self, key: bytes) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self.write_batch([(key, None)])
+
+    def write_batch(self, writes: Writes) -> None:
+        with self.lock:
+            self.journal.write(b''.join(
+                self.JOURNAL.pack(len(key), -1 if value is None else len(value)) + key + (value or b'')
+                for key, value in writes))
+            for key, value in writes:
+                self._put(key, value)
+            if self.memtable_size >= config.LSM_MEMTABLE_SIZE:
+                self._flush()
+
+    def _flush(self) -> None:
+        """Write the memtable out as the newest segment, called holding self.lock."""
+        if not self.memtable:
+            return
+        self.seq += 1
+        path = os.path.join(self.path, f"{self.seq:010d}-{self.seq:010d}.seg")
+        Segment.write(path, iter(sorted(self.memtable.items())), len(self.memtable))
+        self.segments = [Segment(path)] + self.segments
+        self.memtable = {}
+        self.memtable_size = 0
+        self.journal.truncate(0)
+        self.cv.notify_all()
+
+    def items(self, start: Optional[bytes] = None, end: Optional[bytes] = None) -> Iterator[tuple[bytes, bytes]]:
+        """Live (key, value) pairs with start <= key < end in key order, read lazily."""
+        with self.lock:
+            memtable = sorted((key, value) for key, value in self.memtable.items()
+                              if (start is None or key >= start) and (end is None or key < end))
+            segments = self.segments
+        yield from self._merge([iter(memtable)] + [segment.items(start) for segment in segments], end, True)
+
+    @staticmethod
+    def _merge(runs: list[Iterator[tuple[bytes, Optional[bytes]]]], end: Optional[bytes],
+               drop_deletions: bool) -> Iterator[tuple[bytes, Optional[bytes]]]:
+        """Merge runs given newest first, keeping the newest record of every key."""
+        def tagged(age: int, run: Iterator[tuple[bytes, Optional[bytes]]]):
+            for key, value in run:
+                yield key, age, value
+
+        last = None
+        for key, _, value in heapq.merge(*(tagged(age, run) for age, run in enumerate(runs))):
+            if end is not None and key >= end:
+                break
+            if key == last:
+                continue
+            last = key
+            if value is not None or not drop_deletions:
+                yield key, value
+
+    def keys(self) -> list[bytes]:
+        return [key for key, _ in self.items()]
+
+    def _pick_compaction(self) -> Optional[list[Segment]]:
+        """Longest run of consecutive segments of similar size, if long enough to merge."""
+        best: list[Segment] = []
+        run: list[Segment] = []
+        for segment in self.segments:
+            average = sum(other.size for other in run) / len(run) if run else segment.size
+            if run and not (average / 2 <= segment.size <= average * 2):
+                run = []
+            run.append(segment)
+            if len(run) > len(best):
+                best = list(run)
+        return best if len(best) >= config.LSM_COMPACTION_THRESHOLD else None
+
+    def _compaction_loop(self) -> None: # Thread
+        while True:
+            with self.lock:
+                while self._pick_compaction() is None and not self.closed:
+                    self.cv.wait()
+                if self.closed:
+                    return
+            with self.compacting:
+                with self.lock:
+                    run = self._pick_compaction()
+                    # Deletions can only be dropped when nothing older could still hold the key
+                    oldest = run is not None and run[-1] is self.segments[-1]
+                if run is not None:
+                    self._compact(run, oldest)
+
+    def _compact(self, run: list[Segment], drop_deletions: bool) -> None:
+        seqs = (run[-1].seqs[0], run[0].seqs[1])
+        path = os.path.join(self.path, f"{seqs[0]:010d}-{seqs[1]:010d}.seg")
+        count = sum(segment.count for segment in run)
+        Segment.write(path, self._merge([segment.items() for segment in run], None, drop_deletions), count)
+        merged = Segment(path)
+
+        with self.lock:
+            first = self.segments.index(run[0])
+            self.segments = self.segments[:first] + [merged] + self.segments[first + len(run):]
+            self.compactions += 1
+        for segment in run:
+            os.remove(segment.path)
+
+    def compact(self) -> None:
+        """Merge every segment into one, dropping deletions."""
+        with self.compacting:
+            with self.lock:
+                self._flush()
+                run = list(self.segments)
+            if len(run) > 1:
+                self._compact(run, True)
+
+    def sync(self) -> None:
+        with self.lock:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.sync()
+        with self.lock:
+            self.closed = True
+            self.cv.notify_all()
+        self.compactThread.join()
+        self.journal.close()
+
+ENGINES: dict[str, type[Engine]] = {
+    "bsddb": BsddbEngine,
+    "memory": MemoryEngine,
+    "sqlite": SqliteEngine,
+    "log": LogEngine,
+    "lsm": LsmEngine,
+}
+
+def open_engine(db_path: str, engine: Optional[str] = None) -> Engine:
+    """Open the database at db_path with the given engine, config.ENGINE by default."""
+    if os.path.exists(db_path):
+        # Load the existing database
+        print(f"Loading existing database at {db_path}.")
+    else:
+        # Create a new database
+        print(f"Database not found at {db_path}. Creating a new one.")
+    return ENGINES[engine or config.ENGINE](db_path)
+
+def remove_database(db_path: str) -> None:
+    """Delete the files of a database, whatever the engine that made them."""
+    if os.path.isdir(db_path):
+        shutil.rmtree(db_path)
+    elif os.path.exists(db_path):
+        os.remove(db_path)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    if os.path.isdir(db_path + '.cold'):
+        shutil.rmtree(db_path + '.cold')     # Cold segments of a Storage
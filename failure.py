@@ -0,0 +1,61 @@
+import math
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+class PhiAccrualDetector:
+    """
+    Phi-accrual failure detector (Hayashibara et al.): instead of a yes/no verdict, each peer gets
+    a suspicion level phi = -log10(P(a heartbeat comes later than now)), where the intervals between
+    its past heartbeats are taken as normally distributed. phi 1 means a 10% chance of the peer
+    still being alive given the silence so far, phi 8 a chance of one in 10**8.
+    Any message from a peer is a heartbeat: gossip as well as request traffic.
+    """
+    def __init__(self, threshold: float, window: int = 100, min_std: float = 1.0, first_interval: float = 30.0):
+        self.threshold: float = threshold           # Peers whose phi is above it are suspected
+        self.window: int = window                   # Intervals kept per peer
+        self.min_std: float = min_std               # Floor of the standard deviation of the intervals, in seconds
+        self.first_interval: float = first_interval # Expected interval of peers heard from once
+        self.lock = threading.Lock()
+        self.last: dict[str, float] = {}            # Time of the last heartbeat of each peer
+        self.intervals: dict[str, deque[float]] = {}
+
+    def heartbeat(self, peer: str, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        with self.lock:
+            last = self.last.get(peer)
+            if last is None:
+                self.intervals[peer] = deque([self.first_interval], maxlen=self.window)
+            elif now > last:
+                self.intervals[peer].append(now - last)
+            self.last[peer] = max(now, last or now)
+
+    def phi(self, peer: str, now: Optional[float] = None) -> float:
+        """Suspicion level of a peer, 0 for peers never heard from."""
+        now = time.time() if now is None else now
+        with self.lock:
+            last = self.last.get(peer)
+            if last is None:
+                return 0.0
+            intervals = self.intervals[peer]
+            mean = sum(intervals) / len(intervals)
+            std = max(math.sqrt(sum((interval - mean) ** 2 for interval in intervals) / len(intervals)), self.min_std)
+        later = 0.5 * math.erfc((now - last - mean) / (std * math.sqrt(2)))
+        return -math.log10(later) if later > 0 else math.inf
+
+    def levels(self, now: Optional[float] = None) -> dict[str, float]:
+        """Suspicion level of every peer heard from."""
+        with self.lock:
+            peers = list(self.last)
+        return {peer: self.phi(peer, now) for peer in peers}
+
+    def suspects(self, now: Optional[float] = None) -> set[str]:
+        """Peers whose suspicion level is above the threshold."""
+        return {peer for peer, phi in self.levels(now).items() if phi > self.threshold}
+
+    def forget(self, peer: str) -> None:
+        """Stop following a peer, such as a server that left the ring."""
+        with self.lock:
+            self.last.pop(peer, None)
+            self.intervals.pop(peer, None)
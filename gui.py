@@ -51,8 +51,9 @@ class ServerGUI():
     
     def updateRing(self, ring: Ring):
         self.ringList.delete(0, tk.END)
-        for i in range(len(ring.state)):
-            v = ring.state[i]
+        snapshot = ring.snapshot
+        for i in range(len(snapshot.nodes)):
+            v = snapshot.nodes[i]
             if v.server == ring.serverName:
                 self.ringList.insert(i, "{0:20} {1}".format(v.server+"*", v.pos))
             else:
@@ -60,7 +61,7 @@ class ServerGUI():
         
         self.versionList.delete(0, tk.END)
         i = 0
-        for s, v in ring.versions.items():
+        for s, v in snapshot.versions.items():
             if s==ring.serverName:
                 self.versionList.insert(i, "{0:20} {1}".format(s+"*", v))
             else:
@@ -0,0 +1,100 @@
+import bisect
+import hashlib
+import threading
+from typing import Optional
+from config import config
+
+DIGEST_SIZE: int = 16
+
+def ring_size() -> int:
+    """Number of positions on the ring, virtual nodes sit anywhere in [0, config.Q]."""
+    return config.Q + 1
+
+def in_range(token: int, start: int, end: int) -> bool:
+    """Whether a token falls in (start, end], wrapping around the ring when start >= end."""
+    if start < end:
+        return start < token <= end
+    return token > start or token <= end
+
+class MerkleTree:
+    """
+    Merkle tree over the keys of a token range (start, end].
+    The range is cut into 2**depth buckets by token. A bucket hashes to the XOR of the digests of
+    its keys, so a key is updated without reading the others, and an inner node to the hash of its
+    two children. Hashes are kept in an array in heap order with the root at 1, so any node is a
+    single lookup and a key update rehashes the depth nodes above its bucket.
+    """
+    def __init__(self, start: int, end: int, depth: int):
+        self.start: int = start
+        self.end: int = end
+        self.depth: int = depth
+        self.buckets: int = 1 << depth
+        self.span: int = (end - start) % ring_size() or ring_size()
+        self.digests: dict[bytes, int] = {}     # Digest of every key in the range
+        self.lock = threading.Lock()
+
+        self.hashes: list[bytes] = [bytes(DIGEST_SIZE)] * (2 * self.buckets)
+        for i in range(self.buckets - 1, 0, -1):
+            self.hashes[i] = self._combine(self.hashes[2 * i], self.hashes[2 * i + 1])
+
+    @staticmethod
+    def _combine(left: bytes, right: bytes) -> bytes:
+        return hashlib.blake2b(left + right, digest_size=DIGEST_SIZE).digest()
+
+    def bucket(self, token: int) -> int:
+        return ((token - self.start - 1) % ring_size()) * self.buckets // self.span
+
+    def set(self, key_bytes: bytes, token: int, digest: Optional[int]) -> None:
+        """Set the digest of a key, None removes the key."""
+        with self.lock:
+            old = self.digests.pop(key_bytes, 0)
+            if digest:
+                self.digests[key_bytes] = digest
+            if old == (digest or 0):
+                return
+            i = self.buckets + self.bucket(token)
+            bucket = int.from_bytes(self.hashes[i], 'big') ^ old ^ (digest or 0)
+            self.hashes[i] = bucket.to_bytes(DIGEST_SIZE, 'big')
+            i //= 2
+            while i:
+                self.hashes[i] = self._combine(self.hashes[2 * i], self.hashes[2 * i + 1])
+                i //= 2
+
+    def node(self, level: int, index: int) -> bytes:
+        """Hash of the index-th subtree at a level, level 0 is the root and level depth the buckets."""
+        return self.hashes[(1 << level) + index]
+
+    def root(self) -> bytes:
+        return self.node(0, 0)
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+class MerkleRanges:
+    """Merkle trees of a set of disjoint token ranges, swapped as a whole when the ranges change."""
+    def __init__(self):
+        self.trees: dict[tuple[int, int], MerkleTree] = {}
+        self.index: tuple[list[int], list[MerkleTree]] = ([], [])    # Range ends and trees, by end
+
+    def tree_for(self, token: int) -> Optional[MerkleTree]:
+        """Tree of the range holding a token, if any."""
+        ends, ordered = self.index
+        if not ordered:
+            return None
+        # The first range ending at or after the token, or the one wrapping around the ring
+        tree = ordered[bisect.bisect_left(ends, token) % len(ordered)]
+        return tree if in_range(token, tree.start, tree.end) else None
+
+    def replace(self, ranges: list[tuple[int, int]], depth: int) -> list[MerkleTree]:
+        """Keep the trees of the given ranges only, returns the new, still empty, trees."""
+        trees = {}
+        created = []
+        for token_range in ranges:
+            tree = self.trees.get(token_range)
+            if tree is None or tree.depth != depth:
+                tree = MerkleTree(*token_range, depth)
+                created.append(tree)
+            trees[token_range] = tree
+        ordered = sorted(trees.values(), key=lambda tree: tree.end)
+        self.trees, self.index = trees, ([tree.end for tree in ordered], ordered)
+        return created
@@ -16,8 +16,9 @@ class MessageType(IntEnum):
     PUT_KEY = 5 # From WRITE_COORDINATOR to Node
     PUT_ACK = 6
 
-    GOSSIP_REQ = 7
-    GOSSIP_RES = 8
+    GOSSIP_REQ = 7      # Versions of the ring of the sender
+    GOSSIP_RES = 8      # Tokens of the servers the sender knows newer versions of, and the servers it wants
+    GOSSIP_DELTA = 11   # Tokens of the servers wanted by the GOSSIP_RES
 
     HR_REQ = 9
     HR_RES = 10
@@ -1,12 +1,13 @@
 import threading
 
 from message import MessageType, Message
-from typing import Any
+from typing import Any, Optional
 from config import config
 from storage import VectorClock, VersionedValue
 
 class Operation:
-    def __init__(self, thread: threading.Thread, msg: Message, isCord: bool, res: set[VersionedValue] = set(), value: VersionedValue = None):
+    def __init__(self, thread: threading.Thread, msg: Message, isCord: bool, res: set[VersionedValue] = set(), value: VersionedValue = None,
+                 expires: Optional[float] = None):
         # threading
         self.thread: threading.Thread = thread
         self.cv: threading.Condition = threading.Condition()
@@ -19,6 +20,8 @@ class Operation:
         self.type: MessageType = msg.msg_type
         self.isCord: bool = isCord
         self.value: VersionedValue = value
+        self.expires: Optional[float] = expires     # Time at which a put key expires, the same on every replica
+        self.prefList: list[str] = []               # Preference list of the key when the request came in
 
         # To maintain the responses
         self.acks: int = 0
@@ -63,7 +66,9 @@ class Operation:
     
     def response_msg(self, server_name: str, destination: str) -> Message:
         """Make response message for the Preference List nodes."""
-        response = {"key":self.key, "value": self.value.value, "context":self.value.vector_clock.to_dict()} if self.type == MessageType.PUT else {"key":self.key}
+        response = {"key":self.key, "value": self.value.value, "context":self.value.vector_clock.to_dict(stamps=True, dot=False), "expires": self.expires} if self.type == MessageType.PUT else {"key":self.key}
+        if self.type == MessageType.PUT and self.value.vector_clock.dot is not None:
+            response["dot"] = self.value.vector_clock.get_dot()
         msg_type = MessageType.GET_KEY if self.type == MessageType.GET else MessageType.PUT_KEY
         
         return Message(self.id, msg_type, server_name, destination, response)
@@ -71,13 +76,19 @@ class Operation:
     def serialize_res(self, set: set[VersionedValue]) -> list[list]:
         """Make GET RESPONSES serializable.
         list[ list[value], list[vector_clocks] ]
+        With dotted version vectors the siblings share one clock, the context that covers them all.
         """
         serialized = []
         value = []
         vector_clocks = []
         for versioned_value in set:
             value.append(versioned_value.value)
-            vector_clocks.append(versioned_value.vector_clock.to_dict())
+            vector_clocks.append(versioned_value.vector_clock.to_dict(stamps=True))
+        if config.DOTTED_VERSION_VECTORS and len(set) > 1:
+            context = VectorClock()
+            for versioned_value in set:
+                context.merge(versioned_value.vector_clock)
+            vector_clocks = [context.to_dict(stamps=True)]
 
         serialized.append(value)
         serialized.append(vector_clocks)
@@ -86,6 +97,6 @@ class Operation:
     def reply_msg(self, server_name: str) -> Message:
         """Make reply message for the source nodes."""
         res = self.serialize_res(self.resList) if self.resList else None
-        response = {"key":self.key, "res": res} if self.type == MessageType.GET else {"key":self.key, "context":[self.value.vector_clock.to_dict()]}
+        response = {"key":self.key, "res": res} if self.type == MessageType.GET else {"key":self.key, "context":[self.value.vector_clock.to_dict(stamps=True)]}
         msg_type = MessageType.GET_RES if self.type == MessageType.GET else MessageType.PUT_ACK
         return Message(self.id, msg_type, server_name, self.source, response)
\ No newline at end of file
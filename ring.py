@@ -1,13 +1,41 @@
+import bisect
 import random
+from array import array
 from threading import Lock
 import hashlib
-from sortedcontainers import SortedSet
+import zlib
 from config import config
 import json
+from typing import Optional
 
 class VirtualNode: pass
 class Ring: pass
 
+def md5_hash(data: bytes) -> int:
+    return int.from_bytes(hashlib.md5(data).digest(), 'big')
+
+def blake2b_hash(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+def crc32_hash(data: bytes) -> int:
+    return zlib.crc32(data)
+
+# Key hash functions of the ring, by name. md5 puts keys where they were before hashes were pluggable
+HASHES = {"md5": md5_hash, "blake2b": blake2b_hash, "crc32": crc32_hash}
+
+# Ring of the server of this process, whose current snapshot sets the key hash of key_token
+keyRing: Optional[Ring] = None
+
+def key_token(key: str) -> int:
+    """Position of a key on the ring."""
+    ring = keyRing
+    return HASHES[ring.snapshot.keyHash[1] if ring is not None else config.RING_HASH](key.encode()) % config.Q
+
+def use_ring(ring: Optional[Ring]) -> None:
+    """Hash keys the way a ring does, from then on following its key hash setting."""
+    global keyRing
+    keyRing = ring
+
 class VirtualNode:
     def __init__(self, server: str, pos=None):
         self.server: str = server
@@ -31,121 +59,271 @@ class VirtualNode:
     def __repr__(self):
         return str((self.server, self.pos))
 
+class RingSnapshot:
+    """
+    Immutable state of a ring: its virtual nodes in token order, the token positions, the server
+    and the preference list of the range ending at each, the server versions, known servers, key
+    hash setting and whether it is sealed. A snapshot is never changed once published: updates build the next one and
+    swap it in with a single reference assignment, so readers use one snapshot with no lock and
+    never see half of an update.
+    """
+    __slots__ = ('nodes', 'positions', 'owners', 'prefLists', 'versions', 'serverSet', 'keyHash', 'sealed')
+
+    def __init__(self, nodes, versions, serverSet, keyHash, tables=None, sealed=False):
+        self.nodes: tuple[VirtualNode, ...] = tuple(nodes)
+        self.versions: dict[str, int] = versions        # Not to be mutated, copied by updates
+        self.serverSet: frozenset[str] = frozenset(serverSet)
+        self.keyHash: tuple[int, str] = keyHash
+        self.sealed: bool = sealed      # Some server holds data placed with the key hash, which can no longer change
+        if tables is None:
+            owners = tuple(node.server for node in self.nodes)
+            tables = (array('q', (node.pos for node in self.nodes)), owners,
+                      tuple(self._prefList(owners, i) for i in range(len(owners))))
+        positions, owners, prefLists = tables
+        self.positions: array = positions                           # Token position of each node
+        self.owners: tuple[str, ...] = owners                       # Server of each node
+        self.prefLists: tuple[tuple[str, ...], ...] = prefLists     # Preference list of the range ending at each node
+
+    def evolve(self, nodes=None, versions=None, serverSet=None, keyHash=None, sealed=None) -> 'RingSnapshot':
+        """A new snapshot with some fields replaced, sharing the tables of this one if `nodes` is None."""
+        return RingSnapshot(self.nodes if nodes is None else sorted(nodes, key=lambda node: (node.pos, node.server)),
+                            self.versions if versions is None else versions,
+                            self.serverSet if serverSet is None else serverSet,
+                            self.keyHash if keyHash is None else keyHash,
+                            (self.positions, self.owners, self.prefLists) if nodes is None else None,
+                            self.sealed if sealed is None else sealed)
+
+    @staticmethod
+    def _prefList(owners: tuple[str, ...], coord: int) -> tuple[str, ...]:
+        """Servers of the N virtual nodes from the coordinator on, each once."""
+        totalTokens = len(owners)
+        uniqueNodes = set()
+        prefList = []
+        i = 0
+        while len(prefList) < config.N:
+            server = owners[(coord+i) % totalTokens]
+            if server not in uniqueNodes:
+                uniqueNodes.add(server)
+                prefList.append(server)
+            i += 1
+            # if i loops over, break
+            if i > config.N:
+                break
+        return tuple(prefList)
+
+    def getPrefListByToken(self, hash: int, skip=None) -> list[str]:
+        positions = self.positions
+        if not positions:
+            return []
+        coord = bisect.bisect_left(positions, hash)
+        coord = coord if coord < len(positions) else 0
+        prefList = self.prefLists[coord]
+        if not skip or not any(server in skip for server in prefList):
+            return list(prefList)
+
+        owners = self.owners
+        prefList = []
+        for i in range(len(owners)):
+            server = owners[(coord + i) % len(owners)]
+            if server not in skip and server not in prefList:
+                prefList.append(server)
+                if len(prefList) == config.N:
+                    break
+        return prefList
+
 class Ring:
-    def __init__(self, state, versions=None):
-        self.state: SortedSet[VirtualNode] = SortedSet(state)
+    def __init__(self, state, versions=None, keyHash=None, sealed=False):
         self.serverName: str
-        self.serverSet: set[str] = set()
-        self.versions: dict[str, int] = versions
+        self.lock = Lock()      # Serializes updates, reads go to the published snapshot without it
+        # Version -1: the key hash setting is unset until the ring learns the cluster's, or founds the cluster
+        self.snapshot: RingSnapshot = RingSnapshot(sorted(set(state)), versions, (),
+                                                   tuple(keyHash) if keyHash else (-1, config.RING_HASH), sealed=sealed)
+        self.sizeOf: tuple = (None, 0)     # (snapshot, serialized size) of the last serializedSize call
+
+    # Fields of the current snapshot, each read on its own: read self.snapshot once to use several together
+    @property
+    def state(self) -> tuple[VirtualNode, ...]:
+        return self.snapshot.nodes
+
+    @property
+    def versions(self) -> dict[str, int]:
+        return self.snapshot.versions
+
+    @versions.setter
+    def versions(self, versions: dict[str, int]):
+        with self.lock:
+            self.snapshot = self.snapshot.evolve(versions=dict(versions))
+
+    @property
+    def serverSet(self) -> frozenset[str]:
+        return self.snapshot.serverSet
+
+    @property
+    def keyHash(self) -> tuple[int, str]:
+        return self.snapshot.keyHash
+
+    @property
+    def sealed(self) -> bool:
+        return self.snapshot.sealed
 
     def __repr__(self):
+        snapshot = self.snapshot
         return str({
-            'state': [str(node) for node in self.state],
-            'versions': self.versions
+            'state': [str(node) for node in snapshot.nodes],
+            'versions': snapshot.versions,
+            'keyHash': snapshot.keyHash
             })
         
     def merge(self, ring: Ring):
-        updatedServers = set()
-        addedNodes = set()
-        deletedNodes = set()
+        return self.mergeDelta(ring.delta(ring.versions), ring.keyHash, ring.sealed)
 
-        for s, v in ring.versions.items():
-            if self.versions.get(s) is None or self.versions[s] < v:
-                updatedServers.add(s)
-        
-        if not updatedServers: return set(), set()
-        
-        for node in self.state:
-            if node.server not in updatedServers:
-                continue
-            node: VirtualNode
-            if node not in ring.state:
-                self.state.remove(node)
-                deletedNodes.add(node)
-        
-        for node in ring.state:
-            if node.server not in updatedServers:
-                continue
-            node: VirtualNode
-            if node not in self.state:
-                self.state.add(node)
-                addedNodes.add(node)
+    def newerThan(self, versions: dict[str, int]) -> list[str]:
+        """Servers whose tokens this ring knows at a newer version than the given ones."""
+        return [s for s, v in self.versions.items() if versions.get(s) is None or versions[s] < v]
+
+    def olderThan(self, versions: dict[str, int]) -> list[str]:
+        """Servers whose tokens the given versions are newer for."""
+        mine = self.versions
+        return [s for s, v in versions.items() if mine.get(s) is None or mine[s] < v]
+
+    def delta(self, servers) -> dict[str, list]:
+        """{server: [version, token positions]} of some servers, all that gossip needs to update them."""
+        snapshot = self.snapshot
+        delta = {s: [snapshot.versions[s], []] for s in servers if s in snapshot.versions}
+        for node in snapshot.nodes:
+            if node.server in delta:
+                delta[node.server][1].append(node.pos)
+        return delta
 
-        for server in updatedServers:
-            self.versions[server] = ring.versions[server]
+    def mergeDelta(self, delta: dict[str, list], keyHash=None, sealed=False):
+        """Take the tokens of the servers of a delta newer than ours, returns the added and deleted virtual nodes."""
+        with self.lock:
+            snapshot = self.snapshot
+            keyHash = tuple(keyHash) if keyHash is not None and keyHash[0] >= 0 else snapshot.keyHash
+            keyHash = max(snapshot.keyHash, keyHash)
+            sealed = snapshot.sealed or bool(sealed)
 
-        self.serverSet = self.serverSet.union(updatedServers)
+            updatedServers = {s: v for s, (v, _) in delta.items() if snapshot.versions.get(s) is None or snapshot.versions[s] < v}
+            if not updatedServers:
+                if keyHash != snapshot.keyHash or sealed != snapshot.sealed:
+                    self.snapshot = snapshot.evolve(keyHash=keyHash, sealed=sealed)
+                return set(), set()
 
+            current = set(snapshot.nodes)
+            incoming = {VirtualNode(s, pos) for s in updatedServers for pos in delta[s][1]}
+            deletedNodes = {node for node in current if node.server in updatedServers and node not in incoming}
+            addedNodes = incoming - current
+            versions = dict(snapshot.versions)
+            versions.update(updatedServers)
+
+            self.snapshot = snapshot.evolve(nodes=(current - deletedNodes) | addedNodes if addedNodes or deletedNodes else None,
+                                            versions=versions, serverSet=snapshot.serverSet.union(updatedServers),
+                                            keyHash=keyHash, sealed=sealed)
         return addedNodes, deletedNodes
 
-    def serialize(self):
+    def serializedSize(self) -> int:
+        """Bytes of the whole serialized ring, as gossip sent it every round before deltas."""
+        snapshot = self.snapshot
+        if self.sizeOf[0] is not snapshot:
+            self.sizeOf = (snapshot, len(json.dumps({'ring': self.serialize(snapshot)})))
+        return self.sizeOf[1]
+
+    def serialize(self, snapshot: RingSnapshot = None):
+        snapshot = snapshot or self.snapshot
         return ({
-            'state': [[vNode.server, vNode.pos] for vNode in self.state],
-            'versions': self.versions
+            'state': [[vNode.server, vNode.pos] for vNode in snapshot.nodes],
+            'versions': snapshot.versions,
+            'keyHash': list(snapshot.keyHash),
+            'sealed': snapshot.sealed
             })
 
     @staticmethod
     def deserialize(dic):
         state = [VirtualNode(server, pos) for server, pos in dic['state']]
         version = dic['versions']
-        return Ring(state, version)
+        return Ring(state, version, dic.get('keyHash'), dic.get('sealed', False))
 
     
     def init(self, serverName, numTokens, seeds):
         self.serverName = serverName
-        self.serverSet = set(seeds)
-        self.serverSet.discard(serverName)
-        if self.versions is None:
-            self.versions = {self.serverName: 1}
-        for _ in range(numTokens):
-            self.state.add(VirtualNode(serverName))
+        with self.lock:
+            snapshot = self.snapshot
+            versions = snapshot.versions if snapshot.versions is not None else {self.serverName: 1}
+            nodes = set(snapshot.nodes).union(VirtualNode(serverName) for _ in range(numTokens))
+            serverSet = set(seeds) - {serverName}
+            # Seeds found the cluster and set its key hash from their config, servers joining take the cluster's
+            founder = serverName in seeds or not serverSet
+            keyHash = (0, snapshot.keyHash[1]) if founder and snapshot.keyHash[0] < 0 else None
+            self.snapshot = snapshot.evolve(nodes=nodes, versions=versions, serverSet=serverSet, keyHash=keyHash)
 
     def load(self, dic):
-        self.state = SortedSet([VirtualNode(server, pos) for server, pos in dic['state']])
-        self.versions = dic['versions']
-        for s in self.state:
-            self.serverSet.add(s.server)
-
-    def _hash(self, key: str):
-        md5 = hashlib.md5(key.encode())
-        return int(md5.hexdigest(), 16) % config.Q
-
-    def check_key(self, key: int):
-        return self.serverName in set(self.getPrefList(str(key)))    
-
-    def getPrefList(self, key: str) -> list[str]:
-        totalTokens = len(self.state)
-        hash = self._hash(key)
-
-        coord = 0
-        for i in range(totalTokens):
-            if self.state[i].pos >= hash:
-                coord = i
-                break
-        
-        uniqueNodes = set()
-        prefList = []
-        i = 0
-        while len(prefList) < config.N:
-            idx = (coord+i) % totalTokens
-            v = self.state[idx]
-            if v.server not in uniqueNodes:
-                uniqueNodes.add(v.server)
-                prefList.append(idx)
-            i += 1
-            # if i loops over, break
-            if i > config.N:
-                break
-        
-        return [self.state[v].server for v in prefList]
+        with self.lock:
+            snapshot = self.snapshot
+            nodes = {VirtualNode(server, pos) for server, pos in dic['state']}
+            self.snapshot = snapshot.evolve(nodes=nodes, versions=dict(dic['versions']),
+                                            serverSet=snapshot.serverSet.union(node.server for node in nodes),
+                                            keyHash=tuple(dic['keyHash']) if dic.get('keyHash') else None,
+                                            sealed=snapshot.sealed or dic.get('sealed', False))
+
+    def setKeyHash(self, name: str):
+        """
+        Switch the cluster to another key hash function, gossip spreads it to every server.
+        Refused once the ring is sealed: keys are not migrated, data placed with the old hash would be lost.
+        """
+        if name not in HASHES:
+            raise ValueError(f"Unknown key hash {name}, expected one of {list(HASHES)}")
+        with self.lock:
+            if self.snapshot.sealed:
+                raise ValueError("The key hash can no longer change, servers hold data placed with it")
+            self.snapshot = self.snapshot.evolve(keyHash=(max(self.snapshot.keyHash[0], 0) + 1, name))
+
+    def seal(self):
+        """Fix the key hash for good, called by a server once it holds data. Gossip spreads it to every server."""
+        with self.lock:
+            if not self.snapshot.sealed:
+                self.snapshot = self.snapshot.evolve(sealed=True)
+
+    def _hash(self, key: str, snapshot: RingSnapshot = None):
+        return HASHES[(snapshot or self.snapshot).keyHash[1]](key.encode()) % config.Q
+
+    def check_key(self, key: int, skip=None):
+        return self.serverName in self.getPrefList(str(key), skip)
+
+    def getPrefList(self, key: str, skip=None) -> list[str]:
+        """Preference list of a key, passing over the servers of `skip`, such as suspected ones, if given."""
+        snapshot = self.snapshot
+        return snapshot.getPrefListByToken(self._hash(key, snapshot), skip)
+
+    def ranges(self, server: str) -> list[tuple[int, int]]:
+        """Token ranges (start, end] of the virtual nodes whose preference list holds the server."""
+        snapshot = self.snapshot
+        positions = snapshot.positions
+        if len(set(positions)) == 1:
+            return [(positions[0], positions[0])] if server in snapshot.getPrefListByToken(positions[0]) else []
+        return [(positions[i - 1], pos) for i, pos in enumerate(positions)
+                if positions[i - 1] != pos and server in snapshot.getPrefListByToken(pos)]
+
+    def getPrefListByToken(self, hash: int, skip=None) -> list[str]:
+        """
+        Preference list of a token: the range holding it is found by binary search.
+        Servers of `skip` are passed over, the list going on to the next distinct servers of
+        the ring so that it still holds N servers when there are enough.
+        """
+        return self.snapshot.getPrefListByToken(hash, skip)
 
     def add(self, pos):
-        self.state.add(VirtualNode(self.serverName, pos))
-        self.versions[self.serverName] += 1
+        with self.lock:
+            snapshot = self.snapshot
+            versions = dict(snapshot.versions)
+            versions[self.serverName] += 1
+            self.snapshot = snapshot.evolve(nodes=set(snapshot.nodes) | {VirtualNode(self.serverName, pos)}, versions=versions)
     
     def delete(self, pos):
         n = VirtualNode(self.serverName, pos)
-        if n in self.state:
-            self.state.remove(n)
-            self.versions[self.serverName] += 1
-    
\ No newline at end of file
+        with self.lock:
+            snapshot = self.snapshot
+            nodes = set(snapshot.nodes)
+            if n in nodes:
+                versions = dict(snapshot.versions)
+                versions[self.serverName] += 1
+                self.snapshot = snapshot.evolve(nodes=nodes - {n}, versions=versions)
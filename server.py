@@ -5,15 +5,18 @@ import logging
 import argparse
 import os
 import json
-from threading import Thread, Condition
+from threading import Thread, Condition, Event, Lock
 from queue import Queue
-from ring import Ring
+from ring import Ring, use_ring
 from message import MessageType, Message
 from storage import Storage, VersionedValue, VectorClock, KeyVersion
 from typing import  Optional
 from config import *
 from gui import *
 from operation import Operation
+from wal import WriteAheadLog
+from engine import remove_database
+from failure import PhiAccrualDetector
 import log
 
 SWITCH_PORT = 2000
@@ -30,18 +33,35 @@ class Server():
 
         self.operations: dict[str, Operation] = {}
 
+        # Suspicion levels of the other servers, every message from one of them is a heartbeat
+        self.detector = PhiAccrualDetector(config.PHI_THRESHOLD, config.PHI_WINDOW, config.PHI_MIN_STD, config.I)
+
+        # Bytes of gossip sent this round, and saved against sending whole rings, by the gossip and command threads
+        self.gossipSent: int = 0
+        self.gossipSaved: int = 0
+        self.gossipLock = Lock()
+
         self.ring: Ring = Ring([])
         self.ring.init(self.name, config.T, self.seeds)
         
         self.loadState()
+        use_ring(self.ring)
+        self.keyHashName: str = self.ring.keyHash[1]   # Key hash the token index and Merkle trees were built with
 
         # Connect to Switch
         self.socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect_to_switch()
         
         # Unique to each server $path_to_database={datacenter_name}/{server_name}_storage.db
-        self.storage = Storage(f"{self.switch_name}/{self.name}_storage.db")
-        self.kv = KeyVersion(f"{self.switch_name}/{self.name}_key_versions.db")
+        # Both databases share a write-ahead log, replayed here if the server crashed
+        self.wal = WriteAheadLog(f"{self.switch_name}/{self.name}_wal.log", config.WAL_WINDOW, config.WAL_CHECKPOINT) \
+            if config.WAL_WINDOW is not None else None
+        self.storage = Storage(f"{self.switch_name}/{self.name}_storage.db", self.wal)
+        self.kv = KeyVersion(f"{self.switch_name}/{self.name}_key_versions.db", self.wal)
+        if not self.storage.empty():
+            self.ring.seal()    # Keys are placed with the current key hash and nothing migrates them
+        self.rangesChanged = Event()    # Set when the Merkle trees no longer follow the ranges of the ring
+        self.update_ranges()
 
         self.cmdQueue: Queue[Message] = Queue()
         self.cv = Condition()
@@ -49,6 +69,10 @@ class Server():
         self.recvThread = Thread(target=self.receive_from_switch)
         self.cmdThread = Thread(target=self.command_handler)
         self.gossipThread = Thread(target=self.gossip)
+        self.gcThread = Thread(target=self.collect_garbage)
+        self.coldThread = Thread(target=self.demote_cold)
+        self.ttlThread = Thread(target=self.expire_keys)
+        self.merkleThread = Thread(target=self.build_merkle_trees)
         self.guiThread = Thread(target=self.runGUI)
 
     def connect_to_switch(self) -> None: # Connect to switch
@@ -69,7 +93,9 @@ class Server():
                 response = Message.receive_all(self.socket.recvfrom)
 
                 msg: Message = Message.deserialize(response)
-                if msg.msg_type in {MessageType.GOSSIP_REQ, MessageType.GOSSIP_RES}:
+                if msg.source in self.ring.versions and msg.source != self.name:
+                    self.detector.heartbeat(msg.source)
+                if msg.msg_type in {MessageType.GOSSIP_REQ, MessageType.GOSSIP_RES, MessageType.GOSSIP_DELTA}:
                     logging.debug(f"Received Message: {msg}")
                 else:
                     logging.info(f"Received Message: {msg}")
@@ -80,13 +106,18 @@ class Server():
                 logging.error(f"error: {e}")
             
     def serialize_res(self, set: set[VersionedValue]) -> list[list]:
-        """Make GET RESPONSES serializable."""
+        """Make GET RESPONSES serializable, with one shared context for dotted version vectors."""
         serialized = []
         value = []
         vector_clocks = []
         for versioned_value in set:
             value.append(versioned_value.value)
-            vector_clocks.append(versioned_value.vector_clock.to_dict())
+            vector_clocks.append(versioned_value.vector_clock.to_dict(stamps=True))
+        if config.DOTTED_VERSION_VECTORS and len(set) > 1:
+            context = VectorClock()
+            for versioned_value in set:
+                context.merge(versioned_value.vector_clock)
+            vector_clocks = [context.to_dict(stamps=True)]
 
         serialized.append(value)
         serialized.append(vector_clocks)
@@ -103,6 +134,11 @@ class Server():
                 new_vc = new_vc.merge(vc)
             
             deserialized.add(VersionedValue(serialized[0],new_vc))
+
+        elif len(serialized[1]) == 1:
+            # Siblings sharing the context that covers them all
+            for value in serialized[0]:
+                deserialized.add(VersionedValue(value, VectorClock(serialized[1][0])))
         
         else:
 
@@ -165,8 +201,11 @@ class Server():
                 
                 versioned_value = self.deserialize_put([msg.kwargs["value"]], [msg.kwargs["context"]] )
 
+                if versioned_value and msg.kwargs.get("dot"):
+                    versioned_value.vector_clock.set_dot(*msg.kwargs["dot"])
+
                 if versioned_value:
-                    self.put(key, versioned_value.value, versioned_value.vector_clock)
+                    self.put(key, versioned_value.value, versioned_value.vector_clock, msg.kwargs.get("expires"))
                     response = Message(msgid, MessageType.PUT_ACK, self.name, msg.source, kw)
                     self.send(response)
                 else:
@@ -177,7 +216,7 @@ class Server():
     def exec_request(self, req: Message) -> None:
         """Execute the GET or PUT request."""
         op = self.operations.get(req.id)
-        prefList = self.ring.getPrefList(req.kwargs["key"])
+        prefList = op.prefList
 
         with op.cv:
             target = prefList if op.isCord else [random.choice(prefList)]
@@ -209,7 +248,9 @@ class Server():
         key = req.kwargs["key"]
         # Check wether we've key or not
         op = None
-        if self.ring.check_key(key): # we're coordinator
+        # Suspicion levels are computed once per request, for both the coordinator check and the replicas
+        prefList = self.ring.getPrefList(str(key), self.suspects())
+        if self.name in prefList: # we're coordinator
 
             if req.msg_type == MessageType.GET:
                 if self.storage.exists(key):
@@ -219,12 +260,7 @@ class Server():
                     op = Operation(op_thread, req, True)
             else:
 
-                if not self.kv.exists(key):
-                    self.kv.add_key(key)
-                else:
-                    self.kv.inc_version(key)
-
-                version = self.kv.get_version(key)
+                version = self.kv.next_version(key)
 
                 if "context" in req.kwargs:
                     # update the our version in context(context is instanvce of VectorClock)
@@ -232,15 +268,27 @@ class Server():
                 else:
                     versioned_value = VersionedValue(req.kwargs["value"], VectorClock() )
 
-                versioned_value.vector_clock.add(self.name, version)
+                if config.DOTTED_VERSION_VECTORS:
+                    # The put is a new event in the context the client read
+                    versioned_value.vector_clock.set_dot(self.name, version)
+                    dropped = 0
+                else:
+                    dropped = versioned_value.vector_clock.add(self.name, version)
+                if dropped:
+                    logging.warning(f"Truncated the clock of key {key} by {dropped} entries, totals: {VectorClock.stats()}")
 
-                self.put(key, versioned_value.value , versioned_value.vector_clock)
+                # The coordinator fixes when the key expires so every replica expires it at the same time
+                ttl = req.kwargs.get("ttl", config.DEFAULT_TTL)
+                expires = time.time() + ttl if ttl is not None else None
+
+                self.put(key, versioned_value.value , versioned_value.vector_clock, expires)
                 
-                op = Operation(op_thread, req, True, value=versioned_value)
+                op = Operation(op_thread, req, True, value=versioned_value, expires=expires)
 
         else: # we're sub coordinator
             op = Operation(op_thread, req, False)
         
+        op.prefList = prefList
         self.operations[req.id] = op    # Add operation
         op.start()                      # start operation thread
 
@@ -253,7 +301,7 @@ class Server():
             
             req = self.cmdQueue.get()
 
-            if req.msg_type in {MessageType.GOSSIP_REQ, MessageType.GOSSIP_RES}:
+            if req.msg_type in {MessageType.GOSSIP_REQ, MessageType.GOSSIP_RES, MessageType.GOSSIP_DELTA}:
                 self.handle_gossips(req)
                 continue
 
@@ -269,9 +317,10 @@ class Server():
         """Retrieve a value by key from local storage."""
         return self.storage.get_leaf_nodes(key)
 
-    def put(self, key: str, value: str,  context: VectorClock = None) -> None:
+    def put(self, key: str, value: str,  context: VectorClock = None, expires: Optional[float] = None) -> None:
         """Store a key-value pair in local storage."""
-        self.storage.add_version(key, value, context)
+        self.ring.seal()
+        self.storage.add_version(key, value, context, expires)
 
     def send(self, msg: Message): # To Server or Load Blanacer through Switch
         while True:
@@ -286,8 +335,7 @@ class Server():
         logging.info(f"Starting Gossip...")
         while True:
             logging.debug(f"Known Servers: {list(self.ring.serverSet)}, Ring State: {str(list(self.ring.state))}")
-            gossipSet = self.ring.serverSet
-            gossipSet.discard(self.name)
+            gossipSet = self.ring.serverSet - {self.name}
 
             if len(gossipSet) == 0:
                 logging.warning("No Server To Gossip")
@@ -295,13 +343,50 @@ class Server():
                 continue
             gossipList = random.sample(list(gossipSet), min(len(gossipSet), config.G))
             for server in gossipList:
-                message = Message(-1, MessageType.GOSSIP_REQ, self.name, server, {'ring': self.ring})
-                self.send(message)
+                self.send_gossip(MessageType.GOSSIP_REQ, server, {'versions': self.ring.versions, 'keyHash': self.ring.keyHash,
+                                                                'sealed': self.ring.sealed})
             time.sleep(config.I) 
+            with self.gossipLock:
+                sent, saved = self.gossipSent, self.gossipSaved
+                self.gossipSent = self.gossipSaved = 0
+            logging.debug(f"Gossip sent {sent} bytes, {saved} fewer than whole rings")
+            logging.debug(f"Suspicion levels: {self.detector.levels()}")
+
+    def suspects(self) -> Optional[set[str]]:
+        """Servers preference lists pass over, if config.SKIP_SUSPECTED."""
+        return self.detector.suspects() if config.SKIP_SUSPECTED else None
+
+    def send_gossip(self, msg_type: MessageType, dest: str, kwargs: dict) -> None:
+        """Send a gossip message, counting its bytes against those of the whole ring sent before deltas."""
+        size = len(json.dumps(kwargs))
+        # Requests and responses both carried the whole ring, deltas are an extra message
+        saved = (self.ring.serializedSize() if msg_type != MessageType.GOSSIP_DELTA else 0) - size
+        with self.gossipLock:
+            self.gossipSent += size
+            self.gossipSaved += saved
+        self.send(Message(-1, msg_type, self.name, dest, kwargs))
 
     def handle_gossips(self, msg: Message):
-        # merge incoming ring
-        addedNodes, deletedNodes = self.ring.merge(msg.kwargs['ring'])
+        """
+        Scuttlebutt-style exchange: a request carries the versions of the ring alone, the response the
+        tokens of the servers it is behind on and the servers it needs, sent back in a delta.
+        """
+        keyHash, sealed = msg.kwargs.get('keyHash'), msg.kwargs.get('sealed', False)
+        if msg.msg_type == MessageType.GOSSIP_REQ:
+            versions = msg.kwargs['versions']
+            self.ring.mergeDelta({}, keyHash, sealed)
+            self.send_gossip(MessageType.GOSSIP_RES, msg.source, {
+                'delta': self.ring.delta(self.ring.newerThan(versions)),
+                'request': self.ring.olderThan(versions),
+                'keyHash': self.ring.keyHash, 'sealed': self.ring.sealed})
+            addedNodes, deletedNodes = set(), set()
+        else:
+            addedNodes, deletedNodes = self.ring.mergeDelta(msg.kwargs['delta'], keyHash, sealed)
+            if msg.kwargs.get('request'):
+                self.send_gossip(MessageType.GOSSIP_DELTA, msg.source, {
+                    'delta': self.ring.delta(msg.kwargs['request']), 'keyHash': self.ring.keyHash,
+                    'sealed': self.ring.sealed})
+
         if addedNodes or deletedNodes:
             try:
                 self.gui.updateRing(self.ring)
@@ -311,10 +396,57 @@ class Server():
             logging.critical(f"Added new node of server {node.server} at position {node.pos}")
         for node in deletedNodes:
             logging.critical(f"Deleted a node of server {node.server} at position {node.pos}")
-        # send own ring
-        if msg.msg_type == MessageType.GOSSIP_REQ:
-            message = Message(-1, MessageType.GOSSIP_RES, self.name, msg.source, {'ring': self.ring})
-            self.send(message)
+        if addedNodes or deletedNodes:
+            self.update_ranges()
+        self.update_key_hash()
+
+    def update_ranges(self):
+        """Mark the Merkle trees out of date with the token ranges this server holds, for merkleThread to rebuild."""
+        self.rangesChanged.set()
+
+    def update_key_hash(self):
+        """Hash keys with the function the ring settled on, rebuilding what depends on key tokens."""
+        version, name = self.ring.keyHash
+        if name != self.keyHashName:
+            self.keyHashName = name
+            logging.critical(f"Switched to key hash {name} (version {version})")
+            self.storage.rehash()
+            self.update_ranges()
+
+    def collect_garbage(self): # Thread
+        logging.info(f"Starting Garbage Collection...")
+        while True:
+            time.sleep(config.GC_INTERVAL)
+            for key, reclaimed in self.storage.compact_all().items():
+                logging.debug(f"Reclaimed {reclaimed} bytes from key {key}")
+
+    def demote_cold(self): # Thread
+        logging.info(f"Starting cold segment migration...")
+        while True:
+            time.sleep(config.COLD_INTERVAL)
+            moved = self.storage.demote_cold()
+            if moved:
+                logging.debug(f"Moved {moved} idle keys to cold segments")
+
+    def expire_keys(self): # Thread
+        logging.info(f"Starting TTL sweeper...")
+        while True:
+            time.sleep(config.TTL_SWEEP_INTERVAL)
+            # Version counters of collected keys are kept: replicas that still hold the tombstone
+            # would drop the puts of a counter started over
+            expired, collected = self.storage.sweep()
+            for key in expired:
+                logging.debug(f"Expired key {key}")
+            for key in collected:
+                logging.debug(f"Dropped the tombstone of key {key}")
+
+    def build_merkle_trees(self): # Thread
+        logging.info(f"Starting Merkle tree builder...")
+        while True:
+            self.rangesChanged.wait()
+            self.rangesChanged.clear()
+            for start, end in self.storage.set_ranges(self.ring.ranges(self.name)):
+                logging.debug(f"Built Merkle tree of range ({start}, {end}]")
 
     def handle_hinted_handoffs(): # Thread
         raise NotImplementedError
@@ -334,8 +466,13 @@ class Server():
         db_path = f"{self.switch_name}/{self.name}_storage.db"
         kvdb_path = f"{self.switch_name}/{self.name}_key_versions.db"
         try:
-            os.remove(db_path)
-            os.remove(kvdb_path)
+            if self.wal:
+                self.wal.close()
+                os.remove(self.wal.path)
+            self.storage.close()
+            self.kv.close()
+            remove_database(db_path)
+            remove_database(kvdb_path)
             logging.info(f"[Server] Database '{db_path}' deleted.")
         except FileNotFoundError:
             logging.error(f"[Server] Database '{db_path}' does not exist, nothing to delete.")
@@ -373,6 +510,20 @@ class Server():
         self.gossipThread.daemon = True
         self.gossipThread.start()
 
+        if config.GC_MODE == "background":
+            self.gcThread.daemon = True
+            self.gcThread.start()
+
+        if config.COLD_AFTER is not None:
+            self.coldThread.daemon = True
+            self.coldThread.start()
+
+        self.ttlThread.daemon = True
+        self.ttlThread.start()
+
+        self.merkleThread.daemon = True
+        self.merkleThread.start()
+
         self.guiThread.start()
         
         self.guiThread.join()
@@ -398,11 +549,24 @@ class Server():
 
     def addToken(self, pos):
         self.ring.add(pos)
+        self.update_ranges()
         self.gui.updateRing(self.ring)
 
+    def setKeyHash(self, name):
+        # Keys are not migrated to their new owners: only a cluster that holds no data yet may switch
+        if not self.storage.empty():
+            self.ring.seal()
+        try:
+            self.ring.setKeyHash(name)
+        except ValueError as e:
+            logging.error(f"Key hash not switched to {name}: {e}")
+            return
+        self.update_key_hash()
+
     def deleteToken(self, pos):
         logging.critical(f"Deleting token at position {pos}")
         self.ring.delete(pos)
+        self.update_ranges()
         self.gui.updateRing(self.ring)
 
 if __name__=="__main__":    
@@ -0,0 +1,165 @@
+import argparse
+import os
+import struct
+import time
+import zlib
+from typing import BinaryIO, Callable, Iterator, Optional
+from engine import Writes
+from storage import Storage, KeyVersion
+
+# A snapshot file is MAGIC followed by chunks. Each chunk is a (section, record count, payload length, crc32)
+# header and a payload of (key length, value length) headers each followed by the key and the value.
+# Records are sorted by key within a section. The last chunk is an END chunk whose count is the total
+# number of records, so a truncated file is told apart from a complete one.
+MAGIC = b'DYNSNAP1'
+CHUNK = struct.Struct('!BIII')
+RECORD = struct.Struct('!II')
+
+END, STORAGE, KEY_VERSIONS = 0, 1, 2
+
+Progress = Callable[[int, int], None]   # (done, total), in keys for exports and bytes for loads
+
+class SnapshotWriter:
+    """Packs records into chunks of about `chunk_size` bytes."""
+    def __init__(self, file: BinaryIO, chunk_size: int):
+        self.file = file
+        self.chunk_size: int = chunk_size
+        self.section: int = STORAGE
+        self.payload = bytearray()
+        self.count: int = 0
+        self.total: int = 0
+
+        self.file.write(MAGIC)
+
+    def _flush(self) -> None:
+        if self.count:
+            self.file.write(CHUNK.pack(self.section, self.count, len(self.payload), zlib.crc32(self.payload)))
+            self.file.write(self.payload)
+            self.payload = bytearray()
+            self.count = 0
+
+    def write(self, section: int, records: Writes) -> None:
+        if section != self.section:
+            self._flush()
+            self.section = section
+        for key, value in records:
+            self.payload += RECORD.pack(len(key), len(value))
+            self.payload += key
+            self.payload += value
+            self.count += 1
+        self.total += len(records)
+        if len(self.payload) >= self.chunk_size:
+            self._flush()
+
+    def close(self) -> None:
+        self._flush()
+        self.file.write(CHUNK.pack(END, self.total, 0, zlib.crc32(b'')))
+
+def export_snapshot(storage: Storage, kv: KeyVersion, path: str, chunk_size: int = 1 << 20,
+                    progress: Optional[Progress] = None) -> int:
+    """
+    Write a point-in-time snapshot of a storage and its key versions to `path`, while writes go on.
+    The file only appears once complete. Returns the number of records written.
+    """
+    key_versions: Writes = []
+    keys = storage.freeze(lambda: key_versions.extend(kv.snapshot()))
+    try:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            writer = SnapshotWriter(file, chunk_size)
+            writer.write(STORAGE, storage.meta_records())    # Sorts before every key
+            for done, key_bytes in enumerate(keys, 1):
+                writer.write(STORAGE, storage.read_frozen(key_bytes))
+                if progress:
+                    progress(done, len(keys))
+            writer.write(KEY_VERSIONS, key_versions)
+            writer.close()
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        storage.thaw()
+    return writer.total
+
+def read_chunks(path: str) -> Iterator[tuple[int, int, bytes, int]]:
+    """Yield the (section, record count, payload, end offset) of every chunk, checking them."""
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a snapshot")
+        total = 0
+        while True:
+            header = file.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                raise ValueError(f"Snapshot {path} is truncated")
+            section, count, length, crc = CHUNK.unpack(header)
+            if section == END:
+                if count != total:
+                    raise ValueError(f"Snapshot {path} holds {total} records, expected {count}")
+                return
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                raise ValueError(f"Corrupt chunk in snapshot {path} at offset {file.tell() - len(payload)}")
+            total += count
+            yield section, count, payload, file.tell()
+
+def parse_records(payload: bytes) -> Writes:
+    records: Writes = []
+    offset = 0
+    while offset < len(payload):
+        key_len, value_len = RECORD.unpack_from(payload, offset)
+        offset += RECORD.size
+        records.append((payload[offset:offset + key_len], payload[offset + key_len:offset + key_len + value_len]))
+        offset += key_len + value_len
+    return records
+
+def load_snapshot(storage: Storage, kv: KeyVersion, path: str, progress: Optional[Progress] = None) -> int:
+    """
+    Bulk load a snapshot into empty databases, one engine batch per chunk and no version tree walk.
+    The whole file is checked before anything is written. Returns the number of records loaded.
+    """
+    if any(True for _ in storage.db.keys()) or any(True for _ in kv.db.keys()):
+        raise ValueError("Snapshots are only loaded into empty databases")
+    for _ in read_chunks(path):
+        pass
+
+    size = os.path.getsize(path)
+    loaded = 0
+    for section, count, payload, offset in read_chunks(path):
+        db = storage.db if section == STORAGE else kv.db
+        db.write_batch(parse_records(payload))
+        loaded += count
+        if progress:
+            progress(offset, size)
+    storage.db.sync()
+    kv.db.sync()
+    storage.bulk_loaded()
+    kv.bulk_loaded()
+    return loaded
+
+def print_progress(unit: str) -> Progress:
+    start = time.perf_counter()
+    def progress(done: int, total: int) -> None:
+        elapsed = time.perf_counter() - start
+        print(f"\r{done}/{total} {unit} ({done / max(total, 1):.0%}) in {elapsed:.1f}s", end='' if done < total else '\n')
+    return progress
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or bulk load a snapshot of a server's databases")
+    parser.add_argument('action', choices=['export', 'load'])
+    parser.add_argument('-storage', help="Storage database path", required=True)
+    parser.add_argument('-kv', help="Key version database path", required=True)
+    parser.add_argument('-file', help="Snapshot file", required=True)
+    parser.add_argument('-engine', help="Storage engine, config.ENGINE by default")
+    args = parser.parse_args()
+
+    storage = Storage(args.storage, engine=args.engine)
+    kv = KeyVersion(args.kv, engine=args.engine)
+    try:
+        if args.action == 'export':
+            records = export_snapshot(storage, kv, args.file, progress=print_progress("keys"))
+        else:
+            records = load_snapshot(storage, kv, args.file, progress=print_progress("bytes"))
+        print(f"{records} records")
+    finally:
+        storage.close()
+        kv.close()
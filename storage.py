@@ -1,56 +1,290 @@
 import pickle
-import threading
-from typing import Any, Optional
-import bsddb3
+import hashlib
+import bisect
 import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from contextlib import ExitStack, contextmanager
+from itertools import islice, takewhile
+from typing import Any, Callable, Iterator, Optional
+from config import config
+from engine import Engine, Writes, open_engine
+from wal import WriteAheadLog
+from cache import LRUCache
+from compression import Compression, train_dictionary
+from cold import TieredEngine
+from ring import key_token
+from merkle import MerkleRanges, MerkleTree
+from sortedcontainers import SortedSet
 
 class VectorClock:
+    """
+    Vector clock over interned server ids.
+    Entries are kept in arrays sorted by server id, so clocks are compact and compared in a
+    single pass. An entry that is missing counts as older than any version, 0 included.
+    Every entry also carries the time its server last updated it, which plays no part in
+    comparisons. A clock that grows past config.CLOCK_MAX_ENTRIES drops its oldest entries,
+    like Dynamo's clock truncation: the versions may then look concurrent to the client.
+
+    A dotted clock (a dotted version vector) also holds the dot, the (server, counter) event
+    of the write that made it, apart from the entries, which are the context it was written in.
+    It comes after exactly the versions whose events its context and dot cover, so two
+    writes made in the same context are siblings, whatever counters the coordinators picked.
+    """
+    __slots__ = ('ids', 'counters', 'stamps', 'dot')
+
+    BEFORE, AFTER, EQUAL, CONCURRENT = range(4)
+
+    # Server names by id, shared by every clock of the process
+    server_ids: dict[str, int] = {}
+    server_names: list[str] = []
+    intern_lock = threading.Lock()
+
+    # Metrics
+    truncations: int = 0        # Clocks truncated
+    dropped_entries: int = 0    # Entries dropped by truncations
+    stats_lock = threading.Lock()
+
     def __init__(self, clock: dict[str, int] = None):
         """
         Initialize the vector clock.
         Args: clock (dict[str, int])
         """
-        self.clock = clock if clock else {}
+        self.dot: Optional[tuple[int, int, float]] = None     # (server id, counter, time) of a dotted clock
+        self.from_dict(clock if clock else {})
 
-    def add(self, server_name: str, version: int) -> None:
-        """Add the server to clock."""
-        self.clock[server_name] = version
+    @classmethod
+    def server_id(cls, server_name: str) -> int:
+        server_id = cls.server_ids.get(server_name)
+        if server_id is None:
+            with cls.intern_lock:
+                server_id = cls.server_ids.setdefault(server_name, len(cls.server_names))
+                if server_id == len(cls.server_names):
+                    cls.server_names.append(server_name)
+        return server_id
 
-    def __lt__(self, other: 'VectorClock') -> bool:
-        """Retrun True if self.clock is less than other.clock."""
+    @property
+    def clock(self) -> dict[str, int]:
+        return self.to_dict()
 
-        for server_name, version in self.clock.items():
-            if not (server_name in other.clock and version <= other.clock[server_name]):
+    def add(self, server_name: str, version: int, stamp: Optional[float] = None) -> int:
+        """Add the server to clock, updated at `stamp`, now by default. Returns the entries truncated."""
+        server_id = self.server_id(server_name)
+        stamp = time.time() if stamp is None else stamp
+        i = bisect.bisect_left(self.ids, server_id)
+        if i < len(self.ids) and self.ids[i] == server_id:
+            self.counters[i] = version
+            self.stamps[i] = stamp
+        else:
+            self.ids.insert(i, server_id)
+            self.counters.insert(i, version)
+            self.stamps.insert(i, stamp)
+        return self.truncate(config.CLOCK_MAX_ENTRIES)
+
+    def truncate(self, max_entries: Optional[int]) -> int:
+        """Drop the least recently updated entries past `max_entries`, returns the number dropped."""
+        excess = len(self.ids) - max_entries if max_entries is not None else 0
+        if excess <= 0:
+            return 0
+        oldest = set(sorted(range(len(self.ids)), key=lambda i: (self.stamps[i], self.counters[i]))[:excess])
+        kept = [i for i in range(len(self.ids)) if i not in oldest]
+        self.ids = array('I', (self.ids[i] for i in kept))
+        self.counters = array('Q', (self.counters[i] for i in kept))
+        self.stamps = array('d', (self.stamps[i] for i in kept))
+        with self.stats_lock:
+            VectorClock.truncations += 1
+            VectorClock.dropped_entries += excess
+        return excess
+
+    def set_dot(self, server_name: str, version: int, stamp: Optional[float] = None) -> None:
+        """Make this clock the dotted clock of a write event of the server, in the context of its entries."""
+        self.dot = (self.server_id(server_name), version, time.time() if stamp is None else stamp)
+
+    def get_dot(self) -> Optional[tuple[str, int, float]]:
+        """(server name, version, time) of the dot, None if the clock is not dotted."""
+        return (self.server_names[self.dot[0]], self.dot[1], self.dot[2]) if self.dot is not None else None
+
+    def _fold_dot(self) -> None:
+        """Turn the dot into an entry, leaving the clock of every event it covers."""
+        if self.dot is not None:
+            server_id, version, stamp = self.dot
+            self.dot = None
+            i = bisect.bisect_left(self.ids, server_id)
+            if i < len(self.ids) and self.ids[i] == server_id:
+                if version > self.counters[i]:
+                    self.counters[i] = version
+                    self.stamps[i] = stamp
+            else:
+                self.ids.insert(i, server_id)
+                self.counters.insert(i, version)
+                self.stamps.insert(i, stamp)
+
+    def _covered_by(self, other: 'VectorClock') -> bool:
+        """
+        True if every event of this clock is an event of the other, dots included.
+        Counters start at 0, so an entry n covers the events 0 to n of its server and a missing one none.
+        """
+        context = dict(zip(other.ids, other.counters))
+        dot = other.dot[:2] if other.dot is not None else None
+        for server_id, version in zip(self.ids, self.counters):
+            known = context.get(server_id, -1)
+            if version > known and not (version == known + 1 and dot == (server_id, version)):
                 return False
-            
+        if self.dot is not None:
+            server_id, version = self.dot[:2]
+            return version <= context.get(server_id, -1) or dot == (server_id, version)
         return True
 
+    @classmethod
+    def stats(cls) -> dict[str, int]:
+        """Truncation counters of the process."""
+        with cls.stats_lock:
+            return {"truncations": cls.truncations, "dropped_entries": cls.dropped_entries}
+
+    def compare(self, other: 'VectorClock') -> int:
+        """
+        Order of this clock against another: BEFORE if it happened before it, AFTER if after it,
+        EQUAL or CONCURRENT, in one pass over both clocks.
+        """
+        if self.dot is not None or other.dot is not None:
+            before, after = self._covered_by(other), other._covered_by(self)
+            if before:
+                return self.EQUAL if after else self.BEFORE
+            return self.AFTER if after else self.CONCURRENT
+
+        a_ids, b_ids = self.ids, other.ids
+        before = after = False
+        if a_ids == b_ids:
+            for a, b in zip(self.counters, other.counters):
+                if a < b:
+                    before = True
+                elif a > b:
+                    after = True
+        else:
+            a_counters, b_counters = self.counters, other.counters
+            n, m = len(a_ids), len(b_ids)
+            i = j = 0
+            while i < n and j < m:
+                a, b = a_ids[i], b_ids[j]
+                if a == b:
+                    if a_counters[i] != b_counters[j]:
+                        if a_counters[i] < b_counters[j]:
+                            before = True
+                        else:
+                            after = True
+                        if before and after:
+                            return self.CONCURRENT
+                    i += 1
+                    j += 1
+                elif a < b:     # Only in this clock
+                    if before:
+                        return self.CONCURRENT
+                    after = True
+                    i += 1
+                else:           # Only in the other clock
+                    if after:
+                        return self.CONCURRENT
+                    before = True
+                    j += 1
+            after = after or i < n
+            before = before or j < m
+
+        if before:
+            return self.CONCURRENT if after else self.BEFORE
+        return self.AFTER if after else self.EQUAL
+
+    def __lt__(self, other: 'VectorClock') -> bool:
+        """Retrun True if self.clock is less than other.clock."""
+        return self.compare(other) in (self.BEFORE, self.EQUAL)
+
     def __eq__(self, other: 'VectorClock') -> bool:
         """Retrun True if self.clock is equal other.clock."""
+        if not isinstance(other, VectorClock):
+            return NotImplemented
+        return (self.ids == other.ids and self.counters == other.counters
+                and (self.dot and self.dot[:2]) == (other.dot and other.dot[:2]))
 
-        for server_name, version in self.clock.items():
-            if not (server_name in other.clock and version == other.clock[server_name]):
-                return False
-            
-        return len(self.clock) == len(other.clock)
-    
-    def merge(self, other: 'VectorClock') -> None:
-        """Merge this vector clock with another vector clock, taking the maximum version for each server."""
-        for server_name, version in other.clock.items():
-            self.clock[server_name] = max(self.clock.get(server_name, 0), version)
+    def __hash__(self) -> int:
+        return hash((self.ids.tobytes(), self.counters.tobytes(), self.dot and self.dot[:2]))
+
+    def merge(self, other: 'VectorClock', truncate: bool = True) -> None:
+        """
+        Merge this vector clock with another vector clock, taking the maximum version for each server.
+        Dots are folded into the entries: the merged clock is the context of a write that saw both.
+        With truncate False the merged clock keeps every entry, whatever config.CLOCK_MAX_ENTRIES.
+        """
+        self._fold_dot()
+        if other.dot is not None:
+            other = other.copy()
+            other._fold_dot()
+        clock = dict(zip(self.ids, zip(self.counters, self.stamps)))
+        for server_id, entry in zip(other.ids, zip(other.counters, other.stamps)):
+            clock[server_id] = max(clock.get(server_id, entry), entry)
+        self.ids = array('I', sorted(clock))
+        self.counters = array('Q', (clock[server_id][0] for server_id in self.ids))
+        self.stamps = array('d', (clock[server_id][1] for server_id in self.ids))
+        if truncate:
+            self.truncate(config.CLOCK_MAX_ENTRIES)
 
     def delete(self, server_name: str) -> None:
         """Delete the server to clock."""
-        if server_name in self.clock:
-            del self.clock[server_name]
+        server_id = self.server_ids.get(server_name)
+        i = bisect.bisect_left(self.ids, server_id) if server_id is not None else len(self.ids)
+        if i < len(self.ids) and self.ids[i] == server_id:
+            del self.ids[i]
+            del self.counters[i]
+            del self.stamps[i]
 
-    def to_dict(self) -> dict[str, int]:
-        """Convert the vector clock to a dictionary format."""
-        return self.clock
+    def entries(self) -> list[tuple[str, int, float]]:
+        """(server name, version, time updated) of every entry, by server name, the dot left out."""
+        return sorted((self.server_names[server_id], version, stamp)
+                      for server_id, version, stamp in zip(self.ids, self.counters, self.stamps))
+
+    def copy(self) -> 'VectorClock':
+        clock = VectorClock()
+        clock.ids, clock.counters, clock.stamps = array('I', self.ids), array('Q', self.counters), array('d', self.stamps)
+        clock.dot = self.dot
+        return clock
+
+    def to_dict(self, stamps: bool = False, dot: bool = True) -> dict[str, int]:
+        """
+        Convert the vector clock to a dictionary format, the dot folded in unless `dot` is False.
+        With `stamps`, each server maps to [version, time updated], as sent between servers and clients.
+        """
+        clock = self
+        if dot and self.dot is not None:
+            clock = self.copy()
+            clock._fold_dot()
+        if stamps:
+            return {server_name: [version, stamp] for server_name, version, stamp in clock.entries()}
+        return {server_name: version for server_name, version, _ in clock.entries()}
 
     def from_dict(self, data: dict[str, int]) -> None:
-        """Load the vector clock from a dictionary."""
-        self.clock = data
+        """Load the vector clock from a dictionary, of versions or of [version, time updated] pairs."""
+        entries = sorted((self.server_id(server_name), *(entry if isinstance(entry, (list, tuple)) else (entry, 0.0)))
+                         for server_name, entry in data.items())
+        self.ids = array('I', (server_id for server_id, _, _ in entries))
+        self.counters = array('Q', (version for _, version, _ in entries))
+        self.stamps = array('d', (stamp for _, _, stamp in entries))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __reduce__(self):
+        if self.dot is not None:
+            return VectorClock, (self.to_dict(stamps=True, dot=False),), {'dot': self.get_dot()}
+        return VectorClock, (self.to_dict(stamps=True),)
+
+    def __setstate__(self, state: dict) -> None:
+        """The dot of a dotted clock, or the clock dictionary of clocks pickled before slots."""
+        if 'dot' in state:
+            self.set_dot(*state['dot'])
+        else:
+            self.dot = None
+            self.from_dict(state['clock'])
 
     def __str__(self) -> str:
         return str(self.clock)
@@ -62,7 +296,7 @@ class VersionedValue:
 
     # Made VersionedValue hashable by implementing __hash__ and __eq__ methods
     def __hash__(self):
-        return hash((self.value, tuple(self.vector_clock.clock.items())))
+        return hash((self.value, self.vector_clock))
 
     def __eq__(self, other):
         return isinstance(other, VersionedValue) and self.value == other.value and self.vector_clock == other.vector_clock
@@ -73,65 +307,691 @@ class VersionedValue:
     def __repr__(self):
         return f"VersionedValue(value={self.value}, vector_clock={self.vector_clock})"
 
-class KeyVersion:
-    def __init__(self, db_path: str) -> None:
+class RecordCodec:
+    """
+    Binary encoding of the version tree records.
+    A record starts with the codec format and its kind. The server names of all clocks in a record
+    are written once, in a table, and clocks refer to them by index. Counters, lengths and indexes
+    are varints. Pickled records, written before the codec, are still read.
+    Records of format 3 follow every clock entry with the time it was last updated, in whole seconds
+    (format 2 would read as compression.COMPRESSED). Records of formats 4 and 5 hold dotted clocks:
+    each clock ends with its dot, as the index of its server plus one (0 for no dot) and its counter.
+    """
+    FORMAT: int = 1
+    STAMPED_FORMAT: int = 3
+    DOTTED_FORMAT: int = 4          # Stamped, with dots
+    DOTTED_ID_FORMAT: int = 5       # With dots, encodings of dotted versions alone
+    FORMATS: dict[int, tuple[bool, bool]] = {FORMAT: (False, False), STAMPED_FORMAT: (True, False),
+                                             DOTTED_FORMAT: (True, True), DOTTED_ID_FORMAT: (False, True)}
+
+    # Record kinds
+    LEAVES, NODE, IDS, TIME = 1, 2, 3, 4
+
+    # Value tags, ROOT stands for the "root" node of the tree
+    NONE, STR, BYTES, INT, FLOAT, ROOT, PICKLE = range(7)
+
+    DOUBLE = struct.Struct('!d')
+
+    @staticmethod
+    def _write_varint(out: bytearray, n: int) -> None:
+        if n < 0x80:
+            out.append(n)
+            return
+        while n >= 0x80:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    @staticmethod
+    def _read_varint(raw: bytes, offset: int) -> tuple[int, int]:
+        byte = raw[offset]
+        if byte < 0x80:
+            return byte, offset + 1
+        offset += 1
+        result, shift = byte & 0x7f, 7
+        while byte & 0x80:
+            byte = raw[offset]
+            offset += 1
+            result |= (byte & 0x7f) << shift
+            shift += 7
+        return result, offset
+
+    @classmethod
+    def _write_bytes(cls, out: bytearray, data: bytes) -> None:
+        cls._write_varint(out, len(data))
+        out += data
+
+    @classmethod
+    def _write_version(cls, out: bytearray, node: str | VersionedValue, names: dict[str, int],
+                       stamps: bool = True, dots: bool = False) -> None:
+        """Write a version as its value and clock, interning the server names in `names`."""
+        if not isinstance(node, VersionedValue):
+            out.append(cls.ROOT)
+            return
+
+        value = node.value
+        if value is None:
+            out.append(cls.NONE)
+        elif type(value) is str:
+            out.append(cls.STR)
+            cls._write_bytes(out, value.encode('utf-8'))
+        elif type(value) is bytes:
+            out.append(cls.BYTES)
+            cls._write_bytes(out, value)
+        elif type(value) is int:
+            out.append(cls.INT)
+            cls._write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+        elif type(value) is float:
+            out.append(cls.FLOAT)
+            out += cls.DOUBLE.pack(value)
+        else:
+            # Values of any other type are not expected from clients, keep them opaque
+            out.append(cls.PICKLE)
+            cls._write_bytes(out, pickle.dumps(value))
+
+        entries = node.vector_clock.entries()
+        cls._write_varint(out, len(entries))
+        for server_name, version, stamp in entries:
+            index = names.setdefault(server_name, len(names))
+            cls._write_varint(out, index)
+            cls._write_varint(out, version)
+            if stamps:
+                cls._write_varint(out, int(stamp))
+        if dots:
+            dot = node.vector_clock.get_dot()
+            if dot is None:
+                out.append(0)
+                return
+            cls._write_varint(out, names.setdefault(dot[0], len(names)) + 1)
+            cls._write_varint(out, dot[1])
+            if stamps:
+                cls._write_varint(out, int(dot[2]))
+
+    @staticmethod
+    def _dotted(versions) -> bool:
+        return any(isinstance(node, VersionedValue) and node.vector_clock.dot is not None for node in versions)
+
+    @classmethod
+    def _read_version(cls, raw: bytes, offset: int, names: list[str],
+                      stamps: bool = True, dots: bool = False) -> tuple[str | VersionedValue, int]:
+        tag = raw[offset]
+        offset += 1
+        if tag == cls.ROOT:
+            return "root", offset
 
-        if os.path.exists(db_path):
-            # Load the existing database
-            print(f"Loading existing database at {db_path}.")
-            self.db = bsddb3.hashopen(db_path, 'w')  # Open in read/write mode
+        if tag == cls.NONE:
+            value = None
+        elif tag == cls.FLOAT:
+            value = cls.DOUBLE.unpack_from(raw, offset)[0]
+            offset += cls.DOUBLE.size
+        elif tag == cls.INT:
+            n, offset = cls._read_varint(raw, offset)
+            value = (n >> 1) if not n & 1 else -((n + 1) >> 1)
         else:
-            # Create a new database
-            print(f"Database not found at {db_path}. Creating a new one.")
-            self.db = bsddb3.hashopen(db_path, 'c')  # Create if it doesn't exist
+            length, offset = cls._read_varint(raw, offset)
+            data = raw[offset: offset + length]
+            offset += length
+            if tag == cls.STR:
+                value = str(data, 'utf-8')
+            elif tag == cls.BYTES:
+                value = bytes(data)
+            elif tag == cls.PICKLE:
+                value = pickle.loads(data)
+            else:
+                raise ValueError(f"Unknown value tag {tag}")
+
+        count, offset = cls._read_varint(raw, offset)
+        clock = {}
+        for _ in range(count):
+            index, offset = cls._read_varint(raw, offset)
+            version, offset = cls._read_varint(raw, offset)
+            stamp = 0
+            if stamps:
+                stamp, offset = cls._read_varint(raw, offset)
+            clock[names[index]] = (version, float(stamp))
+        vector_clock = VectorClock(clock)
+        if dots:
+            index, offset = cls._read_varint(raw, offset)
+            if index:
+                version, offset = cls._read_varint(raw, offset)
+                stamp = 0
+                if stamps:
+                    stamp, offset = cls._read_varint(raw, offset)
+                vector_clock.set_dot(names[index - 1], version, float(stamp))
+        return VersionedValue(value, vector_clock), offset
+
+    @classmethod
+    def _record(cls, kind: int, body: bytearray, names: dict[str, int], format: int) -> bytes:
+        out = bytearray((format, kind))
+        cls._write_varint(out, len(names))
+        for server_name in names:
+            cls._write_bytes(out, server_name.encode('utf-8'))
+        out += body
+        return bytes(out)
+
+    @classmethod
+    def encode(cls, record: dict | tuple | set) -> bytes:
+        """
+        Encode a record of TreeRecords: a {node id: version} leaf record, a
+        (VersionedValue, time written) node record, a set of node ids or a time.
+        """
+        names: dict[str, int] = {}
+        body = bytearray()
+        dots = False
+        if isinstance(record, dict):
+            kind = cls.LEAVES
+            dots = cls._dotted(record.values())
+            cls._write_varint(body, len(record))
+            for node_id, node in record.items():
+                cls._write_bytes(body, node_id)
+                cls._write_version(body, node, names, dots=dots)
+        elif isinstance(record, tuple):
+            kind = cls.NODE
+            dots = cls._dotted(record[:1])
+            cls._write_version(body, record[0], names, dots=dots)
+            body += cls.DOUBLE.pack(record[1])
+        elif isinstance(record, float):
+            kind = cls.TIME
+            body += cls.DOUBLE.pack(record)
+        else:
+            kind = cls.IDS
+            cls._write_varint(body, len(record))
+            for node_id in sorted(record):
+                cls._write_bytes(body, node_id)
+        return cls._record(kind, body, names, cls.DOTTED_FORMAT if dots else cls.STAMPED_FORMAT)
+
+    @classmethod
+    def encode_version(cls, versioned_value: VersionedValue) -> bytes:
+        """Canonical encoding of a version alone, the same for equal versions whatever their update times."""
+        names: dict[str, int] = {}
+        body = bytearray()
+        dots = cls._dotted([versioned_value])
+        cls._write_version(body, versioned_value, names, stamps=False, dots=dots)
+        return cls._record(cls.NODE, body, names, cls.DOTTED_ID_FORMAT if dots else cls.FORMAT)
+
+    @classmethod
+    def decode(cls, raw: bytes | memoryview) -> dict | tuple | set | float:
+        """Decode a record, from a memoryview too: only the decoded values are copied out of it."""
+        if raw[0] == 0x80:
+            return pickle.loads(raw)
+        if raw[0] not in cls.FORMATS:
+            raise ValueError(f"Unknown record format {raw[0]}")
+        stamps, dots = cls.FORMATS[raw[0]]
+
+        kind = raw[1]
+        count, offset = cls._read_varint(raw, 2)
+        names = []
+        for _ in range(count):
+            length, offset = cls._read_varint(raw, offset)
+            names.append(sys.intern(str(raw[offset: offset + length], 'utf-8')))
+            offset += length
+
+        if kind == cls.NODE:
+            versioned_value, offset = cls._read_version(raw, offset, names, stamps, dots)
+            return versioned_value, cls.DOUBLE.unpack_from(raw, offset)[0]
+        if kind == cls.TIME:
+            return cls.DOUBLE.unpack_from(raw, offset)[0]
+
+        count, offset = cls._read_varint(raw, offset)
+        if kind == cls.IDS:
+            ids = set()
+            for _ in range(count):
+                length, offset = cls._read_varint(raw, offset)
+                ids.add(bytes(raw[offset: offset + length]))
+                offset += length
+            return ids
+        if kind == cls.LEAVES:
+            leaves = {}
+            for _ in range(count):
+                length, offset = cls._read_varint(raw, offset)
+                node_id = bytes(raw[offset: offset + length])
+                leaves[node_id], offset = cls._read_version(raw, offset + length, names, stamps, dots)
+            return leaves
+        raise ValueError(f"Unknown record kind {kind}")
+
+class KeyVersion:
+    """
+    Per-key version counters.
+    Versions are handed out from memory. The database only holds, per key, a ceiling below
+    which versions may have been handed out, raised `config.VERSION_BLOCK` versions at a time.
+    A restart resumes every key at its ceiling, so it skips at most one block of versions.
+    """
+    CEILING = struct.Struct('!Q')
+
+    def __init__(self, db_path: str, wal: Optional[WriteAheadLog] = None, engine: Optional[str] = None) -> None:
+
+        self.db: Engine = open_engine(db_path, engine)
+        self.lock = threading.Lock()            # Guards the counters in memory, never held across a write
+        self.key_locks: list[threading.Lock] = [threading.Lock() for _ in range(max(1, config.LOCK_STRIPES))]
+        self.versions: dict[bytes, int] = {}    # Last version handed out
+        self.ceilings: dict[bytes, int] = {}    # First version not reserved in the database
+
+        # Versions are made durable through the write-ahead log, if any
+        self.db_path: str = db_path
+        self.wal: Optional[WriteAheadLog] = wal
+        if self.wal:
+            self.wal.register(self.db_path, self.db)
 
     def encode(self, key: str) -> bytes:
         """Convert an integer key to a bytes representation."""
         return bytes(key, 'utf-8') if isinstance(key, str) else key
-    
+
+    @classmethod
+    def decode_ceiling(cls, record: bytes) -> int:
+        if len(record) == cls.CEILING.size:
+            return cls.CEILING.unpack(record)[0]
+        # Counters written before leases hold the last version handed out, pickled
+        return int(pickle.loads(record)) + 1
+
+    def _commit(self, writes: Writes) -> None:
+        """Apply writes once they are durable in the write-ahead log, if any."""
+        if self.wal:
+            self.wal.commit(self.db_path, writes, self.db)
+        else:
+            self.db.write_batch(writes)
+
+    def _write(self, key_bytes: bytes, ceiling: int) -> None:
+        """Store a ceiling, durably before returning when there is a write-ahead log."""
+        self._commit([(key_bytes, self.CEILING.pack(ceiling))])
+
+    def _load(self, key_bytes: bytes) -> bool:
+        """Bring the counter of a key in memory, returns False for a new key. Called holding self.lock."""
+        if key_bytes in self.versions:
+            return True
+        record = self.db.get(key_bytes)
+        if record is None:
+            return False
+        ceiling = self.decode_ceiling(record)
+        self.versions[key_bytes] = ceiling - 1
+        self.ceilings[key_bytes] = ceiling
+        return True
+
+    def _allocate(self, key_bytes: bytes, pick: Callable[[], Optional[int]]) -> Optional[int]:
+        """
+        Hand out the version `pick` chooses from the counters in memory, if any, reserving the next
+        block first when it is past the ceiling. Allocations of a key are serialized by its lock,
+        held across the write so no version of the new block is handed out before it is durable.
+        self.lock is not, so reservations of other keys share the fsync.
+        """
+        with self.key_locks[hash(key_bytes) % len(self.key_locks)]:
+            with self.lock:
+                version = pick()
+                if version is None:
+                    return None
+                if version < self.ceilings.get(key_bytes, 0):
+                    self.versions[key_bytes] = version
+                    return version
+            ceiling = version + max(1, config.VERSION_BLOCK)
+            self._write(key_bytes, ceiling)
+            with self.lock:
+                self.ceilings[key_bytes] = ceiling
+                self.versions[key_bytes] = version
+            return version
+
+    def next_version(self, key: str) -> int:
+        """Allocate the version of a new put of the key, 0 for a new key."""
+        key_bytes = self.encode(key)
+        return self._allocate(key_bytes, lambda: self.versions[key_bytes] + 1 if self._load(key_bytes) else 0)
+
     def add_key(self, key: str):
         """Add key to the key version storage if the key is new."""
         key_bytes = self.encode(key)
-
-        if not self.db.has_key(key_bytes):
-            self.db[key_bytes] = pickle.dumps(0)
+        self._allocate(key_bytes, lambda: None if self._load(key_bytes) else 0)
 
     def get_version(self, key: str) -> int:
         """Return version of the key"""
         key_bytes = self.encode(key)
 
-        return int(pickle.loads(self.db[key_bytes]))
+        with self.lock:
+            if not self._load(key_bytes):
+                raise KeyError(key)
+            return self.versions[key_bytes]
     
     def inc_version(self, key: str):
         """Increse version of the key."""
         key_bytes = self.encode(key)
 
-        ver = int(pickle.loads(self.db[key_bytes]))
-        ver+=1
-
-        self.db[key_bytes] = pickle.dumps(ver)
+        def following() -> int:
+            if not self._load(key_bytes):
+                raise KeyError(key)
+            return self.versions[key_bytes] + 1
+        self._allocate(key_bytes, following)
     
     def exists(self, key: str) -> bool:
         key_bytes = self.encode(key)
 
-        return self.db.has_key(key_bytes)
+        with self.lock:
+            return key_bytes in self.versions or self.db.has_key(key_bytes)
 
-class Storage:
-    def __init__(self, db_path: str):
+    def snapshot(self) -> Writes:
+        """Every counter record as of now, sorted, with the ceilings held in memory."""
+        with self.lock:
+            records = {key_bytes: self.db[key_bytes] for key_bytes in self.db.keys()}
+            for key_bytes, ceiling in self.ceilings.items():
+                records[key_bytes] = self.CEILING.pack(ceiling)
+            return sorted(records.items())
+
+    def bulk_loaded(self) -> None:
+        """Forget the counters held in memory after records were written directly to the engine."""
+        with self.lock:
+            self.versions.clear()
+            self.ceilings.clear()
+
+    def close(self):
+        """Give back the unused part of the reserved blocks and close the database"""
+        with self.lock:
+            for key_bytes, version in self.versions.items():
+                if self.ceilings[key_bytes] != version + 1:
+                    self.db[key_bytes] = self.CEILING.pack(version + 1)
+        self.db.close()
+
+ROOT_ID: bytes = b"root"
+TREE_FORMAT: bytes = b"vdag1"
+READ_VIEW: bytes = b""      # Cached (leaf values, expiry time) of a key, read without its lock. No record key is empty
+
+class TreeRecords:
+    """
+    Record-level view of one key's version DAG.
+    Every version node, its child list, its parent list and the leaf set live in
+    separate records, so a write only rewrites the records it actually changes.
+
+    Layout (all records share the key bytes as prefix):
+        key            -> TREE_FORMAT marker
+        key\x00l       -> {leaf node id: VersionedValue}, enough to serve reads on its own
+        key\x00n<id>   -> (VersionedValue, time written)
+        key\x00c<id>   -> set of child node ids
+        key\x00p<id>   -> set of parent node ids
+        key\x00e       -> time at which the key expires, for keys written with a TTL
+        key\x00t       -> (VersionedValue with the merged clock of the expired leaves, time expired), a tombstone
+    Records other than the marker are encoded with RecordCodec, then compressed if `compression` is given.
+    """
+    def __init__(self, db: Engine, key_bytes: bytes, cached: Optional[dict[bytes, tuple[Any, int]]] = None,
+                 compression: Optional[Compression] = None):
+        self.db = db
+        self.compression: Optional[Compression] = compression
+        self.key_bytes: bytes = key_bytes
+        self.cached: dict[bytes, tuple[Any, int]] = cached if cached is not None else {}  # decoded records with their size
+        self.dirty: dict[bytes, Any] = {}     # records to write back on flush
+
+    @staticmethod
+    def node_id(versioned_value: VersionedValue) -> bytes:
+        """Content address of a version, equal versions share the same id."""
+        return hashlib.blake2b(RecordCodec.encode_version(versioned_value), digest_size=16).digest()
+
+    def _encode(self, record: Any) -> bytes:
+        raw = RecordCodec.encode(record)
+        return self.compression.compress(raw) if self.compression else raw
 
-        if os.path.exists(db_path):
-            # Load the existing database
-            print(f"Loading existing database at {db_path}.")
-            self.db = bsddb3.hashopen(db_path, 'w')  # Open in read/write mode
+    def _decode(self, raw: bytes) -> Any:
+        return RecordCodec.decode(self.compression.decompress(raw) if self.compression else raw)
+
+    def _record_key(self, tag: bytes, node_id: bytes = b"") -> bytes:
+        return self.key_bytes + b"\x00" + tag + node_id
+
+    def _load(self, record_key: bytes) -> tuple[Any, int]:
+        """Decoded record and its size, None if missing. Records are only read once."""
+        if record_key not in self.cached:
+            self.preload(record_key, self.db.get(record_key))
+        return self.cached[record_key]
+
+    def preload(self, record_key: bytes, raw: Optional[bytes]) -> None:
+        """Take a record read by the caller, the marker is kept raw and the others decoded."""
+        if record_key == self.key_bytes:
+            self.cached[record_key] = (bytes(raw), len(raw)) if raw is not None else (None, 0)
         else:
-            # Create a new database
-            print(f"Database not found at {db_path}. Creating a new one.")
-            self.db = bsddb3.hashopen(db_path, 'c')  # Create if it doesn't exist
-        self.lock = threading.Lock()
+            self.cached[record_key] = (self._decode(raw), len(raw)) if raw is not None else (None, 0)
+
+    def read_ahead(self) -> list[bytes]:
+        """
+        Keys of the records a write reads first that are not loaded yet: the marker and the leaf
+        record, then once those are loaded, the node and parent records of the leaves.
+        """
+        wanted = [self.key_bytes, self._record_key(b"l"), self._record_key(b"e")]
+        if all(record_key in self.cached for record_key in wanted):
+            if self.marker() != TREE_FORMAT:
+                return []
+            wanted = [self._record_key(tag, leaf) for leaf in self.leaves() - {ROOT_ID} for tag in (b"n", b"p")]
+            wanted.append(self._record_key(b"t"))
+        return [record_key for record_key in wanted if record_key not in self.cached]
+
+    def _get(self, record_key: bytes, default: Any) -> Any:
+        if record_key in self.dirty:
+            record = self.dirty[record_key]
+        else:
+            record = self._load(record_key)[0]
+        return default if record is None else record
+
+    def _set(self, record_key: bytes, record: Any) -> None:
+        self.dirty[record_key] = record
+
+    def _delete(self, record_key: bytes) -> int:
+        """Drop a record, returns the number of bytes it took."""
+        size = self._load(record_key)[1]
+        self.dirty[record_key] = None
+        return size
+
+    def size(self) -> int:
+        """Encoded size of the records held in memory."""
+        return sum(size for _, size in self.cached.values())
+
+    def trim(self) -> None:
+        """Forget the decoded records a read or the next write is unlikely to need, all but the leaves'."""
+        leaves = self.leaves()
+        keep = {READ_VIEW, self.key_bytes, self._record_key(b"l"), self._record_key(b"e"), self._record_key(b"t")} | \
+            {self._record_key(tag, leaf) for leaf in leaves for tag in (b"n", b"c", b"p")}
+        for record_key in [record_key for record_key in self.cached if record_key not in keep]:
+            del self.cached[record_key]
+        self.publish()
+
+    def publish(self) -> None:
+        """
+        Replace the read view of the leaf values and expiry time in a single assignment, so reads
+        without the key's lock never pair the leaves of one write with the expiry time of another.
+        """
+        leaves_key, expires_key = self._record_key(b"l"), self._record_key(b"e")
+        if leaves_key in self.cached and expires_key in self.cached:
+            leaves = self.cached[leaves_key][0]
+            view = (tuple(leaves.values()) if leaves is not None else None, self.cached[expires_key][0])
+            self.cached[READ_VIEW] = (view, 0)
+        else:
+            self.cached.pop(READ_VIEW, None)
+
+    def marker(self) -> Optional[bytes]:
+        """Raw record stored under the key itself, the TREE_FORMAT marker or an old pickled tree."""
+        return self._load(self.key_bytes)[0]
+
+    def has_node(self, node_id: bytes) -> bool:
+        return node_id == ROOT_ID or self._get(self._record_key(b"n", node_id), None) is not None
+
+    def node(self, node_id: bytes) -> str | VersionedValue:
+        if node_id == ROOT_ID:
+            return "root"
+        return self._get(self._record_key(b"n", node_id), None)[0]
+
+    def written_at(self, node_id: bytes) -> float:
+        """Time at which the version was stored on this server."""
+        return self._get(self._record_key(b"n", node_id), None)[1]
+
+    def children(self, node_id: bytes) -> set[bytes]:
+        return set(self._get(self._record_key(b"c", node_id), set()))
+
+    def parents(self, node_id: bytes) -> set[bytes]:
+        return set(self._get(self._record_key(b"p", node_id), set()))
+
+    def leaves(self) -> set[bytes]:
+        return set(self._get(self._record_key(b"l"), {ROOT_ID: "root"}))
+
+    def leaf_values(self) -> set[str | VersionedValue]:
+        return set(self._get(self._record_key(b"l"), {ROOT_ID: "root"}).values())
+
+    def expires(self) -> Optional[float]:
+        return self._get(self._record_key(b"e"), None)
+
+    def expired(self, now: float) -> bool:
+        """Whether the key exists and its TTL ran out."""
+        expires = self.expires()
+        return expires is not None and expires <= now and self.marker() is not None
+
+    def tombstone(self) -> Optional[tuple[VersionedValue, float]]:
+        return self._get(self._record_key(b"t"), None)
+
+    def due(self, grace: float) -> Optional[float]:
+        """Time a sweep has work on the key, expiring it or dropping its tombstone `grace` seconds old, None for never."""
+        times = [self.expires()] if self.marker() is not None and self.expires() is not None else []
+        tombstone = self.tombstone()
+        if tombstone is not None:
+            times.append(tombstone[1] + grace)
+        return min(times, default=None)
+
+    def set_expires(self, expires: Optional[float]) -> None:
+        """Set the time at which the key expires, None for never."""
+        if expires != self.expires():
+            self._set(self._record_key(b"e"), float(expires) if expires is not None else None)
+
+    def set_tombstone(self, clock: VectorClock, expired: float) -> None:
+        """Tombstone stamped with the time the key expired, the same on every replica."""
+        self._set(self._record_key(b"t"), (VersionedValue(None, clock), expired))
+
+    def set_node(self, node_id: bytes, versioned_value: VersionedValue) -> None:
+        self._set(self._record_key(b"n", node_id), (versioned_value, time.time()))
+
+    def set_children(self, node_id: bytes, children: set[bytes]) -> None:
+        self._set(self._record_key(b"c", node_id), children)
+
+    def set_parents(self, node_id: bytes, parents: set[bytes]) -> None:
+        self._set(self._record_key(b"p", node_id), parents)
+
+    def set_leaves(self, leaves: set[bytes]) -> None:
+        self._set(self._record_key(b"l"), {leaf: self.node(leaf) for leaf in leaves})
+
+    def delete_node(self, node_id: bytes) -> int:
+        """Drop a version with its edge lists, returns the number of bytes freed."""
+        return sum(self._delete(self._record_key(tag, node_id)) for tag in (b"n", b"c", b"p"))
+
+    def record_keys(self) -> list[bytes]:
+        """Keys of all the records the key may have, found by walking the tree from the root."""
+        record_keys = [self.key_bytes, self._record_key(b"l"), self._record_key(b"e"), self._record_key(b"t")]
+        visited: set[bytes] = set()
+        stack: list[bytes] = [ROOT_ID]
+        while stack:
+            node_id = stack.pop()
+            if node_id in visited:
+                continue
+            visited.add(node_id)
+            record_keys.append(self._record_key(b"c", node_id))
+            if node_id != ROOT_ID:
+                record_keys += [self._record_key(b"n", node_id), self._record_key(b"p", node_id)]
+            stack.extend(self.children(node_id) - visited)
+        return record_keys
+
+    def collect(self) -> Writes:
+        """Encode the changed records, the leaf record last so it never names a missing version."""
+        leaves_key = self._record_key(b"l")
+        writes: Writes = []
+        for record_key, record in sorted(self.dirty.items(), key=lambda item: item[0] == leaves_key):
+            writes.append((record_key, self._encode(record) if record is not None else None))
+        if self.dirty and self.marker() != TREE_FORMAT:
+            writes.append((self.key_bytes, TREE_FORMAT))
+        return writes
+
+    def written(self, writes: Writes) -> None:
+        """Keep the decoded records of collected writes once they are applied (write-through)."""
+        for record_key, raw in writes:
+            if record_key == self.key_bytes:
+                self.cached[record_key] = (raw, len(raw))
+            else:
+                self.cached[record_key] = (self.dirty[record_key], len(raw)) if raw is not None else (None, 0)
+        self.dirty.clear()
+        self.publish()
+
+    def flush(self, write: Optional[Callable[[Writes], None]] = None) -> Writes:
+        """
+        Write back the changed records with `write`, such as a commit through the write-ahead log,
+        straight to the engine by default. Returns the writes made.
+        """
+        writes = self.collect()
+        if writes:
+            (write or self.db.write_batch)(writes)
+        self.written(writes)
+        return writes
+
+    def migrate(self, write: Optional[Callable[[Writes], None]] = None) -> Writes:
+        """Split a tree stored in the old single-record format into per-node records."""
+        raw = self.marker()
+        if raw is None or raw == TREE_FORMAT:
+            return []
+
+        tree = pickle.loads(raw)
+        ids = {node: (ROOT_ID if node == "root" else self.node_id(node)) for node in tree if node != "leaves"}
+        parents: dict[bytes, set[bytes]] = {}
+        for node, children in tree.items():
+            if node == "leaves":
+                continue
+            if node != "root":
+                self.set_node(ids[node], node)
+            child_ids = {self.node_id(child) for child in children}
+            if child_ids or node == "root":
+                self.set_children(ids[node], child_ids)
+            for child in children:
+                self.set_node(self.node_id(child), child)
+                parents.setdefault(self.node_id(child), set()).add(ids[node])
+        for node_id, parent_ids in parents.items():
+            self.set_parents(node_id, parent_ids)
+        self.set_leaves({ROOT_ID if leaf == "root" else self.node_id(leaf) for leaf in tree["leaves"]})
+        return self.flush(write)
+
+class Storage:
+    def __init__(self, db_path: str, wal: Optional[WriteAheadLog] = None, engine: Optional[str] = None):
+
+        self.db: Engine = open_engine(db_path, engine)
+
+        # Writes to a key are serialized by one lock of a fixed pool picked by key hash,
+        # writes to keys on different locks proceed in parallel
+        self.locks: list[threading.Lock] = [threading.Lock() for _ in range(max(1, config.LOCK_STRIPES))]
+
+        # Decoded records of recently used keys, kept in step with every write
+        self.cache = LRUCache(config.CACHE_ENTRIES, config.CACHE_BYTES)
+
+        # (ring token, key) of every key in ring order, built on the first range scan
+        self.token_index: Optional[SortedSet] = None
+        self.index_lock = threading.Lock()
+
+        # (time due, key) of the keys with a TTL or a tombstone in the order sweeps get to them, built on the first sweep
+        self.expiry_index: Optional[SortedSet] = None
+        self.expiry_due: dict[bytes, float] = {}    # Entry of each key in the expiry index
+        self.expiry_lock = threading.Lock()
+
+        # Merkle trees of the token ranges set by set_ranges, kept in step with every write
+        self.merkle = MerkleRanges()
+
+        # Keys of the running snapshot not read yet, and the records of those written since it started
+        self.frozen_keys: Optional[set[bytes]] = None
+        self.frozen: dict[bytes, Writes] = {}
+        self.snapshot_lock = threading.Lock()   # One snapshot at a time
+
+        # Writes are made durable through the write-ahead log, if any
+        self.db_path: str = db_path
+        self.wal: Optional[WriteAheadLog] = wal
+        if self.wal:
+            self.wal.register(self.db_path, self.db)
+
+        # Records of config.COMPRESSION_THRESHOLD bytes or more are stored compressed,
+        # with the dictionary the log left active
+        self.compression = Compression(self.db, config.COMPRESSION_THRESHOLD, config.COMPRESSION_LEVEL, self._write)
+
+        # Keys untouched for config.COLD_AFTER seconds are moved to memory-mapped segments,
+        # the log replays into the hot engine underneath
+        self.touched: Optional[dict[bytes, float]] = None      # Last read or write of the hot keys
+        self.opened: float = time.time()
+        if config.COLD_AFTER is not None or os.path.isdir(db_path + ".cold"):
+            self.db = TieredEngine(self.db, db_path + ".cold")
+            self.touched = {}
 
     def encode(self, key: str) -> bytes:
         """Convert an integer key to a bytes representation."""
-        return bytes(key, 'utf-8') if isinstance(key, str) else key
+        if isinstance(key, bytes):
+            return key
+        return bytes(key, 'utf-8') if isinstance(key, str) else bytes(str(key), 'utf-8')
 
     @staticmethod
     def compare_versioned_value(v1: str|VersionedValue, v2: VersionedValue) -> str:
@@ -142,117 +1002,759 @@ class Storage:
         """
         if v1 == "root":
             return 'child'
-        
-        if v1.vector_clock < v2.vector_clock:
-            if v1.vector_clock == v2.vector_clock:
-                return "equal"
-            else:
-                return 'child'
-        else:
-            return "sibling"
+
+        order = v1.vector_clock.compare(v2.vector_clock)
+        if order == VectorClock.BEFORE:
+            return 'child'
+        return "equal" if order == VectorClock.EQUAL else "sibling"
     
-    def _load_tree(self, key: bytes) -> dict[str| VersionedValue , set[VersionedValue]]:
-        """Load the adjacency list for a given key from Berkeley DB"""
-        if key in self.db:
-            return pickle.loads(self.db[key])
+    def _commit(self, writes: Writes, db: Engine) -> None:
+        """Apply writes to an engine once they are durable in the write-ahead log, if any."""
+        if not writes:
+            return
+        if self.wal:
+            self.wal.commit(self.db_path, writes, db)
         else:
-            # Initialize an empty adjacency list with a root node
-            return {"root": set(), "leaves": {"root"}}
+            db.write_batch(writes)
+
+    def _write(self, writes: Writes, thaw: list[bytes] = ()) -> None:
+        """
+        Commit writes, moving the keys of `thaw` back to the hot engine first if they are cold.
+        Called holding the locks of the keys written: concurrent writers of other keys share the fsync.
+        """
+        self._commit(self._thawed(thaw) + writes, self.db)
 
-    def add_version(self, key: str, value: Any ,context: VectorClock) -> None:
-        """Add a new versioned value to the version tree for the given key."""
+    def _lock(self, key_bytes: bytes) -> threading.Lock:
+        """Lock guarding the records of a key."""
+        return self.locks[hash(key_bytes) % len(self.locks)]
+
+    @contextmanager
+    def _locked(self, keys_bytes: list[bytes]) -> Iterator[None]:
+        """Hold the locks of several keys, taken in pool order so batches cannot deadlock."""
+        stripes = sorted({hash(key_bytes) % len(self.locks) for key_bytes in keys_bytes})
+        for stripe in stripes:
+            self.locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self.locks[stripe].release()
+
+    def _touch(self, keys_bytes: list[bytes]) -> None:
+        """
+        Note a read or write of keys, keeping them out of cold segments for config.COLD_AFTER seconds.
+        Only keys that exist are noted, reads of missing keys would fill self.touched for nothing.
+        """
+        if self.touched is not None:
+            now = time.time()
+            for key_bytes in keys_bytes:
+                self.touched[key_bytes] = now
+
+    def _thawed(self, keys_bytes: list[bytes]) -> Writes:
+        """Records of the cold keys about to be written, logged with the write that moves them back to the hot engine."""
+        if not isinstance(self.db, TieredEngine):
+            return []
+        return [record for key_bytes in keys_bytes for record in self.db.cold.records(key_bytes)]
+
+    def _records(self, key_bytes: bytes, cached: bool = True) -> TreeRecords:
+        """
+        Record view of the version tree of a key, upgrading old single-record trees.
+        Cached views share their decoded records with the cache and must be used holding the key's lock.
+        The cache is peeked at: reads count their hit or miss in _cached_leaves, writes do not count.
+        """
+        records = TreeRecords(self.db, key_bytes, self.cache.peek(key_bytes) if cached else None, self.compression)
+        records.migrate(self._write)
+        return records
+
+    def _records_many(self, keys_bytes: list[bytes], leaves_only: bool = False) -> dict[bytes, TreeRecords]:
+        """
+        Record views of several keys, the records missing from the cache are read in one engine
+        call per round: markers and leaf records, then unless `leaves_only` the leaves' records.
+        """
+        records = {key_bytes: TreeRecords(self.db, key_bytes, self.cache.peek(key_bytes), self.compression)
+                   for key_bytes in keys_bytes}
+        for _ in range(1 if leaves_only else 2):
+            wanted = {record_key: view for view in records.values() for record_key in view.read_ahead()}
+            if wanted:
+                for record_key, raw in self.db.get_many(list(wanted)).items():
+                    wanted[record_key].preload(record_key, raw)
+        for view in records.values():
+            view.migrate(self._write)
+        return records
+
+    def _remember(self, records: TreeRecords) -> None:
+        """(Re)insert the decoded records of the leaves of a key into the cache."""
+        records.trim()
+        self.cache.put(records.key_bytes, records.cached, records.size())
+
+    def _load_tree(self, key_bytes: bytes) -> dict[str| VersionedValue , set[VersionedValue]]:
+        """Assemble the adjacency list for a given key from its node records"""
+        records = self._records(key_bytes, cached=False)
+        tree: dict[str | VersionedValue, set[VersionedValue]] = {"root": set()}
+        tree["leaves"] = records.leaf_values()
+
+        visited: set[bytes] = set()
+        stack: list[bytes] = [ROOT_ID]
+        while stack:
+            node_id = stack.pop()
+            if node_id in visited:
+                continue
+            visited.add(node_id)
+
+            children = records.children(node_id)
+            if children:
+                tree[records.node(node_id)] = {records.node(child) for child in children}
+            stack.extend(children - visited)
+
+        return tree
+
+    def add_version(self, key: str, value: Any ,context: VectorClock, expires: Optional[float] = None) -> None:
+        """
+        Add a new versioned value to the version tree for the given key.
+        The key expires at `expires`, never if None, until a later version sets another time.
+        """
         key_bytes = self.encode(key)
         version_value = VersionedValue(value, context)
 
-        with self.lock:
-            tree = self._load_tree(key_bytes)
+        with self._lock(key_bytes):
+            records = self._records(key_bytes)
+            if records.expired(time.time()):
+                self._expire([records])
+                records = self._records(key_bytes)
+            new_key = records.marker() is None
+            if not self._insert(records, version_value):
+                return  # Duplicate version, or older than the key's tombstone
+            records.set_expires(expires)
+            self._touch([key_bytes])
 
-            # Determine the parents for the new version
-            last_parent: str | VersionedValue  = "root"
+            if config.GC_MODE == "inline":
+                self._compact(records, config.GC_GENERATIONS, config.GC_WINDOW)
 
-            parents:  set[str | VersionedValue] = set()
-            children: set[str | VersionedValue] = set()
+            # Save the changed records
+            self._preserve(key_bytes)
+            records.flush(lambda writes: self._write(writes, [key_bytes]))
+            self._remember(records)
+            if new_key:
+                self._index_keys([key_bytes])
+            self._digest(records)
+            self._schedule(key_bytes, records.due(config.TOMBSTONE_GRACE))
 
-            # Start from root's children
-            visited: set[str | VersionedValue] = set()
-            stack: list[str | VersionedValue] = list(tree.get("root", set()))
+    def multi_put(self, versions: list[tuple]) -> None:
+        """
+        Add several (key, value, context) or (key, value, context, expires) versions, in order, as one
+        engine batch and one log entry. The locks of all the keys are held together and the records
+        missing from the cache are read ahead for all the keys at once.
+        """
+        prepared = [(self.encode(version[0]), VersionedValue(version[1], version[2]), version[3] if len(version) > 3 else None)
+                    for version in versions]
+        keys_bytes = list(dict.fromkeys(key_bytes for key_bytes, _, _ in prepared))
 
-            while stack:
-                node = stack.pop()
+        with self._locked(keys_bytes):
+            records = self._records_many(keys_bytes)
+            now = time.time()
+            expired = [key_bytes for key_bytes in keys_bytes if records[key_bytes].expired(now)]
+            if expired:
+                self._expire([records[key_bytes] for key_bytes in expired])
+                records.update(self._records_many(expired))
+            new_keys = [key_bytes for key_bytes in keys_bytes if records[key_bytes].marker() is None]
+            changed = []
+            for key_bytes, version_value, expires in prepared:
+                if self._insert(records[key_bytes], version_value):
+                    records[key_bytes].set_expires(expires)
+                    changed.append(key_bytes)
+            changed = list(dict.fromkeys(changed))
+            self._touch(changed)
+            if config.GC_MODE == "inline":
+                for key_bytes in changed:
+                    self._compact(records[key_bytes], config.GC_GENERATIONS, config.GC_WINDOW)
 
-                if node in visited:
-                    continue  # Skip nodes that have been fully processed
-                visited.add(node)
+            for key_bytes in changed:
+                self._preserve(key_bytes)
+            collected = {key_bytes: records[key_bytes].collect() for key_bytes in changed}
+            self._write([write for key_writes in collected.values() for write in key_writes], changed)
+            for key_bytes, key_writes in collected.items():
+                records[key_bytes].written(key_writes)
+                self._remember(records[key_bytes])
+                self._digest(records[key_bytes])
+                self._schedule(key_bytes, records[key_bytes].due(config.TOMBSTONE_GRACE))
+            self._index_keys([key_bytes for key_bytes in new_keys if key_bytes in collected])
 
-                # Add the last parent when you leave the subtree of the last parent
-                if not self.compare_versioned_value(last_parent, node)=='child':
-                    parents.add(last_parent)
+    def _insert(self, records: TreeRecords, version_value: VersionedValue) -> bool:
+        """
+        Link a new version into the tree records, returns False if it is already there or the
+        key's tombstone descends from it.
+        The walk starts from the leaves and only goes down while nodes are not ancestors
+        of the new version, so a put that supersedes the leaves reads and writes O(leaves)
+        records whatever the length of the history.
+        """
+        version_id = TreeRecords.node_id(version_value)
+        if records.has_node(version_id):
+            return False
+        tombstone = records.tombstone()
+        if tombstone is not None and version_value.vector_clock < tombstone[0].vector_clock:
+            return False    # Written before the key expired
 
-                # Finding the deepest parent or 
-                if self.compare_versioned_value(node, version_value) == "child":
-                    last_parent = node
-                elif self.compare_versioned_value(version_value, node) == "child":
-                    children.add(node)
+        leaves = records.leaves()
 
-                # Only push children of the current node if it hasn't already been explored
-                stack.extend(tree.get(node, set()) - visited)
+        # Order of the nodes against the new version, each compared once for both walks
+        orders: dict[bytes, int] = {ROOT_ID: VectorClock.BEFORE}
+        def order(node_id: bytes) -> int:
+            if node_id not in orders:
+                orders[node_id] = records.node(node_id).vector_clock.compare(version_value.vector_clock)
+            return orders[node_id]
 
-            # Adding last_parent in case of edge case
-            parents.add(last_parent)
-            
-            # Cleaning of parents and children
-            cleaned = set()
-            for child in children:
-                # child shouldn't be child of any other child
-                if all(self.compare_versioned_value(other, child) != "child" for other in children - {child}):
-                    cleaned.add(child)
-            children = cleaned
-
-            cleaned = set()
-            for parent in parents:
-                # parent shouldn't be parent of any other parent
-                if all(self.compare_versioned_value(parent, other) != "child" for other in parents - {parent}):
-                    cleaned.add(parent)
-            parents = cleaned
-
-            # Add the new version and adjust parent-child links
-            for parent in parents:
-                tree.setdefault(parent, set()).add(version_value)
-                # Remove existing child links from parents to children
-                for child in children:
-                    tree[parent].discard(child)
-
-            # Update leaves
-            for parent in parents:
-                tree["leaves"].discard(parent)  # Remove any non-leaves
-            if not children:
-                tree["leaves"].add(version_value)  # Only add as a leaf if it has no children
+        # Children: the oldest versions that descend from the new one.
+        # Only nodes above a leaf can descend from it, so walk down from those leaves.
+        children: set[bytes] = set()
+        visited: set[bytes] = set()
+        stack: list[bytes] = [leaf for leaf in leaves if order(leaf) == VectorClock.AFTER]
+        while stack:
+            node_id = stack.pop()
+            if node_id in visited:
+                continue
+            visited.add(node_id)
+
+            descendants = [parent for parent in records.parents(node_id) if order(parent) == VectorClock.AFTER]
+            if not descendants:
+                children.add(node_id)
+            stack.extend(descendants)
+
+        # Parents: the newest ancestors of the new version, found on the way down from the leaves
+        parents: set[bytes] = set()
+        visited = set()
+        stack = list(leaves)
+        while stack:
+            node_id = stack.pop()
+            if node_id in visited:
+                continue
+            visited.add(node_id)
+
+            if order(node_id) == VectorClock.BEFORE:
+                parents.add(node_id)
             else:
-                tree[version_value] = children # Add the children to new node
+                stack.extend(records.parents(node_id) - visited)
+
+        # parent shouldn't be parent of any other parent
+        parents = self._newest(records, parents)
 
-            # Save the updated tree
-            self.db[key_bytes] = pickle.dumps(tree)
+        # Add the new version and adjust parent-child links
+        for parent in parents:
+            records.set_children(parent, (records.children(parent) - children) | {version_id})
+        for child in children:
+            records.set_parents(child, (records.parents(child) - parents) | {version_id})
+
+        records.set_node(version_id, version_value)
+        records.set_parents(version_id, parents)
+        if children:
+            records.set_children(version_id, children)
+
+        # Update leaves, only add as a leaf if it has no children
+        leaves -= parents
+        if not children:
+            leaves.add(version_id)
+        records.set_leaves(leaves)
+        return True
+
+    @staticmethod
+    def _newest(records: TreeRecords, node_ids: set[bytes]) -> set[bytes]:
+        """The nodes that are no ancestor of another one of the set, the root only if it is alone."""
+        if len(node_ids) < 2:
+            return set(node_ids)
+        clocks = {node_id: records.node(node_id).vector_clock for node_id in node_ids - {ROOT_ID}}
+        ordered = list(clocks)
+        ancestors = set()
+        for i, node_id in enumerate(ordered):
+            for other in ordered[i + 1:]:
+                order = clocks[node_id].compare(clocks[other])
+                if order == VectorClock.BEFORE:
+                    ancestors.add(node_id)
+                elif order == VectorClock.AFTER:
+                    ancestors.add(other)
+        return set(ordered) - ancestors
+
+    def _compact(self, records: TreeRecords, generations: Optional[int], window: Optional[float]) -> int:
+        """
+        Drop the ancestors that fall outside the retention policy, returns the bytes reclaimed.
+        A version is kept if it is a leaf, at most `generations` edges below a leaf or written
+        within the last `window` seconds. Kept versions whose parents were dropped are relinked
+        to their newest kept ancestors, or to the root.
+        """
+        if generations is None and window is None:
+            return 0
+
+        now = time.time()
+        kept: set[bytes] = set()
+        dropped: set[bytes] = set()
+
+        # Walk down from the leaves one generation at a time
+        depth = 0
+        visited: set[bytes] = set()
+        level: set[bytes] = records.leaves() - {ROOT_ID}
+        while level:
+            visited |= level
+            for node_id in level:
+                if depth == 0 or (generations is not None and depth <= generations) or \
+                        (window is not None and now - records.written_at(node_id) <= window):
+                    kept.add(node_id)
+                else:
+                    dropped.add(node_id)
+            level = set().union(*(records.parents(node_id) for node_id in level)) - visited - {ROOT_ID}
+            depth += 1
+
+        if not dropped:
+            return 0
+
+        reclaimed = 0
+        root_children = records.children(ROOT_ID) - dropped
+        for node_id in kept:
+            parents = records.parents(node_id)
+            if parents & dropped:
+                # Newest kept ancestors reachable through dropped versions
+                candidates: set[bytes] = set()
+                stack = list(parents)
+                seen: set[bytes] = set()
+                while stack:
+                    parent = stack.pop()
+                    if parent in seen:
+                        continue
+                    seen.add(parent)
+                    if parent in dropped:
+                        stack.extend(records.parents(parent))
+                    else:
+                        candidates.add(parent)
+
+                parents = self._newest(records, candidates)
+                records.set_parents(node_id, parents)
+                for parent in parents - {ROOT_ID}:
+                    records.set_children(parent, records.children(parent) | {node_id})
+                if ROOT_ID in parents:
+                    root_children.add(node_id)
+
+            children = records.children(node_id)
+            if children & dropped:
+                records.set_children(node_id, children - dropped)
+
+        records.set_children(ROOT_ID, root_children)
+        for node_id in dropped:
+            reclaimed += records.delete_node(node_id)
+
+        return reclaimed
+
+    def compact(self, key: str, generations: Optional[int] = None, window: Optional[float] = None) -> int:
+        """
+        Garbage collect the version tree of a key, returns the bytes reclaimed.
+        The retention policy defaults to config.GC_GENERATIONS and config.GC_WINDOW.
+        """
+        if generations is None and window is None:
+            generations, window = config.GC_GENERATIONS, config.GC_WINDOW
+
+        key_bytes = self.encode(key)
+        with self._lock(key_bytes):
+            if not self.db.has_key(key_bytes):
+                return 0
+            records = self._records(key_bytes)
+            reclaimed = self._compact(records, generations, window)
+            self._preserve(key_bytes)
+            records.flush(lambda writes: self._write(writes, [key_bytes]))
+            self._remember(records)
+        return reclaimed
+
+    def keys(self) -> list[str]:
+        """All keys held in the storage."""
+        return [record_key.decode('utf-8') for record_key in self.db.keys() if b"\x00" not in record_key]
+
+    def empty(self) -> bool:
+        """Whether the storage holds no key."""
+        return not any(b"\x00" not in record_key for record_key in self.db.keys())
+
+    def _index_keys(self, keys_bytes: list[bytes]) -> None:
+        """Enter new keys in the token index, if it is built."""
+        with self.index_lock:
+            if self.token_index is not None:
+                self.token_index.update((key_token(key_bytes.decode('utf-8')), key_bytes) for key_bytes in keys_bytes)
+
+    def _unindex_keys(self, keys_bytes: list[bytes]) -> None:
+        """Remove deleted keys from the token index, if it is built."""
+        with self.index_lock:
+            if self.token_index is not None:
+                self.token_index.difference_update((key_token(key_bytes.decode('utf-8')), key_bytes) for key_bytes in keys_bytes)
+
+    def _schedule(self, key_bytes: bytes, due: Optional[float]) -> None:
+        """Move a key to the time a sweep has work on it in the expiry index, if it is built, None to take it out."""
+        with self.expiry_lock:
+            if self.expiry_index is None:
+                return
+            previous = self.expiry_due.pop(key_bytes, None)
+            if previous is not None:
+                self.expiry_index.discard((previous, key_bytes))
+            if due is not None:
+                self.expiry_due[key_bytes] = due
+                self.expiry_index.add((due, key_bytes))
+
+    def _expiry_index(self, chunk: int = 256) -> SortedSet:
+        """The expiry index, built from the TTL and tombstone records on first use. Called holding self.expiry_lock."""
+        if self.expiry_index is None:
+            keys_bytes = sorted({record_key.partition(b"\x00")[0] for record_key in self.db.keys()
+                                 if record_key.partition(b"\x00")[2] in (b"e", b"t")} - {b""})
+            due: dict[bytes, float] = {}
+            for i in range(0, len(keys_bytes), chunk):
+                views = {key_bytes: TreeRecords(self.db, key_bytes, compression=self.compression) for key_bytes in keys_bytes[i:i + chunk]}
+                wanted = [record_key for key_bytes in views for record_key in (key_bytes, key_bytes + b"\x00e", key_bytes + b"\x00t")]
+                for record_key, raw in self.db.get_many(wanted).items():
+                    views[record_key.partition(b"\x00")[0]].preload(record_key, raw)
+                due.update((key_bytes, view.due(config.TOMBSTONE_GRACE)) for key_bytes, view in views.items())
+            self.expiry_due = {key_bytes: when for key_bytes, when in due.items() if when is not None}
+            self.expiry_index = SortedSet((when, key_bytes) for key_bytes, when in self.expiry_due.items())
+        return self.expiry_index
+
+    def _token_index(self) -> SortedSet:
+        """The token index, built from the keys of the database on first use. Called holding self.index_lock."""
+        if self.token_index is None:
+            self.token_index = SortedSet((key_token(key), self.encode(key)) for key in self.keys())
+        return self.token_index
+
+    def rehash(self) -> None:
+        """Forget the token index and Merkle trees, after the ring switched key hash functions."""
+        with self.index_lock:
+            self.token_index = None
+        self.merkle.replace([], config.MERKLE_DEPTH)
+
+    def keys_in_range(self, start: int, end: int, chunk: int = 256) -> Iterator[str]:
+        """
+        Lazily list the keys whose ring token is in (start, end], in ring order, wrapping around
+        the ring when start >= end. The index is read `chunk` keys at a time so writes go on
+        while a range is streamed, keys created meanwhile may or may not be listed.
+        """
+        spans = [(start, end)] if start < end else [(start, config.Q), (-1, end)]
+        for low, high in spans:
+            position, inclusive = (low + 1,), True
+            while True:
+                with self.index_lock:
+                    batch = list(islice(self._token_index().irange(position, (high + 1,), inclusive=(inclusive, False)), chunk))
+                if not batch:
+                    break
+                for _, key_bytes in batch:
+                    yield key_bytes.decode('utf-8')
+                position, inclusive = batch[-1], False
+
+    def scan(self, start: int, end: int, chunk: int = 256) -> Iterator[tuple[str, set[VersionedValue]]]:
+        """Lazily stream the (key, leaf nodes) of the token range (start, end], reading `chunk` keys per batch."""
+        keys = self.keys_in_range(start, end, chunk)
+        while True:
+            batch = list(islice(keys, chunk))
+            if not batch:
+                return
+            leaves = self.multi_get(batch)
+            for key in batch:
+                if leaves[key] is not None:
+                    yield key, leaves[key]
+
+    def _digest(self, records: TreeRecords, tree: Optional[MerkleTree] = None) -> None:
+        """
+        Refresh the digest of a key in the Merkle tree of its range, called holding the key's lock.
+        A key digests to the hash of its leaf ids, replicas holding the same versions agree on it.
+        """
+        if tree is None and not self.merkle.trees:
+            return
+        key_bytes = records.key_bytes
+        token = key_token(key_bytes.decode('utf-8'))
+        tree = tree or self.merkle.tree_for(token)
+        if tree is None:
+            return
+        leaves = records.leaves() if records.marker() is not None else {ROOT_ID}
+        digest = None
+        if leaves != {ROOT_ID}:
+            digest = int.from_bytes(hashlib.blake2b(key_bytes + b"".join(sorted(leaves)), digest_size=16).digest(), 'big')
+        tree.set(key_bytes, token, digest)
+
+    def set_ranges(self, ranges: list[tuple[int, int]], chunk: int = 256) -> list[tuple[int, int]]:
+        """
+        Keep a Merkle tree for each of the token ranges (start, end], usually the ones whose preference
+        list holds this server. Trees of ranges already held are kept, the others are built from the
+        keys in their range while writes go on. Returns the ranges built.
+        """
+        created = self.merkle.replace(ranges, config.MERKLE_DEPTH)
+        for tree in created:
+            keys = self.keys_in_range(tree.start, tree.end, chunk)
+            while True:
+                batch = [self.encode(key) for key in islice(keys, chunk)]
+                if not batch:
+                    break
+                with self._locked(batch):
+                    for records in self._records_many(batch, leaves_only=True).values():
+                        self._digest(records, tree)
+        return [(tree.start, tree.end) for tree in created]
+
+    def merkle_tree(self, start: int, end: int) -> Optional[MerkleTree]:
+        """Merkle tree of a token range set by set_ranges, its root and subtree hashes are read in O(1)."""
+        return self.merkle.trees.get((start, end))
+
+    def _raw_records(self, key_bytes: bytes) -> Writes:
+        """Every record of a key as stored, sorted by record key. Called holding the key's lock."""
+        records = TreeRecords(self.db, key_bytes, compression=self.compression)
+        marker = records.marker()
+        if marker is None:
+            return []
+        if marker != TREE_FORMAT:
+            return [(key_bytes, marker)]   # Old single-record tree
+
+        record_keys = records.record_keys()
+        return sorted((record_key, raw) for record_key, raw in self.db.get_many(record_keys).items() if raw is not None)
+
+    def meta_records(self) -> Writes:
+        """Records that belong to no key, such as compression dictionaries, sorted by record key."""
+        return sorted((record_key, self.db[record_key]) for record_key in self.db.keys() if record_key.startswith(b"\x00"))
+
+    def train_compression(self, samples: Optional[list[bytes]] = None, keys: int = 1000) -> int:
+        """
+        Train a preset dictionary on sample values, by default the leaf values of up to `keys`
+        keys, and compress new records with it. Returns the dictionary id.
+        """
+        if samples is None:
+            samples = [str(leaf.value).encode('utf-8')
+                       for leaves in self.multi_get(list(islice(self.keys(), keys))).values() if leaves
+                       for leaf in leaves]
+        return self.compression.add_dictionary(train_dictionary(samples, config.COMPRESSION_DICTIONARY_SIZE))
+
+    def _preserve(self, key_bytes: bytes) -> None:
+        """Save the records of a key the running snapshot has not read yet, before a write changes them."""
+        if self.frozen_keys is not None and key_bytes in self.frozen_keys and key_bytes not in self.frozen:
+            self.frozen[key_bytes] = self._raw_records(key_bytes)
+
+    def freeze(self, on_freeze: Optional[Callable[[], None]] = None) -> list[bytes]:
+        """
+        Start a point-in-time snapshot, returns its keys in order for read_frozen.
+        Writes go on: a write saves the records of a key the snapshot has not read yet before changing
+        them (copy on write). `on_freeze` runs while no write is in flight, for other databases to take
+        their part of the snapshot. Every freeze must be followed by thaw.
+        """
+        self.snapshot_lock.acquire()
+        with ExitStack() as stack:
+            for lock in self.locks:
+                stack.enter_context(lock)
+            keys = sorted(record_key for record_key in self.db.keys() if b"\x00" not in record_key)
+            self.frozen_keys, self.frozen = set(keys), {}
+            if on_freeze:
+                on_freeze()
+        return keys
+
+    def read_frozen(self, key_bytes: bytes) -> Writes:
+        """Records of a key of the running snapshot as of when it started."""
+        with self._lock(key_bytes):
+            self.frozen_keys.discard(key_bytes)
+            saved = self.frozen.pop(key_bytes, None)
+            return saved if saved is not None else self._raw_records(key_bytes)
+
+    def thaw(self) -> None:
+        """End the running snapshot."""
+        self.frozen_keys, self.frozen = None, {}
+        self.snapshot_lock.release()
+
+    def bulk_loaded(self) -> None:
+        """Forget everything derived from the records after they were written directly to the engine."""
+        self.cache.clear()
+        self.compression = Compression(self.db, config.COMPRESSION_THRESHOLD, config.COMPRESSION_LEVEL, self._write)
+        with self.index_lock:
+            self.token_index = None
+        with self.expiry_lock:
+            self.expiry_index, self.expiry_due = None, {}
+        ranges = list(self.merkle.trees)
+        self.merkle.replace([], config.MERKLE_DEPTH)
+        self.set_ranges(ranges)
+
+    def compact_all(self, generations: Optional[int] = None, window: Optional[float] = None) -> dict[str, int]:
+        """Garbage collect every key, returns the bytes reclaimed per key that shrank."""
+        reclaimed = {}
+        for key in self.keys():
+            freed = self.compact(key, generations, window)
+            if freed:
+                reclaimed[key] = freed
+        return reclaimed
+
+    def _expire(self, expired: list[TreeRecords]) -> None:
+        """Replace the records of expired keys by tombstones in one commit, called holding the keys' locks."""
+        self._write([write for records in expired for write in self._tombstone(records)],
+                    [records.key_bytes for records in expired])
+        for records in expired:
+            self._expired(records)
+
+    def _tombstone(self, records: TreeRecords) -> Writes:
+        """
+        Writes replacing the records of an expired key by a tombstone whose clock merges the clocks
+        of its leaves, so replicas drop the versions written before it expired. Its clock is never
+        truncated: a dropped entry would let the versions it covers come back. Called holding the
+        key's lock, _expired follows once they are committed.
+        """
+        key_bytes = records.key_bytes
+        clock = VectorClock()
+        for leaf in records.leaf_values() - {"root"}:
+            clock.merge(leaf.vector_clock, truncate=False)
+        tombstone = records.tombstone()
+        if tombstone is not None:
+            clock.merge(tombstone[0].vector_clock, truncate=False)
+
+        self._preserve(key_bytes)
+        records.set_tombstone(clock, records.expires())
+        return [(record_key, None) for record_key, _ in self._raw_records(key_bytes)] + records.collect()
+
+    def _expired(self, records: TreeRecords) -> None:
+        """Forget what was derived from the records of a key replaced by its tombstone."""
+        key_bytes = records.key_bytes
+        self.cache.pop(key_bytes)
+        if self.touched is not None:
+            self.touched.pop(key_bytes, None)
+        self._unindex_keys([key_bytes])
+        self._digest(TreeRecords(self.db, key_bytes, compression=self.compression))
+        self._schedule(key_bytes, records.tombstone()[1] + config.TOMBSTONE_GRACE)
+
+    def sweep(self, rate: Optional[float] = None, chunk: int = 100, now: Optional[float] = None) -> tuple[list[str], list[str]]:
+        """
+        One pass over the keys due in the expiry index: expire the keys whose time has come and drop
+        the tombstones older than config.TOMBSTONE_GRACE. At most `rate` keys, config.TTL_SWEEP_RATE
+        by default, are checked per second, `chunk` at a time, so the sweep leaves I/O to requests.
+        Returns the keys expired and the keys whose tombstone was dropped, which are gone for good.
+        """
+        rate = config.TTL_SWEEP_RATE if rate is None else rate
+        with self.expiry_lock:
+            current = time.time() if now is None else now
+            keys_bytes = [key_bytes for _, key_bytes in takewhile(lambda entry: entry[0] <= current, self._expiry_index())]
+
+        expired: list[str] = []
+        collected: list[str] = []
+        for i in range(0, len(keys_bytes), chunk):
+            started = time.perf_counter()
+            batch_keys = keys_bytes[i:i + chunk]
+            writes: Writes = []
+            written: list[bytes] = []
+            tombstoned: list[TreeRecords] = []
+            dropped: list[TreeRecords] = []
+            with self._locked(batch_keys):
+                current = time.time() if now is None else now
+                for key_bytes, records in self._records_many(batch_keys, leaves_only=True).items():
+                    if records.expired(current):
+                        writes += self._tombstone(records)
+                        written.append(key_bytes)
+                        tombstoned.append(records)
+                        expired.append(key_bytes.decode('utf-8'))
+                        continue
+                    tombstone = records.tombstone()
+                    if tombstone is not None and current - tombstone[1] >= config.TOMBSTONE_GRACE:
+                        self._preserve(key_bytes)
+                        writes.append((key_bytes + b"\x00t", None))
+                        written.append(key_bytes)
+                        dropped.append(records)
+                        if records.marker() is None:
+                            collected.append(key_bytes.decode('utf-8'))
+                    else:
+                        self._schedule(key_bytes, records.due(config.TOMBSTONE_GRACE))
+
+                # One commit for the chunk, then what derives from the records
+                self._write(writes, written)
+                for records in tombstoned:
+                    self._expired(records)
+                for records in dropped:
+                    self.cache.pop(records.key_bytes)
+                    self._schedule(records.key_bytes, records.expires() if records.marker() is not None else None)
+            if rate:
+                time.sleep(max(0.0, len(batch_keys) / rate - (time.perf_counter() - started)))
+        return expired, collected
+
+    def demote_cold(self, idle: Optional[float] = None) -> int:
+        """
+        Move the keys no read or write touched for `idle` seconds, config.COLD_AFTER by default, to
+        memory-mapped cold segments of config.COLD_SEGMENT_KEYS keys. Their records leave the hot
+        engine and the cache, reads of cold keys are served from the page cache and the next write
+        to one moves it back. Returns the number of keys moved.
+        """
+        if not isinstance(self.db, TieredEngine):
+            return 0
+        cutoff = time.time() - (config.COLD_AFTER if idle is None else idle)
+        idle_keys = [record_key for record_key in self.db.hot.keys()
+                     if b"\x00" not in record_key and self.touched.get(record_key, self.opened) <= cutoff]
+
+        moved = 0
+        for i in range(0, len(idle_keys), config.COLD_SEGMENT_KEYS):
+            chunk = idle_keys[i:i + config.COLD_SEGMENT_KEYS]
+            with self._locked(chunk):
+                keys = {key_bytes: self._raw_records(key_bytes) for key_bytes in chunk
+                        if self.touched.get(key_bytes, self.opened) <= cutoff}
+                keys = {key_bytes: records for key_bytes, records in keys.items() if records}
+                if not keys:
+                    continue
+                # The segment is on disk before the deletions of the hot records are committed
+                self.db.demote(keys, lambda deletions: self._commit(deletions, self.db.hot))
+                for key_bytes in keys:
+                    self.cache.pop(key_bytes)
+                    self.touched.pop(key_bytes, None)
+            moved += len(keys)
+        return moved
+
+    def _cached_leaves(self, key_bytes: bytes) -> Optional[set[VersionedValue]]:
+        """Leaf nodes of a key from the cache. Hits need no lock, they read the read view writers replace whole."""
+        cached = self.cache.get(key_bytes)
+        view = cached.get(READ_VIEW) if cached is not None else None
+        if view is not None:
+            leaves, expires = view[0]
+            if leaves is not None and (expires is None or expires > time.time()):
+                return set(leaves)
+        return None
 
     def get_leaf_nodes(self, key: str) -> Optional[set[VersionedValue]]:
-        """Retrieve the leaf nodes for the given key."""
+        """Retrieve the leaf nodes for the given key, from the leaf record alone."""
         key_bytes = self.encode(key)
+        leaves = self._cached_leaves(key_bytes)
+        if leaves is not None:
+            self._touch([key_bytes])
+            return leaves
 
-        if self.db.has_key(key_bytes):
-            tree = self._load_tree(key_bytes)
-            return tree["leaves"]
-        else:
-            return None
+        with self._lock(key_bytes):
+            if not self.db.has_key(key_bytes):
+                return None
+            records = self._records(key_bytes)
+            if records.expired(time.time()):
+                return None
+            leaves = records.leaf_values()
+            self._remember(records)
+            self._touch([key_bytes])
+            return leaves
+
+    def multi_get(self, keys: list[str]) -> dict[str, Optional[set[VersionedValue]]]:
+        """Leaf nodes of several keys like get_leaf_nodes, the keys missing from the cache are read in one engine call."""
+        results: dict[str, Optional[set[VersionedValue]]] = {}
+        missing: dict[bytes, str] = {}
+        keys_bytes = [self.encode(key) for key in keys]
+        for key, key_bytes in zip(keys, keys_bytes):
+            leaves = self._cached_leaves(key_bytes)
+            if leaves is not None:
+                results[key] = leaves
+            else:
+                missing[key_bytes] = key
+
+        if missing:
+            with self._locked(list(missing)):
+                for key_bytes, records in self._records_many(list(missing), leaves_only=True).items():
+                    if records.marker() is None or records.expired(time.time()):
+                        results[missing[key_bytes]] = None
+                        continue
+                    results[missing[key_bytes]] = records.leaf_values()
+                    self._remember(records)
+        self._touch([key_bytes for key, key_bytes in zip(keys, keys_bytes) if results[key] is not None])
+        return results
 
     def get_version_tree(self, key: str) -> dict[str |VersionedValue, set[VersionedValue]]:
         """Retrieve the full version tree for the given key."""
         key_bytes = self.encode(key)
-        return self._load_tree(key_bytes)
+        with self._lock(key_bytes):
+            tree = self._load_tree(key_bytes)
+            if tree["leaves"] != {"root"}:
+                self._touch([key_bytes])
+            return tree
 
     def exists(self, key: str) -> bool:
         """Checks wether we've key or not"""
         key_bytes = self.encode(key)
-        return self.db.has_key(key_bytes)
+        return key_bytes in self.cache or self.db.has_key(key_bytes)
 
     def close(self):
         """Close the database"""
-        self.db.close()
\ No newline at end of file
+        self.db.close()
@@ -73,7 +73,7 @@ class Switch:
                     break
 
                 message: Message = Message.deserialize(response)
-                if message.msg_type in {MessageType.GOSSIP_REQ, MessageType.GOSSIP_RES}:
+                if message.msg_type in {MessageType.GOSSIP_REQ, MessageType.GOSSIP_RES, MessageType.GOSSIP_DELTA}:
                     logging.debug(f"Received Message: {message}")
                 else:
                     logging.info(f"Received Message: {message}")
@@ -1,8 +1,24 @@
 import unittest
 import os
+import pickle
 import threading
 import random
-from storage import VectorClock, VersionedValue, Storage
+import time
+import json
+import hashlib
+import zlib
+import struct
+import shutil
+from storage import READ_VIEW, VectorClock, VersionedValue, Storage, KeyVersion, RecordCodec
+from wal import WriteAheadLog, HEADER
+from engine import LogEngine, LsmEngine, MemoryEngine, remove_database
+from cache import LRUCache
+from cold import ColdStore
+from compression import ACTIVE_KEY, Compression, train_dictionary
+from snapshot import export_snapshot, load_snapshot, CHUNK
+from ring import Ring, VirtualNode, key_token, use_ring
+from merkle import MerkleTree, MerkleRanges, in_range
+from failure import PhiAccrualDetector
 from operation import Operation
 from message import Message, MessageType
 from config import config
@@ -81,15 +97,65 @@ class TestVectorClock(unittest.TestCase):
         vc.from_dict(initial_data)
         self.assertEqual(vc.to_dict(), initial_data)
 
+    def test_truncation(self):
+        # The least recently updated entries are dropped past the cap, stamps do not take part in comparisons
+        truncations = VectorClock.stats()["truncations"]
+        vc = VectorClock({"server1": [5, 100.0], "server2": [1, 300.0], "server3": [7, 200.0]})
+        self.assertEqual(vc.truncate(2), 1)
+        self.assertEqual(vc.to_dict(stamps=True), {"server2": [1, 300.0], "server3": [7, 200.0]})
+        self.assertEqual(vc, VectorClock({"server2": 1, "server3": 7}))
+        self.assertEqual(VectorClock.stats()["truncations"], truncations + 1)
+
+        old_max = config.CLOCK_MAX_ENTRIES
+        config.CLOCK_MAX_ENTRIES = 2
+        try:
+            self.assertEqual(vc.add("server4", 1), 1)
+            self.assertEqual(vc.to_dict(), {"server2": 1, "server4": 1})
+            vc.merge(VectorClock({"server2": [3, 50.0], "server5": [1, 400.0]}))
+            self.assertEqual(vc.to_dict(), {"server4": 1, "server5": 1})
+            vc.merge(VectorClock({"server6": 1}), truncate=False)     # As tombstone clocks are merged
+            self.assertEqual(vc.to_dict(), {"server4": 1, "server5": 1, "server6": 1})
+        finally:
+            config.CLOCK_MAX_ENTRIES = old_max
+        self.assertEqual(pickle.loads(pickle.dumps(vc)).to_dict(stamps=True), vc.to_dict(stamps=True))
+
+    def test_dotted(self):
+        # Two puts in the same context are concurrent, whatever their counters
+        first, second = VectorClock({"A": 2}), VectorClock({"A": 2})
+        first.set_dot("A", 3)
+        second.set_dot("A", 4)
+        self.assertEqual(first.compare(second), VectorClock.CONCURRENT)
+        self.assertEqual(VectorClock({"A": 3}).compare(VectorClock({"A": 4})), VectorClock.BEFORE)
+        self.assertEqual(second.to_dict(), {"A": 4})
+        self.assertEqual(second.to_dict(dot=False), {"A": 2})
+
+        # A put in the context of both comes after both, one that saw only the first after the first alone
+        context = VectorClock()
+        context.merge(first)
+        context.merge(second)
+        self.assertEqual(context.to_dict(), {"A": 4})
+        context.set_dot("B", 1)
+        self.assertTrue(first < context and second < context)
+        partial = VectorClock({"A": 3})
+        partial.set_dot("A", 5)
+        self.assertEqual(first.compare(partial), VectorClock.BEFORE)
+        self.assertEqual(second.compare(partial), VectorClock.CONCURRENT)
+        self.assertEqual(first.compare(VectorClock({"A": 2})), VectorClock.AFTER)
+
+        self.assertNotEqual(first, VectorClock({"A": 3}))
+        self.assertEqual(pickle.loads(pickle.dumps(first)), first)
+
     def test_string_representation(self):
         # Test the string representation of the vector clock
         vc = VectorClock({"server1": 1, "server2": 2})
         self.assertEqual(str(vc), "{'server1': 1, 'server2': 2}")
 
 class TestStorage(unittest.TestCase):
+    ENGINE = None   # config.ENGINE
+
     def setUp(self):
         # self.db = Storage("test_version_tree.db")
-        self.db = Storage("test_version_tree.db")
+        self.db = Storage("test_version_tree.db", engine=self.ENGINE)
 
     @staticmethod
     def print_tree(tree: dict[str |VersionedValue, set[VersionedValue]], str1: str):
@@ -107,7 +173,7 @@ class TestStorage(unittest.TestCase):
         self.db.close()
         self.db.close()
         if os.path.exists("test_version_tree.db"):
-            os.remove("test_version_tree.db")
+            remove_database("test_version_tree.db")
 
     def test_add_version(self):
         context1 = VectorClock({"A": 2})
@@ -288,6 +354,302 @@ class TestStorage(unittest.TestCase):
         leaves = self.db.get_leaf_nodes(1)
         self.assertIn(version_value4, leaves)
 
+    def test_get_leaf_nodes_siblings(self):
+        self.assertIsNone(self.db.get_leaf_nodes(1))
+
+        self.db.add_version(1, "value1", VectorClock({"A": 1}))
+        self.db.add_version(1, "value2", VectorClock({"A": 1, "B": 1}))
+        self.db.add_version(1, "value3", VectorClock({"A": 1, "C": 1}))
+
+        # Leaves are served from their own record, without the version nodes
+        for record_key in list(self.db.db.keys()):
+            if record_key.startswith(self.db.encode(1) + b"\x00n"):
+                del self.db.db[record_key]
+
+        self.assertEqual(self.db.get_leaf_nodes(1), {
+            VersionedValue("value2", VectorClock({"A": 1, "B": 1})),
+            VersionedValue("value3", VectorClock({"A": 1, "C": 1})),
+        })
+
+    def test_concurrent_writes(self):
+        # Writers on their own keys run in parallel, writers on a shared key still see each other's versions
+        def writer(thread: int):
+            for version in range(1, 21):
+                self.db.add_version(f"cart{thread}", f"value{version}", VectorClock({"A": version}))
+                self.db.add_version("shared", f"value{thread}.{version}", VectorClock({f"S{thread}": version}))
+
+        threads = [threading.Thread(target=writer, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for thread in range(8):
+            self.assertEqual(self.db.get_leaf_nodes(f"cart{thread}"), {VersionedValue("value20", VectorClock({"A": 20}))})
+        self.assertEqual(self.db.get_leaf_nodes("shared"),
+                         {VersionedValue(f"value{thread}.20", VectorClock({f"S{thread}": 20})) for thread in range(8)})
+
+    def test_multi_put(self):
+        self.db.multi_put([
+            ("1", "value1", VectorClock({"A": 1})),
+            ("2", "other1", VectorClock({"B": 1})),
+            ("1", "value2", VectorClock({"A": 2})),
+            ("1", "sibling", VectorClock({"A": 1, "C": 1})),
+            ("2", "other1", VectorClock({"B": 1})),     # Duplicate
+        ])
+        self.assertEqual(self.db.get_leaf_nodes("1"), {VersionedValue("value2", VectorClock({"A": 2})),
+                                                       VersionedValue("sibling", VectorClock({"A": 1, "C": 1}))})
+        self.assertEqual(self.db.get_leaf_nodes("2"), {VersionedValue("other1", VectorClock({"B": 1}))})
+
+        # Versions building on existing trees, read back from the engine
+        self.db.cache.clear()
+        self.db.multi_put([("1", "value3", VectorClock({"A": 3, "C": 1})), ("3", "new", VectorClock({"A": 1}))])
+        self.assertEqual(self.db.get_leaf_nodes("1"), {VersionedValue("value3", VectorClock({"A": 3, "C": 1}))})
+        self.assertEqual(self.db.get_version_tree("1")[VersionedValue("value1", VectorClock({"A": 1}))],
+                         {VersionedValue("value2", VectorClock({"A": 2})), VersionedValue("sibling", VectorClock({"A": 1, "C": 1}))})
+
+    def test_multi_get(self):
+        self.db.multi_put([(f"cart{key}", f"value{key}", VectorClock({"A": 1})) for key in range(600)])
+        self.db.cache.clear()
+        self.db.get_leaf_nodes("cart0")     # Cached, the others come from the engine
+        leaves = self.db.multi_get([f"cart{key}" for key in range(600)] + ["missing"])
+        self.assertIsNone(leaves["missing"])
+        for key in range(600):
+            self.assertEqual(leaves[f"cart{key}"], {VersionedValue(f"value{key}", VectorClock({"A": 1}))})
+
+    def test_keys_in_range(self):
+        for key in range(50):
+            self.db.add_version(str(key), f"value{key}", VectorClock({"A": 1}))
+        tokens = {str(key): key_token(str(key)) for key in range(50)}
+        ordered = sorted(tokens, key=lambda key: (tokens[key], key.encode()))
+
+        start, end = config.Q // 4, 3 * config.Q // 4
+        self.assertEqual(list(self.db.keys_in_range(start, end, chunk=3)),
+                         [key for key in ordered if start < tokens[key] <= end])
+
+        # Wrapping around the ring, keys created after the index is built are listed too
+        self.db.add_version("late", "value", VectorClock({"A": 1}))
+        tokens["late"] = key_token("late")
+        ordered = sorted(tokens, key=lambda key: (tokens[key], key.encode()))
+        wrapped = [key for key in ordered if tokens[key] > end] + [key for key in ordered if tokens[key] <= start]
+        self.assertEqual(list(self.db.keys_in_range(end, start, chunk=3)), wrapped)
+        self.assertEqual(sorted(self.db.keys_in_range(start, start)), sorted(tokens))
+
+    def test_scan(self):
+        for key in range(20):
+            self.db.add_version(str(key), f"value{key}", VectorClock({"A": 1}))
+        scanned = dict(self.db.scan(0, 0, chunk=4))
+        self.assertEqual(scanned, {str(key): {VersionedValue(f"value{key}", VectorClock({"A": 1}))} for key in range(20)})
+
+    def test_merkle(self):
+        other = Storage("test_version_tree2.db", engine=self.ENGINE)
+        try:
+            ranges = [(0, config.Q // 2), (config.Q // 2, 0)]
+            self.db.set_ranges(ranges)
+            for key in range(30):
+                self.db.add_version(str(key), f"value{key}", VectorClock({"A": 1}))
+            # Trees built from what is already stored match trees maintained write by write
+            for key in reversed(range(30)):
+                other.add_version(str(key), f"value{key}", VectorClock({"A": 1}))
+            self.assertEqual(other.set_ranges(ranges), ranges)
+            for start, end in ranges:
+                self.assertEqual(self.db.merkle_tree(start, end).root(), other.merkle_tree(start, end).root())
+
+            # A new version only changes the root and bucket of its range
+            other.multi_put([("7", "value7b", VectorClock({"A": 2}))])
+            token = key_token("7")
+            for start, end in ranges:
+                mine, theirs = self.db.merkle_tree(start, end), other.merkle_tree(start, end)
+                changed = in_range(token, start, end)
+                self.assertEqual(mine.root() != theirs.root(), changed)
+                if changed:
+                    bucket = mine.bucket(token)
+                    self.assertNotEqual(mine.node(mine.depth, bucket), theirs.node(theirs.depth, bucket))
+                    self.assertEqual(mine.node(mine.depth, bucket ^ 1), theirs.node(theirs.depth, bucket ^ 1))
+
+            # Ranges still held keep their tree
+            tree = self.db.merkle_tree(*ranges[0])
+            moved = (config.Q // 2, 3 * config.Q // 4)
+            self.assertEqual(self.db.set_ranges([ranges[0], moved]), [moved])
+            self.assertIs(self.db.merkle_tree(*ranges[0]), tree)
+            self.assertIsNone(self.db.merkle_tree(*ranges[1]))
+            self.assertEqual(len(self.db.merkle_tree(*moved)), len([key for key in range(30) if in_range(key_token(str(key)), *moved)]))
+        finally:
+            other.close()
+            if os.path.exists("test_version_tree2.db"):
+                remove_database("test_version_tree2.db")
+
+    def test_compression(self):
+        threshold = config.COMPRESSION_THRESHOLD
+        config.COMPRESSION_THRESHOLD = 64
+        try:
+            db = Storage("test_version_tree2.db", engine=self.ENGINE)
+            carts = [json.dumps({"cart": [f"item{item}" for item in range(key % 7, key % 7 + 8)]}) for key in range(40)]
+            for key, cart in enumerate(carts[:20]):
+                db.add_version(str(key), cart, VectorClock({"A": 1}))
+            plain = db.compression.stats()
+            self.assertGreater(plain["compressed"], 0)
+            self.assertGreater(plain["ratio"], 1)
+
+            db.train_compression()
+            for key, cart in enumerate(carts[20:], 20):
+                db.add_version(str(key), cart, VectorClock({"A": 1}))
+            trained = db.compression.stats()
+            self.assertGreater((trained["raw_bytes"] - plain["raw_bytes"]) / (trained["stored_bytes"] - plain["stored_bytes"]), plain["ratio"])
+
+            # Records compressed with or without the dictionary read back from the engine
+            db.cache.clear()
+            for key, cart in enumerate(carts):
+                self.assertEqual(db.get_leaf_nodes(str(key)), {VersionedValue(cart, VectorClock({"A": 1}))})
+            self.assertNotIn(b"\x00za", [key.encode() for key in db.keys()])
+            db.close()
+        finally:
+            config.COMPRESSION_THRESHOLD = threshold
+            if os.path.exists("test_version_tree2.db"):
+                remove_database("test_version_tree2.db")
+
+    def test_cold_segments(self):
+        cold_after = config.COLD_AFTER
+        config.COLD_AFTER = 3600
+        try:
+            db = Storage("test_version_tree2.db", engine=self.ENGINE)
+            for key in range(10):
+                db.add_version(str(key), f"value{key}", VectorClock({"A": 1}))
+                db.add_version(str(key), f"value{key}.2", VectorClock({"A": 2}))
+            db.add_version("0", "sibling", VectorClock({"B": 1}))
+            tree = db.get_version_tree("0")
+            self.assertEqual(db.demote_cold(), 0)
+
+            # Reads of missing keys are not noted
+            self.assertIsNone(db.get_leaf_nodes("missing"))
+            self.assertEqual(db.multi_get(["missing", "0"])["missing"], None)
+            db.get_version_tree("missing")
+            self.assertEqual(sorted(db.touched), sorted(str(key).encode() for key in range(10)))
+
+            # Every record leaves the hot engine, reads come from the segment without a copy
+            self.assertEqual(db.demote_cold(idle=0), 10)
+            self.assertEqual([key for key in db.db.hot.keys() if not key.startswith(b"\x00")], [])
+            self.assertIsInstance(db.db.get(b"0\x00l"), memoryview)
+            self.assertEqual(sorted(db.keys()), sorted(str(key) for key in range(10)))
+            self.assertEqual(db.get_version_tree("0"), tree)
+            self.assertEqual(db.get_leaf_nodes("5"), {VersionedValue("value5.2", VectorClock({"A": 2}))})
+
+            # A write moves the key back
+            db.add_version("1", "value1.3", VectorClock({"A": 3}))
+            self.assertIn(b"1", db.db.hot.keys())
+            self.assertNotIn(b"1", db.db.cold)
+            self.assertEqual(db.get_leaf_nodes("1"), {VersionedValue("value1.3", VectorClock({"A": 3}))})
+            db.close()
+
+            db = Storage("test_version_tree2.db", engine=self.ENGINE)
+            if self.ENGINE != "memory":
+                self.assertEqual(db.get_leaf_nodes("1"), {VersionedValue("value1.3", VectorClock({"A": 3}))})
+            self.assertEqual(db.get_version_tree("0"), tree)
+
+            # Segments whose keys all moved back are deleted
+            for key in range(10):
+                db.add_version(str(key), f"value{key}.4", VectorClock({"A": 4}))
+            db.close()
+            self.assertEqual(os.listdir("test_version_tree2.db.cold"), [])
+        finally:
+            config.COLD_AFTER = cold_after
+            remove_database("test_version_tree2.db")
+
+    def test_dotted_versions(self):
+        # Puts made in the same context are kept as siblings, a put in the context read replaces them all
+        first, second = VectorClock({"A": 1}), VectorClock({"A": 1})
+        first.set_dot("A", 2)
+        second.set_dot("A", 3)
+        self.db.add_version("cart", "value1", VectorClock({"A": 1}))
+        self.db.add_version("cart", "value2", first)
+        self.db.add_version("cart", "value3", second)
+        self.db.add_version("cart", "value3", second)
+        self.assertEqual(self.db.get_leaf_nodes("cart"), {VersionedValue("value2", first), VersionedValue("value3", second)})
+
+        merged = VectorClock({"A": 3})
+        merged.set_dot("B", 1)
+        self.db.add_version("cart", "merged", merged)
+        self.db.cache.clear()
+        self.assertEqual(self.db.get_leaf_nodes("cart"), {VersionedValue("merged", merged)})
+        self.assertEqual(next(iter(self.db.get_leaf_nodes("cart"))).vector_clock.get_dot()[:2], ("B", 1))
+
+        # First puts of a new key through two coordinators both have counter 0 and are concurrent,
+        # a put that saw only one of them leaves the other
+        x, y = VectorClock(), VectorClock()
+        x.set_dot("A", 0)
+        y.set_dot("B", 0)
+        self.assertEqual(x.compare(y), VectorClock.CONCURRENT)
+        self.db.add_version("new", "x", x)
+        self.db.add_version("new", "y", y)
+        x2 = VectorClock({"A": 0})
+        x2.set_dot("A", 1)
+        self.db.add_version("new", "x2", x2)
+        self.assertEqual(self.db.get_leaf_nodes("new"), {VersionedValue("y", y), VersionedValue("x2", x2)})
+
+    def test_ttl(self):
+        now = time.time()
+        self.db.add_version("cart", "value1", VectorClock({"A": 1}), expires=now + 3600)
+        self.db.add_version("cart", "value2", VectorClock({"A": 2, "B": 1}), expires=now + 3600)
+        self.db.add_version("forever", "value", VectorClock({"A": 1}))
+        self.db.add_version("gone", "value", VectorClock({"A": 1}), expires=now - 1)
+        self.assertEqual(self.db.sweep(rate=0), (["gone"], []))
+
+        # Sweeps walk the expiry index, kept in step with puts and expiries
+        self.assertEqual([key_bytes for _, key_bytes in self.db.expiry_index], [b"cart", b"gone"])
+
+        # Expired keys are hidden from reads before a sweep gets to them
+        self.assertEqual(self.db.get_leaf_nodes("cart"), {VersionedValue("value2", VectorClock({"A": 2, "B": 1}))})
+        self.db.cache.clear()
+        self.assertEqual(self.db.multi_get(["cart", "gone"]), {"cart": {VersionedValue("value2", VectorClock({"A": 2, "B": 1}))}, "gone": None})
+        self.assertEqual(self.db.sweep(rate=0, now=now + 7200), (["cart"], []))
+        self.assertIsNone(self.db.get_leaf_nodes("cart"))
+        self.assertEqual(self.db.keys(), ["forever"])
+
+        # Late writes of versions older than the tombstone are dropped, newer ones bring the key back
+        self.db.add_version("cart", "value1", VectorClock({"A": 1}))
+        self.assertIsNone(self.db.get_leaf_nodes("cart"))
+        self.db.add_version("cart", "value3", VectorClock({"A": 3}))
+        self.assertEqual(self.db.get_leaf_nodes("cart"), {VersionedValue("value3", VectorClock({"A": 3}))})
+        self.assertEqual(set(self.db.get_version_tree("cart")), {"root", "leaves"})
+
+        # Tombstones are stamped with the expiry time, the same on every replica, and go after the grace period
+        self.assertEqual(self.db._records(self.db.encode("cart")).tombstone()[1], now + 3600)
+        later = now + 3600 + config.TOMBSTONE_GRACE + 1
+        self.assertEqual(self.db.sweep(rate=0, now=later), ([], ["gone"]))
+        self.assertEqual(self.db.sweep(rate=0, now=later), ([], []))
+        self.db.add_version("gone", "value", VectorClock({"A": 1}))
+        self.assertEqual(self.db.get_leaf_nodes("gone"), {VersionedValue("value", VectorClock({"A": 1}))})
+        self.assertEqual(self.db.expiry_due, {})
+
+    def test_cache(self):
+        self.db.add_version(1, "value1", VectorClock({"A": 1}))
+        self.db.add_version(1, "value2", VectorClock({"A": 2}))
+        hits = self.db.cache.hits
+
+        # Served from the records written through on add_version
+        self.assertEqual(self.db.get_leaf_nodes(1), {VersionedValue("value2", VectorClock({"A": 2}))})
+        self.assertEqual(self.db.cache.hits, hits + 1)
+
+        # Dropping the cache falls back to the database: one miss for the uncached read, then one hit
+        self.db.cache.clear()
+        hits, misses = self.db.cache.hits, self.db.cache.misses
+        self.assertEqual(self.db.get_leaf_nodes(1), {VersionedValue("value2", VectorClock({"A": 2}))})
+        self.assertIn(self.db.encode(1), self.db.cache)
+        self.assertEqual((self.db.cache.hits, self.db.cache.misses), (hits, misses + 1))
+        self.db.get_leaf_nodes(1)
+        self.assertEqual((self.db.cache.hits, self.db.cache.misses), (hits + 1, misses + 1))
+
+        # Writes do not count
+        self.db.add_version(1, "value3", VectorClock({"A": 3}))
+        self.db.add_version(2, "value", VectorClock({"A": 1}))
+        self.assertEqual((self.db.cache.hits, self.db.cache.misses), (hits + 1, misses + 1))
+
+        # Lock-free reads go to a read view of the leaves and expiry time, replaced whole by writes
+        view = self.db.cache.peek(self.db.encode(1))[READ_VIEW]
+        self.db.add_version(1, "value4", VectorClock({"A": 4}), time.time() + 3600)
+        self.assertEqual(view[0], ((VersionedValue("value3", VectorClock({"A": 3})),), None))
+        self.assertEqual(self.db.cache.peek(self.db.encode(1))[READ_VIEW][0][0], (VersionedValue("value4", VectorClock({"A": 4})),))
+
     def test_compare_versioned_value(self):
         # Test comparison of vector clocks
         vc1 = VectorClock({"A": 1})
@@ -299,10 +661,679 @@ class TestStorage(unittest.TestCase):
         self.assertEqual(Storage.compare_versioned_value(vv2, vv1), "sibling")
         self.assertEqual(Storage.compare_versioned_value(vv1, vv1), "equal")
 
+    def test_legacy_tree_migration(self):
+        # Trees written as a single pickled adjacency dict are split into records on access
+        version_value1 = VersionedValue("value1", VectorClock({"A": 1}))
+        version_value2 = VersionedValue("value2", VectorClock({"A": 2}))
+        legacy = {"root": {version_value1}, "leaves": {version_value2}, version_value1: {version_value2}}
+        self.db.db[self.db.encode(1)] = pickle.dumps(legacy)
+
+        self.assertDictEqual(self.db.get_version_tree(1), legacy)
+
+        self.db.add_version(1, "value3", VectorClock({"A": 3}))
+        self.assertEqual(self.db.get_leaf_nodes(1), {VersionedValue("value3", VectorClock({"A": 3}))})
+
+    def test_compact(self):
+        # A chain A:1 -> ... -> A:6 with a concurrent branch B:1 -> B:1,A:6
+        for version in range(1, 7):
+            self.db.add_version(1, f"value{version}", VectorClock({"A": version}))
+        self.db.add_version(1, "valueB", VectorClock({"B": 1}))
+        self.db.add_version(1, "valueAB", VectorClock({"A": 6, "B": 1}))
+
+        reclaimed = self.db.compact(1, generations=2)
+        self.assertGreater(reclaimed, 0)
+        self.assertEqual(self.db.compact(1, generations=2), 0)
+
+        value5 = VersionedValue("value5", VectorClock({"A": 5}))
+        value6 = VersionedValue("value6", VectorClock({"A": 6}))
+        valueB = VersionedValue("valueB", VectorClock({"B": 1}))
+        valueAB = VersionedValue("valueAB", VectorClock({"A": 6, "B": 1}))
+        self.assertDictEqual(self.db.get_version_tree(1), {
+            'root': {value5, valueB},
+            'leaves': {valueAB},
+            value5: {value6},
+            value6: {valueAB},
+            valueB: {valueAB},
+        })
+
+        # Keeping only the leaves
+        self.db.compact(1, generations=0)
+        self.assertDictEqual(self.db.get_version_tree(1), {'root': {valueAB}, 'leaves': {valueAB}})
+
+        # Nothing is older than the window
+        self.db.add_version(1, "value7", VectorClock({"A": 7, "B": 1}))
+        self.assertEqual(self.db.compact(1, window=60), 0)
+        self.assertEqual(list(self.db.compact_all(generations=0)), ["1"])
+        self.assertEqual(self.db.get_leaf_nodes(1), {VersionedValue("value7", VectorClock({"A": 7, "B": 1}))})
+
     def test_get_version_tree_empty_key(self):
         # Test retrieving a tree for a non-existent key
         tree = self.db.get_version_tree(99)
         self.assertEqual(tree, {"root": set(), "leaves": {"root"}})
 
+    def test_encode(self):
+        # Bytes keys pass through, as in KeyVersion.encode
+        self.assertEqual(self.db.encode(b"cart"), b"cart")
+        self.assertEqual(self.db.encode("cart"), b"cart")
+        self.assertEqual(self.db.encode(1), b"1")
+
+class TestStorageMemory(TestStorage):
+    ENGINE = "memory"
+
+class TestStorageSqlite(TestStorage):
+    ENGINE = "sqlite"
+
+class TestStorageLog(TestStorage):
+    ENGINE = "log"
+
+class TestStorageLsm(TestStorage):
+    ENGINE = "lsm"
+
+class TestLogEngine(unittest.TestCase):
+    def tearDown(self):
+        if os.path.exists("test_log_engine.db"):
+            os.remove("test_log_engine.db")
+
+    def test_reopen(self):
+        db = LogEngine("test_log_engine.db")
+        db[b"a"] = b"1"
+        db.write_batch([(b"b", b"2"), (b"a", b"3"), (b"c", b"4"), (b"c", None)])
+        db.close()
+
+        # Torn record at the tail from a crash mid write
+        with open("test_log_engine.db", "ab") as log:
+            log.write(LogEngine.HEADER.pack(1, 100, 0) + b"k")
+
+        db = LogEngine("test_log_engine.db")
+        self.assertEqual({key: db[key] for key in db.keys()}, {b"a": b"3", b"b": b"2"})
+        db.close()
+
+    def test_rewrite(self):
+        db = LogEngine("test_log_engine.db")
+        for i in range(300):
+            db[b"key"] = bytes(8192)
+        self.assertLess(os.path.getsize("test_log_engine.db"), 1 << 21)
+        self.assertEqual(db[b"key"], bytes(8192))
+        db.close()
+
+class TestLsmEngine(unittest.TestCase):
+    def setUp(self):
+        self.memtable_size = config.LSM_MEMTABLE_SIZE
+        config.LSM_MEMTABLE_SIZE = 256
+        self.db = LsmEngine("test_lsm")
+
+    def tearDown(self):
+        self.db.close()
+        config.LSM_MEMTABLE_SIZE = self.memtable_size
+        remove_database("test_lsm")
+
+    def test_segments(self):
+        for i in range(100):
+            self.db[b"key%03d" % i] = b"value%d" % i
+        del self.db[b"key042"]
+        self.db[b"key007"] = b"new"
+        self.assertGreater(len(self.db.segments), 1)
+
+        self.assertEqual(self.db[b"key007"], b"new")
+        self.assertEqual(self.db[b"key099"], b"value99")
+        self.assertNotIn(b"key042", self.db)
+
+        # Bloom filters keep lookups of missing keys out of the segments
+        skips = self.db.bloom_skips
+        self.assertNotIn(b"missing", self.db)
+        self.assertGreater(self.db.bloom_skips, skips)
+
+        self.assertEqual([key for key, _ in self.db.items(b"key040", b"key045")],
+                         [b"key040", b"key041", b"key043", b"key044"])
+
+        # Segments and memtable journal survive a reopen
+        self.db.close()
+        self.db = LsmEngine("test_lsm")
+        self.assertEqual(len(self.db.keys()), 99)
+        self.assertEqual(self.db[b"key007"], b"new")
+
+    def test_compaction(self):
+        for round in range(20):
+            for i in range(10):
+                self.db[b"key%03d" % i] = b"value%d-%d" % (i, round)
+        self.db.compact()
+
+        self.assertEqual(len(self.db.segments), 1)
+        self.assertEqual(self.db[b"key003"], b"value3-19")
+        self.assertEqual(len(self.db.keys()), 10)
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(max_entries=2, max_bytes=100)
+        cache.put("a", 1, 10)
+        cache.put("b", 2, 10)
+        cache.get("a")
+        cache.put("c", 3, 10)   # Evicts b, the least recently used
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+
+        cache.put("d", 4, 95)   # Over the byte budget, evicts everything else
+        self.assertEqual(cache.get("d"), 4)
+        self.assertIsNone(cache.get("a"))
+
+        cache.put("e", 5, 101)  # Larger than the whole cache, not kept
+        self.assertIsNone(cache.get("e"))
+
+        self.assertEqual(cache.stats(), {"entries": 1, "bytes": 95, "hits": 3, "misses": 3, "evictions": 3})
+
+class TestColdStore(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree("test_cold", ignore_errors=True)
+
+    def test_collect(self):
+        store = ColdStore("test_cold")
+        store.add({b"a": [(b"a", b"1")]})
+        store.add({b"b": [(b"b", b"2")]})
+
+        # A sync deletes the segments dead when it started, keys moved back since are not durable yet
+        store.drop([b"a"])
+        dead = store.dead_segments()
+        store.drop([b"b"])
+        store.collect(dead)
+        self.assertEqual(os.listdir("test_cold"), ["00000002.seg"])
+
+        # A segment being read is unmapped once the read is done
+        store.add({b"c": [(b"c", b"3")]})
+        with store._pinned(b"c") as (segment, records):
+            store.drop([b"c"])
+            store.collect()
+            self.assertEqual(bytes(segment.read(*records[b"c"])), b"3")
+        self.assertRaises(ValueError, segment.read, *records[b"c"])
+        store.close()
+
+class TestRecordCodec(unittest.TestCase):
+    def test_round_trip(self):
+        v1 = VersionedValue("cart", VectorClock({"A": 1, "B": 300}))
+        v2 = VersionedValue(None, VectorClock({"B": 2}))
+        records = [
+            {b"root": "root"},
+            {b"x" * 16: v1, b"y" * 16: v2},
+            (v1, 1700000000.25),
+            {b"x" * 16, b"root"},
+            set(),
+            1700000000.25,
+        ]
+        for record in records:
+            self.assertEqual(RecordCodec.decode(RecordCodec.encode(record)), record)
+        for value in ("", "välue", b"\x00\xff", 0, -5, 1 << 70, 2.5, None, ("other", 1)):
+            versioned_value = VersionedValue(value, VectorClock({"A": 1}))
+            self.assertEqual(RecordCodec.decode(RecordCodec.encode((versioned_value, 0.0)))[0].value, value)
+
+    def test_server_names_interned(self):
+        leaves = {b"x" * 16: VersionedValue("a", VectorClock({"server1": 1, "server2": 2})),
+                  b"y" * 16: VersionedValue("b", VectorClock({"server1": 3}))}
+        raw = RecordCodec.encode(leaves)
+        self.assertEqual(raw.count(b"server1"), 1)
+        self.assertLess(len(raw), len(pickle.dumps(leaves)))
+
+    def test_canonical_version(self):
+        v1 = VersionedValue("cart", VectorClock({"A": 1, "B": 2}))
+        v2 = VersionedValue("cart", VectorClock({"B": 2, "A": 1}))
+        self.assertEqual(RecordCodec.encode_version(v1), RecordCodec.encode_version(v2))
+        self.assertNotEqual(RecordCodec.encode_version(v1), RecordCodec.encode_version(VersionedValue("cart", VectorClock({"A": 1}))))
+
+    def test_stamps(self):
+        record = (VersionedValue("cart", VectorClock({"A": [1, 1700000000.0], "B": [2, 1700000500.0]})), 1.0)
+        decoded = RecordCodec.decode(RecordCodec.encode(record))
+        self.assertEqual(decoded[0].vector_clock.to_dict(stamps=True), record[0].vector_clock.to_dict(stamps=True))
+
+        # Node ids do not depend on stamps, and records written before stamps are still read
+        restamped = VersionedValue("cart", VectorClock({"A": [1, 5.0], "B": [2, 6.0]}))
+        self.assertEqual(RecordCodec.encode_version(record[0]), RecordCodec.encode_version(restamped))
+        unstamped = RecordCodec.encode_version(record[0]) + RecordCodec.DOUBLE.pack(1.0)
+        self.assertEqual(RecordCodec.decode(unstamped), record)
+
+    def test_dots(self):
+        clock = VectorClock({"A": [1, 1700000000.0]})
+        clock.set_dot("B", 4, 1700000500.0)
+        record = {b"x" * 16: VersionedValue("cart", clock), b"y" * 16: VersionedValue("other", VectorClock({"A": 2}))}
+        decoded = RecordCodec.decode(RecordCodec.encode(record))
+        self.assertEqual(decoded, record)
+        self.assertEqual(decoded[b"x" * 16].vector_clock.get_dot(), ("B", 4, 1700000500.0))
+        self.assertIsNone(decoded[b"y" * 16].vector_clock.dot)
+
+        # Versions differing by their dot alone have different ids
+        other = VectorClock({"A": 1})
+        other.set_dot("B", 5)
+        self.assertNotEqual(RecordCodec.encode_version(VersionedValue("cart", clock)), RecordCodec.encode_version(VersionedValue("cart", other)))
+
+    def test_pickled_records(self):
+        record = (VersionedValue("cart", VectorClock({"A": 1})), 1.0)
+        self.assertEqual(RecordCodec.decode(pickle.dumps(record)), record)
+
+class TestMerkleTree(unittest.TestCase):
+    def test_incremental(self):
+        tree = MerkleTree(100, 50, depth=4)     # Wraps around the ring
+        empty = tree.root()
+        tree.set(b"a", 120, 1)
+        tree.set(b"b", 10, 2)
+        other = MerkleTree(100, 50, depth=4)
+        other.set(b"b", 10, 2)
+        other.set(b"a", 120, 1)
+        self.assertEqual(tree.root(), other.root())
+
+        tree.set(b"a", 120, 3)
+        self.assertNotEqual(tree.root(), other.root())
+        self.assertEqual(tree.node(4, tree.bucket(10)), other.node(4, other.bucket(10)))
+        tree.set(b"a", 120, None)
+        tree.set(b"b", 10, None)
+        self.assertEqual(tree.root(), empty)
+        self.assertEqual(len(tree), 0)
+
+    def test_ranges(self):
+        ranges = MerkleRanges()
+        ranges.replace([(10, 20), (30, 5)], depth=2)
+        self.assertEqual((ranges.tree_for(15).start, ranges.tree_for(15).end), (10, 20))
+        self.assertEqual(ranges.tree_for(40).end, 5)
+        self.assertEqual(ranges.tree_for(3).end, 5)
+        self.assertIsNone(ranges.tree_for(25))
+
+    def test_ring_ranges(self):
+        ring = Ring([VirtualNode(f"s{i}", pos) for i, pos in enumerate((10, 20, 30, 40))], {})
+        # A range is held by the servers of the N virtual nodes from its end on
+        self.assertEqual(ring.ranges("s0"), [(40, 10), (20, 30), (30, 40)])
+        self.assertEqual(ring.ranges("s1"), [(40, 10), (10, 20), (30, 40)])
+
+class TestRing(unittest.TestCase):
+    def test_pref_list_table(self):
+        ring = Ring([VirtualNode(f"s{i % 4}", pos) for i, pos in enumerate((10, 20, 30, 40, 50, 60))], {})
+        ring.serverName = "s0"
+        ring.versions = {"s0": 1}
+        self.assertEqual(ring.getPrefListByToken(25), ["s2", "s3", "s0"][:config.N])
+        self.assertEqual(ring.getPrefListByToken(30), ring.getPrefListByToken(21))
+        self.assertEqual(ring.getPrefListByToken(61), ring.getPrefListByToken(0))   # Wraps around the ring
+
+        # The table follows the tokens of the ring
+        ring.add(26)
+        self.assertEqual(ring.getPrefListByToken(25)[0], "s0")
+        ring.delete(26)
+        self.assertEqual(ring.getPrefListByToken(25)[0], "s2")
+        other = Ring([VirtualNode("s5", 22)], {"s5": 1})
+        self.assertEqual(ring.merge(other), ({VirtualNode("s5", 22)}, set()))
+        self.assertEqual(ring.getPrefListByToken(21)[0], "s5")
+        self.assertTrue(ring.check_key("cart") == ("s0" in ring.getPrefList("cart")))
+        self.assertEqual(Ring([]).getPrefListByToken(5), [])
+
+    def test_key_hash(self):
+        self.assertEqual(key_token("cart"), int(hashlib.md5(b"cart").hexdigest(), 16) % config.Q)
+
+        # The highest (version, name) setting wins on every server, and travels with the ring
+        ring, other = Ring([VirtualNode("s0", 10)], {"s0": 1}), Ring([VirtualNode("s1", 20)], {"s1": 1})
+        other.setKeyHash("crc32")
+        self.assertRaises(ValueError, other.setKeyHash, "sha1")
+        ring.merge(Ring.deserialize(json.loads(json.dumps(other.serialize()))))
+        self.assertEqual(ring.keyHash, (1, "crc32"))
+        other.merge(Ring([], {}, (1, "blake2b")))
+        self.assertEqual(other.keyHash, (1, "crc32"))
+        self.assertEqual(ring._hash("cart"), zlib.crc32(b"cart") % config.Q)
+
+        # A server joining takes the setting of the cluster, whatever its own config
+        founder, newcomer = Ring([], {}, (0, "blake2b")), Ring([], {})
+        newcomer.init("s1", 1, ["s0"])
+        self.assertEqual(newcomer.keyHash[0], -1)
+        founder.mergeDelta({}, newcomer.keyHash)
+        self.assertEqual(founder.keyHash, (0, "blake2b"))
+        newcomer.mergeDelta({}, founder.keyHash)
+        self.assertEqual(newcomer.keyHash, (0, "blake2b"))
+        seed = Ring([], {})
+        seed.init("s0", 1, ["s0", "s1"])
+        self.assertEqual(seed.keyHash, (0, config.RING_HASH))
+
+        # key_token follows the current snapshot of the ring of the server
+        try:
+            use_ring(ring)
+            self.assertEqual(key_token("cart"), ring._hash("cart"))
+            ring.setKeyHash("blake2b")
+            self.assertEqual(key_token("cart"), ring._hash("cart"))
+        finally:
+            use_ring(None)
+
+        # Once a server holds data the setting is sealed, on every server gossip reaches
+        ring.seal()
+        self.assertRaises(ValueError, ring.setKeyHash, "md5")
+        self.assertEqual(ring.keyHash, (2, "blake2b"))
+        other.merge(Ring.deserialize(json.loads(json.dumps(ring.serialize()))))
+        self.assertTrue(other.sealed)
+        self.assertRaises(ValueError, other.setKeyHash, "md5")
+        newcomer.mergeDelta({}, ring.keyHash, ring.sealed)
+        self.assertTrue(newcomer.sealed)
+        self.assertFalse(founder.sealed)
+
+    def test_delta_gossip(self):
+        ring = Ring([VirtualNode("s0", 10), VirtualNode("s1", 20), VirtualNode("s2", 30)], {"s0": 1, "s1": 1, "s2": 1})
+        other = Ring([VirtualNode("s0", 10), VirtualNode("s1", 25), VirtualNode("s3", 40)], {"s0": 1, "s1": 2, "s3": 1})
+
+        # Only the servers one side is behind on travel, each way
+        self.assertEqual(other.newerThan(ring.versions), ["s1", "s3"])
+        self.assertEqual(other.olderThan(ring.versions), ["s2"])
+        response = json.loads(json.dumps({'delta': other.delta(other.newerThan(ring.versions))}))
+        self.assertEqual(response['delta'], {"s1": [2, [25]], "s3": [1, [40]]})
+        self.assertEqual(ring.mergeDelta(response['delta']), ({VirtualNode("s1", 25), VirtualNode("s3", 40)}, {VirtualNode("s1", 20)}))
+        other.mergeDelta(ring.delta(other.olderThan(ring.versions)))
+        self.assertEqual(list(ring.state), list(other.state))
+        self.assertEqual(ring.snapshot.prefLists, other.snapshot.prefLists)
+        self.assertEqual(ring.mergeDelta(other.delta(other.versions)), (set(), set()))
+        self.assertLess(len(json.dumps({'versions': ring.versions})), ring.serializedSize())
+
+    def test_skip_suspected(self):
+        ring = Ring([VirtualNode(f"s{i}", pos) for i, pos in enumerate((10, 20, 30, 40, 50))], {})
+        self.assertEqual(ring.getPrefListByToken(15, skip=set()), ring.getPrefListByToken(15))
+        # The list goes on past the suspected servers, to N healthy ones when there are enough
+        expected = [server for server in ["s1", "s2", "s3", "s4", "s0"] if server != "s2"][:config.N]
+        self.assertEqual(ring.getPrefListByToken(15, skip={"s2"}), expected)
+        self.assertEqual(ring.getPrefListByToken(15, skip={"s0", "s1", "s2", "s3"}), ["s4"])
+
+    def test_snapshots(self):
+        ring = Ring([VirtualNode("s1", 10), VirtualNode("s2", 20)], {"s0": 1, "s1": 1, "s2": 1})
+        ring.init("s0", 2, ["s1", "s2"])
+        before = ring.snapshot
+        ring.add(15)
+        self.assertIsNot(ring.snapshot, before)
+        self.assertNotIn(VirtualNode("s0", 15), before.nodes)
+        self.assertEqual(before.versions["s0"], 1)
+        self.assertEqual(ring.versions["s0"], 2)
+        self.assertEqual(ring.serverSet, {"s1", "s2"})
+
+        # Readers never see a half applied update while gossip keeps replacing the ring
+        errors = []
+        def read():
+            try:
+                for key in range(2000):
+                    snapshot = ring.snapshot
+                    prefList = ring.getPrefList(str(key))
+                    self.assertTrue(prefList and len(snapshot.positions) == len(snapshot.prefLists))
+            except Exception as e:
+                errors.append(e)
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for version in range(2, 200):
+            ring.mergeDelta({"s3": [version, [version, version + 1000]]})
+        for reader in readers:
+            reader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual([node.pos for node in ring.state if node.server == "s3"], [199, 1199])
+
+class TestFailureDetector(unittest.TestCase):
+    def test_phi(self):
+        detector = PhiAccrualDetector(threshold=8, min_std=0.1, first_interval=1.0)
+        self.assertEqual(detector.phi("s1", now=0), 0.0)
+        for beat in range(20):
+            detector.heartbeat("s1", now=beat)
+        detector.heartbeat("s2", now=19)
+
+        # Suspicion grows with the silence past the usual interval
+        self.assertLess(detector.phi("s1", now=19.5), 1)
+        self.assertLess(detector.phi("s1", now=20.1), detector.phi("s1", now=20.5))
+        self.assertEqual(detector.suspects(now=19.5), set())
+        self.assertEqual(detector.suspects(now=22), {"s1", "s2"})
+        detector.heartbeat("s1", now=22)
+        self.assertEqual(detector.suspects(now=22), {"s2"})
+        detector.forget("s2")
+        self.assertEqual(set(detector.levels(now=22)), {"s1"})
+
+class TestCompression(unittest.TestCase):
+    def test_threshold(self):
+        compression = Compression(MemoryEngine(), threshold=100)
+        small, large = b"\x01" + b"a" * 50, b"\x01" + b"a" * 500
+        self.assertIs(compression.compress(small), small)
+        stored = compression.compress(large)
+        self.assertLess(len(stored), len(large))
+        self.assertEqual(compression.decompress(stored), large)
+        self.assertEqual(compression.decompress(small), small)
+        self.assertEqual(compression.stats()["compressed"], 1)
+
+    def test_dictionary(self):
+        db = MemoryEngine()
+        samples = [json.dumps({"cart": [f"product-{item}" for item in range(key, key + 5)]}).encode() for key in range(50)]
+        zdict = train_dictionary(samples, 512)
+        self.assertLessEqual(len(zdict), 512)
+
+        compression = Compression(db, threshold=0)
+        without = compression.compress(b"\x01" + samples[3])
+        compression.add_dictionary(zdict)
+        with_dictionary = compression.compress(b"\x01" + samples[3])
+        self.assertLess(len(with_dictionary), len(without))
+
+        # Dictionaries are stored with the records and picked up by a new instance
+        reopened = Compression(db, threshold=0)
+        self.assertEqual(reopened.active, compression.active)
+        self.assertEqual(reopened.decompress(with_dictionary), b"\x01" + samples[3])
+        self.assertEqual(reopened.decompress(without), b"\x01" + samples[3])
+
+class TestKeyVersion(unittest.TestCase):
+    def setUp(self):
+        self.block = config.VERSION_BLOCK
+        config.VERSION_BLOCK = 10
+        self.kv = KeyVersion("test_key_versions.db", engine="log")
+
+    def tearDown(self):
+        config.VERSION_BLOCK = self.block
+        remove_database("test_key_versions.db")
+
+    def test_next_version(self):
+        self.assertFalse(self.kv.exists("1"))
+        self.assertEqual([self.kv.next_version("1") for _ in range(3)], [0, 1, 2])
+        self.assertTrue(self.kv.exists("1"))
+        self.assertEqual(self.kv.get_version("1"), 2)
+        self.kv.inc_version("1")
+        self.assertEqual(self.kv.get_version("1"), 3)
+        self.kv.close()
+
+    def test_reserved_blocks(self):
+        for _ in range(25):
+            self.kv.next_version("1")
+        # Only the ceiling of the current block is stored, in a fixed-width encoding
+        self.assertEqual(self.kv.db[b"1"], KeyVersion.CEILING.pack(30))
+
+        # Without a clean close a restart skips the rest of the block
+        self.kv.db.close()
+        self.kv = KeyVersion("test_key_versions.db", engine="log")
+        self.assertEqual(self.kv.next_version("1"), 30)
+
+        # A clean close gives the rest of the block back
+        self.kv.close()
+        self.kv = KeyVersion("test_key_versions.db", engine="log")
+        self.assertEqual(self.kv.next_version("1"), 31)
+        self.kv.close()
+
+    def test_legacy_counter(self):
+        self.kv.db[b"1"] = pickle.dumps(7)
+        self.assertEqual(self.kv.get_version("1"), 7)
+        self.assertEqual(self.kv.next_version("1"), 8)
+        self.kv.close()
+
+    def test_concurrent_allocation(self):
+        versions = []
+        def allocate():
+            for _ in range(100):
+                versions.append(self.kv.next_version("1"))
+        threads = [threading.Thread(target=allocate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(versions), list(range(400)))
+        self.kv.close()
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.storage = Storage("test_version_tree.db", engine="memory")
+        self.kv = KeyVersion("test_key_versions.db", engine="memory")
+        for key in range(20):
+            for version in range(3):
+                self.storage.add_version(str(key), f"value{key}.{version}", VectorClock({"A": self.kv.next_version(str(key))}))
+        self.storage.add_version("0", "sibling", VectorClock({"B": 1}))
+
+    def tearDown(self):
+        for path in ("test_snapshot", "test_snapshot.tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def restore(self) -> tuple[Storage, KeyVersion]:
+        storage = Storage("test_version_tree2.db", engine="memory")
+        kv = KeyVersion("test_key_versions2.db", engine="memory")
+        load_snapshot(storage, kv, "test_snapshot")
+        return storage, kv
+
+    def test_round_trip(self):
+        trees = {key: self.storage.get_version_tree(key) for key in self.storage.keys()}
+        records = export_snapshot(self.storage, self.kv, "test_snapshot", chunk_size=256)
+        self.assertEqual(records, len(self.storage.db.db) + len(self.kv.db.db))
+
+        storage, kv = self.restore()
+        self.assertEqual({key: storage.get_version_tree(key) for key in storage.keys()}, trees)
+        # Counters resume past every version the source may have handed out
+        self.assertGreaterEqual(kv.next_version("5"), self.kv.next_version("5"))
+        with self.assertRaises(ValueError):
+            load_snapshot(storage, kv, "test_snapshot")     # Not empty
+
+    def test_point_in_time(self):
+        trees = {key: self.storage.get_version_tree(key) for key in self.storage.keys()}
+
+        # Writes made while the snapshot is streamed are left out of it
+        def write(done: int, total: int):
+            if done == 1:
+                self.storage.add_version("9", "later", VectorClock({"A": 10}))
+                self.storage.multi_put([("new", "later", VectorClock({"A": 1})), ("8", "later", VectorClock({"A": 10}))])
+        export_snapshot(self.storage, self.kv, "test_snapshot", progress=write)
+        self.assertEqual(self.storage.get_leaf_nodes("9"), {VersionedValue("later", VectorClock({"A": 10}))})
+
+        storage, _ = self.restore()
+        self.assertEqual({key: storage.get_version_tree(key) for key in storage.keys()}, trees)
+
+    def test_corrupt(self):
+        export_snapshot(self.storage, self.kv, "test_snapshot", chunk_size=256)
+        with open("test_snapshot", "r+b") as file:
+            file.seek(100)
+            file.write(b"\xff")
+        storage = Storage("test_version_tree2.db", engine="memory")
+        kv = KeyVersion("test_key_versions2.db", engine="memory")
+        with self.assertRaises(ValueError):
+            load_snapshot(storage, kv, "test_snapshot")
+        self.assertEqual(storage.db.db, {})
+
+        with open("test_snapshot", "r+b") as file:
+            file.truncate(os.path.getsize("test_snapshot") - CHUNK.size)
+        with self.assertRaises(ValueError):
+            load_snapshot(storage, kv, "test_snapshot")
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.wal = WriteAheadLog("test_wal.log", 0.005)
+
+    def tearDown(self):
+        self.wal.file.close()
+        for path in ("test_wal.log", "test_version_tree.db", "test_key_versions.db"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_group_commit(self):
+        db = {}
+        self.wal.register("db", db)
+
+        def write(i):
+            record_key = str(i).encode()
+            db[record_key] = b"value"
+            self.wal.wait(self.wal.submit("db", [(record_key, b"value")]))
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.wal.commits, 20)
+        self.assertLess(self.wal.fsyncs, 20)
+        self.assertEqual(len(self.wal.entries()), 20)
+
+    def test_recovery(self):
+        self.wal.register("db", {})
+        self.wal.wait(self.wal.submit("db", [(b"a", b"1"), (b"b", b"2")]))
+        self.wal.wait(self.wal.submit("db", [(b"a", None)]))
+        self.wal.wait(self.wal.submit("other", [(b"c", b"3")]))
+
+        # Torn entry at the tail from a crash mid write
+        self.wal.file.write(HEADER.pack(100, 0) + b"partial")
+        self.wal.file.flush()
+
+        recovered = {}
+        WriteAheadLog("test_wal.log", 0.005).register("db", recovered)
+        self.assertEqual(recovered, {b"b": b"2"})
+
+    def test_checkpoint(self):
+        db = {}
+        self.wal.register("db", db)
+        self.wal.checkpoint_size = 1
+        self.wal.wait(self.wal.submit("db", [(b"a", b"1")]))
+        self.assertEqual(self.wal.entries(), [])
+
+    def test_write_ahead(self):
+        # Writes are on disk before they are applied, so a crash while applying them is redone
+        class Crash(Exception):
+            pass
+
+        class Torn(dict):
+            def __setitem__(self, key, value):
+                if key == b"b":
+                    raise Crash()
+                super().__setitem__(key, value)
+
+        db = Torn()
+        self.wal.register("db", db)
+        self.assertRaises(Crash, self.wal.commit, "db", [(b"a", b"1"), (b"b", b"2")], db)
+        self.assertEqual(db, {b"a": b"1"})
+        recovered = {}
+        WriteAheadLog("test_wal.log", 0.005).register("db", recovered)
+        self.assertEqual(recovered, {b"a": b"1", b"b": b"2"})
+
+        # The log is truncated once the writes it holds are applied
+        self.wal.checkpoint_size = 1
+        applied = {}
+        self.wal.commit("db", [(b"c", b"3")], applied)
+        self.assertEqual(applied, {b"c": b"3"})
+        self.assertEqual(self.wal.entries(), [])
+
+    def test_key_version_group_commit(self):
+        # Blocks of different keys are reserved without a global lock held across the fsync
+        kv = KeyVersion("test_key_versions.db", self.wal, engine="memory")
+        threads = [threading.Thread(target=kv.next_version, args=(str(i),)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([kv.get_version(str(i)) for i in range(20)], [0] * 20)
+        self.assertEqual(self.wal.commits, 20)
+        self.assertLess(self.wal.fsyncs, 20)
+        kv.close()
+
+    def test_storage_recovery(self):
+        storage = Storage("test_version_tree.db", self.wal, engine="memory")
+        kv = KeyVersion("test_key_versions.db", self.wal, engine="memory")
+        kv.add_key("1")
+        kv.inc_version("1")
+        storage.add_version("1", "value1", VectorClock({"A": 1}))
+        self.assertEqual(len(self.wal.entries()), 2)    # One counter block and one put
+
+        # Logged writes are redone into whatever the database files hold
+        recovered = {}
+        WriteAheadLog("test_wal.log", 0.005).register("test_version_tree.db", recovered)
+        self.assertEqual(recovered, storage.db.db)
+
+        # Dictionaries are logged before records compressed with them
+        storage.compression.threshold = 0
+        dictionary_id = storage.train_compression([b'{"items": ["apple", "pear"]}'] * 4)
+        storage.add_version("2", {"items": ["apple", "pear"]}, VectorClock({"A": 1}))
+        recovered = {}
+        WriteAheadLog("test_wal.log", 0.005).register("test_version_tree.db", recovered)
+        self.assertEqual(recovered[ACTIVE_KEY], struct.pack('!I', dictionary_id))
+        self.assertEqual(recovered, storage.db.db)
+        storage.close()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
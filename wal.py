@@ -0,0 +1,156 @@
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from engine import Engine, Writes
+
+# Each log entry is a (length, crc32) header followed by a pickled (database name, writes) pair.
+# A write is a (record key, record) pair, a None record deletes the key.
+HEADER = struct.Struct('!II')
+
+class WriteAheadLog:
+    """
+    Redo log shared by the databases of a server.
+    Writers commit their records: the log is on disk before the database is written (write-ahead),
+    so a crash in the middle of a multi-record write is redone from the log on restart. Writers
+    that arrive within `window` seconds of each other share a single write + fsync (group commit).
+    Once the log grows past `checkpoint_size` bytes, and the writes it holds are all applied, the
+    databases are synced and the log is truncated.
+    """
+    def __init__(self, path: str, window: float, checkpoint_size: int = 1 << 22):
+        self.path: str = path
+        self.window: float = window
+        self.checkpoint_size: int = checkpoint_size
+        self.dbs: dict[str, object] = {}
+
+        self.file = open(path, 'ab')
+        self.cv = threading.Condition()
+        self.io_lock = threading.Lock()     # Orders batches on disk
+        self.pending: list[bytes] = []
+        self.batch: int = 1                 # Batch currently being filled
+        self.synced: int = 0                # Last batch on disk
+        self.leader: bool = False           # A writer is collecting the current batch
+        self.applying: int = 0              # Commits logged or being logged, not applied yet
+        self.checkpointing: bool = False    # A checkpoint waits for them, new commits wait for it
+
+        # Metrics
+        self.commits: int = 0
+        self.fsyncs: int = 0
+
+    def register(self, name: str, db) -> None:
+        """Attach a database to the log and redo the writes logged for it since the last checkpoint."""
+        self.dbs[name] = db
+        for entry_name, writes in self.entries():
+            if entry_name == name:
+                self.apply(db, writes)
+        if hasattr(db, 'sync'):
+            db.sync()
+
+    @staticmethod
+    def apply(db, writes: Writes) -> None:
+        if isinstance(db, Engine):
+            db.write_batch(writes)
+            return
+        for record_key, record in writes:
+            if record is not None:
+                db[record_key] = record
+            elif record_key in db:
+                del db[record_key]
+
+    def entries(self) -> list[tuple[str, Writes]]:
+        """Read back the complete entries of the log, stopping at a torn or corrupt tail."""
+        entries = []
+        with open(self.path, 'rb') as log:
+            data = log.read()
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            length, crc = HEADER.unpack_from(data, offset)
+            payload = data[offset + HEADER.size: offset + HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            entries.append(pickle.loads(payload))
+            offset += HEADER.size + length
+        return entries
+
+    def commit(self, name: str, writes: Writes, db) -> None:
+        """Log writes of a database and wait until they are on disk, then apply them to `db`."""
+        with self.cv:
+            while self.checkpointing:
+                self.cv.wait()
+            self.applying += 1
+        try:
+            self.wait(self.submit(name, writes))
+            self.apply(db, writes)
+        finally:
+            with self.cv:
+                self.applying -= 1
+                self._checkpoint_if_idle()
+
+    def submit(self, name: str, writes: Writes) -> int:
+        """Queue writes of a database, returns the batch to wait for."""
+        payload = pickle.dumps((name, writes))
+        with self.cv:
+            self.pending.append(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.commits += 1
+            return self.batch
+
+    def wait(self, batch: int) -> None:
+        """Block until the given batch is durable, leading the group commit if nobody is."""
+        with self.cv:
+            while self.synced < batch:
+                if self.leader:
+                    self.cv.wait()
+                    continue
+                self.leader = True
+                self.cv.release()
+                try:
+                    time.sleep(self.window)     # Let concurrent writers join the batch
+                finally:
+                    self.cv.acquire()
+                self._commit()
+
+    def _commit(self) -> None:
+        """Write and fsync the current batch, called by the leader holding self.cv."""
+        entries, self.pending = self.pending, []
+        batch = self.batch
+        self.batch += 1
+        self.leader = False
+        self.io_lock.acquire()
+        self.cv.release()
+        try:
+            self.file.write(b''.join(entries))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.fsyncs += 1
+            full = self.file.tell() >= self.checkpoint_size
+        finally:
+            self.io_lock.release()
+            self.cv.acquire()
+        self.synced = max(self.synced, batch)
+        self.checkpointing = self.checkpointing or full
+        self._checkpoint_if_idle()
+        self.cv.notify_all()
+
+    def _checkpoint_if_idle(self) -> None:
+        """Checkpoint once one is due and every logged commit is applied, called holding self.cv."""
+        if self.checkpointing and not self.applying:
+            with self.io_lock:
+                self.checkpoint()
+            self.checkpointing = False
+            self.cv.notify_all()
+
+    def checkpoint(self) -> None:
+        """Flush the databases and drop the log, every logged write must already be applied to them."""
+        for db in self.dbs.values():
+            if hasattr(db, 'sync'):
+                db.sync()
+        self.file.truncate(0)
+        self.file.seek(0)
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        with self.io_lock:
+            self.checkpoint()
+            self.file.close()